@@ -0,0 +1,411 @@
+# PATH: indflow/bench_ingest.py
+# LAST_RECODE: 2026-10-17 15:30 America/Bahia
+# MOTIVO: Benchmark do ingest do ESP (/machine/update) com frota simulada; mede latencia, req/s,
+#         SQL por request e commits por request, e compara com o baseline salvo (bench_baseline.json).
+#
+# Uso:
+#   python bench_ingest.py                          # test client, 20 devices x 150 leituras
+#   python bench_ingest.py --devices 50 --ticks 300
+#   python bench_ingest.py --modo waitress          # servidor local real (threads + HTTP)
+#   python bench_ingest.py --salvar-baseline        # grava o resultado como novo baseline
+#
+# Sempre roda num banco temporario (nunca no indflow.db). Sai com codigo 1 se alguma metrica
+# piorar mais que --tolerancia em relacao ao baseline.
+
+import argparse
+import atexit
+import hashlib
+import http.client
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BASE_DIR, "bench_baseline.json")
+
+API_KEY = "bench-key"
+CLIENTE_ID = "bench-cliente"
+
+# Threads que nao sao request (contadas a parte: escrita amortizada em lote)
+_THREADS_FUNDO = {"indflow-event-journal", "indflow-status-refresh"}
+
+
+# ============================================================
+# CONTADOR DE SQL (trace_callback em toda conexao aberta)
+# ============================================================
+class ContadorSQL:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.zerar()
+
+    def zerar(self):
+        with self._lock:
+            self.req_stmts = 0
+            self.req_commits = 0
+            self.bg_stmts = 0
+            self.bg_commits = 0
+
+    def registrar(self, sql: str):
+        commit = sql.lstrip().upper().startswith("COMMIT")
+        fundo = threading.current_thread().name in _THREADS_FUNDO
+        with self._lock:
+            if fundo:
+                self.bg_stmts += 1
+                self.bg_commits += 1 if commit else 0
+            else:
+                self.req_stmts += 1
+                self.req_commits += 1 if commit else 0
+
+
+CONTADOR = ContadorSQL()
+_SQLITE_CONNECT_ORIGINAL = sqlite3.connect
+
+
+def _connect_contado(*args, **kwargs):
+    conn = _SQLITE_CONNECT_ORIGINAL(*args, **kwargs)
+    try:
+        conn.set_trace_callback(CONTADOR.registrar)
+    except Exception:
+        pass
+    return conn
+
+
+# ============================================================
+# FROTA SIMULADA
+# ============================================================
+class EspSimulado:
+    """
+    Um ESP: contador absoluto crescente, paradas ocasionais (MANUAL / run=0),
+    seq monotonico e ts_ms do relogio simulado.
+    """
+
+    def __init__(self, idx: int, rnd: random.Random):
+        self.idx = idx
+        self.rnd = rnd
+        self.mac = "BE:EF:00:00:%02X:%02X" % ((idx >> 8) & 0xFF, idx & 0xFF)
+        self.machine_id = f"bench{idx:03d}"
+        self.contador = rnd.randint(0, 5000)
+        self.seq = 0
+        self.parada_restante = 0
+
+    def proxima_leitura(self, ts_ms: int) -> dict:
+        if self.parada_restante > 0:
+            self.parada_restante -= 1
+        elif self.rnd.random() < 0.03:
+            self.parada_restante = self.rnd.randint(2, 12)
+
+        rodando = self.parada_restante == 0
+        if rodando:
+            self.contador += self.rnd.randint(0, 4)
+
+        self.seq += 1
+        return {
+            "mac": self.mac,
+            "machine_id": self.machine_id,
+            "producao_turno": self.contador,
+            "status": "AUTO" if rodando else "MANUAL",
+            "run": 1 if rodando else 0,
+            "seq": self.seq,
+            "ts_ms": ts_ms,
+        }
+
+
+def _percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * (p / 100.0)
+    i = int(k)
+    j = min(i + 1, len(ordenados) - 1)
+    return ordenados[i] + (ordenados[j] - ordenados[i]) * (k - i)
+
+
+def _preparar_banco(db_path: str, esps: list, bobinas_csv: str) -> dict:
+    """Cliente + OP ATIVA por maquina (com bobinas). Fora da medicao."""
+    from modules.producao.routes import init_op_db
+
+    init_op_db()
+
+    conn = _SQLITE_CONNECT_ORIGINAL(db_path)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO clientes (id, nome, api_key_hash, status, created_at) VALUES (?, ?, ?, 'active', ?)",
+            (CLIENTE_ID, "Bench", hashlib.sha256(API_KEY.encode()).hexdigest(), datetime.now().isoformat()),
+        )
+        ops = {}
+        for esp in esps:
+            cur = conn.execute(
+                "INSERT INTO ordens_producao (machine_id, os, lote, operador, bobina, started_at, status, baseline_pcs) "
+                "VALUES (?, 'OS-BENCH', 'L1', 'bench', ?, ?, 'ATIVA', ?)",
+                (esp.machine_id, bobinas_csv, datetime.now().isoformat(), esp.contador),
+            )
+            ops[esp.machine_id] = int(cur.lastrowid)
+        conn.commit()
+        return ops
+    finally:
+        conn.close()
+
+
+def _armar_troca_bobina(db_path: str, op_id: int, machine_id: str, abs_pcs: int, agora_iso: str) -> None:
+    """
+    Mesmo efeito de POST /producao/op/troca-bobina (fecha a bobina aberta e arma a pendencia);
+    a abertura da proxima acontece no proximo /machine/update, que e o que medimos.
+    """
+    conn = _SQLITE_CONNECT_ORIGINAL(db_path)
+    try:
+        row = conn.execute(
+            "SELECT MAX(seq) FROM ordens_producao_bobina_eventos WHERE op_id = ? AND ended_at IS NULL",
+            (op_id,),
+        ).fetchone()
+        if not row or row[0] is None:
+            return
+        agora = agora_iso
+        conn.execute(
+            "UPDATE ordens_producao_bobina_eventos SET ended_at = ?, end_abs_pcs = ? WHERE op_id = ? AND seq = ?",
+            (agora, int(abs_pcs), op_id, int(row[0])),
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO ordens_producao_bobina_pendencia "
+            "(op_id, machine_id, armed_at, closed_seq, closed_abs_pcs, next_seq, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (op_id, machine_id, agora, int(row[0]), int(abs_pcs), int(row[0]) + 1, agora, agora),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _inicio_simulado(hhmm: str) -> datetime:
+    """Hoje no HH:MM (Bahia); se ainda nao chegou, ontem (relogio simulado nunca no futuro)."""
+    from modules.machine_calc import now_bahia
+
+    agora = now_bahia()
+    h, m = [int(x) for x in hhmm.split(":")]
+    ini = agora.replace(hour=h, minute=m, second=0, microsecond=0)
+    if ini > agora:
+        ini -= timedelta(days=1)
+    return ini
+
+
+# ============================================================
+# MODOS
+# ============================================================
+def _rodar_test_client(app, esps, args, db_path, ops) -> list:
+    """Sequencial, relogio simulado (relogio_replay) para atravessar a troca de turno."""
+    from modules.machine_calc import relogio_replay
+
+    client = app.test_client()
+    headers = {"X-API-Key": API_KEY}
+    t0 = _inicio_simulado(args.inicio)
+    latencias = []
+
+    for tick in range(args.ticks):
+        agora_sim = t0 + timedelta(seconds=tick * args.intervalo)
+        ts_ms = int(agora_sim.timestamp() * 1000)
+
+        if args.troca_bobina and tick > 0 and tick % args.troca_bobina == 0:
+            for esp in esps:
+                _armar_troca_bobina(db_path, ops[esp.machine_id], esp.machine_id, esp.contador, agora_sim.isoformat())
+
+        for esp in esps:
+            payload = esp.proxima_leitura(ts_ms)
+            ini = time.perf_counter()
+            with relogio_replay(agora_sim):
+                r = client.post("/machine/update", json=payload, headers=headers)
+            latencias.append((time.perf_counter() - ini) * 1000.0)
+            if r.status_code != 200:
+                raise SystemExit(f"/machine/update {r.status_code}: {r.get_data(as_text=True)[:200]}")
+
+    return latencias
+
+
+def _rodar_waitress(app, esps, args, db_path, ops) -> list:
+    """Servidor waitress local; 1 thread cliente por ESP, relogio real."""
+    from waitress import create_server
+
+    server = create_server(app, host="127.0.0.1", port=0, threads=args.threads)
+    porta = server.effective_port
+    th_srv = threading.Thread(target=server.run, name="bench-waitress", daemon=True)
+    th_srv.start()
+
+    latencias = []
+    lat_lock = threading.Lock()
+    erros = []
+    barreira = threading.Barrier(len(esps))
+
+    def _esp_loop(esp):
+        conn_http = http.client.HTTPConnection("127.0.0.1", porta, timeout=30)
+        barreira.wait()
+        minhas = []
+        for tick in range(args.ticks):
+            if args.troca_bobina and tick > 0 and tick % args.troca_bobina == 0:
+                _armar_troca_bobina(db_path, ops[esp.machine_id], esp.machine_id, esp.contador, datetime.now().isoformat())
+            corpo = json.dumps(esp.proxima_leitura(int(time.time() * 1000)))
+            ini = time.perf_counter()
+            conn_http.request("POST", "/machine/update", body=corpo,
+                         headers={"Content-Type": "application/json", "X-API-Key": API_KEY})
+            resp = conn_http.getresponse()
+            resp.read()
+            minhas.append((time.perf_counter() - ini) * 1000.0)
+            if resp.status != 200:
+                erros.append(resp.status)
+                break
+        conn_http.close()
+        with lat_lock:
+            latencias.extend(minhas)
+
+    threads = [threading.Thread(target=_esp_loop, args=(e,), name=f"bench-esp-{e.idx}") for e in esps]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # o servidor morre com o processo (thread daemon)
+    if erros:
+        raise SystemExit(f"/machine/update falhou: {erros[:5]}")
+    return latencias
+
+
+# ============================================================
+# BASELINE
+# ============================================================
+# Menor e melhor em todas; rps e o unico "maior e melhor"
+_METRICAS_MENOR_MELHOR = ["p50_ms", "p95_ms", "p99_ms", "sql_por_req", "commits_por_req"]
+
+
+def _comparar(resultado: dict, baseline: dict, tolerancia: float) -> list:
+    regressoes = []
+    for k in _METRICAS_MENOR_MELHOR:
+        novo, velho = resultado.get(k), baseline.get(k)
+        if not isinstance(novo, (int, float)) or not isinstance(velho, (int, float)) or velho <= 0:
+            continue
+        delta = (novo - velho) / velho
+        print(f"  {k:<16} {velho:>10.3f} -> {novo:>10.3f}  ({delta:+.1%})")
+        if delta > tolerancia:
+            regressoes.append(k)
+
+    novo, velho = resultado.get("req_por_s"), baseline.get("req_por_s")
+    if isinstance(novo, (int, float)) and isinstance(velho, (int, float)) and velho > 0:
+        delta = (novo - velho) / velho
+        print(f"  {'req_por_s':<16} {velho:>10.1f} -> {novo:>10.1f}  ({delta:+.1%})")
+        if -delta > tolerancia:
+            regressoes.append("req_por_s")
+    return regressoes
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark do ingest /machine/update com frota de ESP simulada")
+    ap.add_argument("--modo", choices=["client", "waitress"], default="client")
+    ap.add_argument("--devices", type=int, default=20)
+    ap.add_argument("--ticks", type=int, default=150, help="leituras por device")
+    ap.add_argument("--intervalo", type=int, default=5, help="segundos simulados entre leituras (modo client)")
+    ap.add_argument("--inicio", default="13:50", help="HH:MM do relogio simulado (turno 06:00-14:00 atravessa o fim)")
+    ap.add_argument("--troca-bobina", type=int, default=40, help="a cada N ticks arma troca de bobina (0 desliga)")
+    ap.add_argument("--threads", type=int, default=8, help="threads do waitress")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--salvar-baseline", action="store_true")
+    ap.add_argument("--tolerancia", type=float, default=0.25, help="piora maxima aceita (0.25 = 25%%)")
+    ap.add_argument("--manter-db", action="store_true", help="nao apaga o banco temporario (inspecao)")
+    args = ap.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix="indflow-bench-")
+    db_path = os.path.join(tmpdir, "indflow.db")
+    os.environ["INDFLOW_DB_PATH"] = db_path
+    if not args.manter_db:
+        # registrado antes do import do server: roda depois dos flush de atexit (journal, last_seen)
+        atexit.register(shutil.rmtree, tmpdir, True)
+
+    # precisa estar ativo antes do import: os modulos chamam sqlite3.connect em tempo de execucao
+    sqlite3.connect = _connect_contado
+    sys.path.insert(0, BASE_DIR)
+
+    import logging
+    logging.getLogger("indflow").setLevel(logging.WARNING)
+
+    from server import app
+    from modules import event_journal
+
+    rnd = random.Random(args.seed)
+    esps = [EspSimulado(i, rnd) for i in range(args.devices)]
+    ops = _preparar_banco(db_path, esps, "300,300,300,300,300,300")
+
+    client = app.test_client()
+    for esp in esps:
+        client.post("/machine/config", json={
+            "machine_id": esp.machine_id, "inicio": "06:00", "fim": "14:00", "meta_turno": 4000, "rampa": 0,
+        }, headers={"X-API-Key": API_KEY})
+
+    CONTADOR.zerar()
+    ini = time.perf_counter()
+    if args.modo == "waitress":
+        latencias = _rodar_waitress(app, esps, args, db_path, ops)
+    else:
+        latencias = _rodar_test_client(app, esps, args, db_path, ops)
+    duracao = time.perf_counter() - ini
+    event_journal.flush_journal(30)
+
+    n = len(latencias)
+    resultado = {
+        "modo": args.modo,
+        "devices": args.devices,
+        "ticks": args.ticks,
+        "requests": n,
+        "p50_ms": round(_percentil(latencias, 50), 3),
+        "p95_ms": round(_percentil(latencias, 95), 3),
+        "p99_ms": round(_percentil(latencias, 99), 3),
+        "req_por_s": round(n / duracao, 1) if duracao > 0 else 0.0,
+        "sql_por_req": round(CONTADOR.req_stmts / n, 2) if n else 0.0,
+        "commits_por_req": round(CONTADOR.req_commits / n, 3) if n else 0.0,
+        "sql_fundo_por_req": round(CONTADOR.bg_stmts / n, 2) if n else 0.0,
+        "commits_fundo_total": CONTADOR.bg_commits,
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "gerado_em": datetime.now().isoformat(timespec="seconds"),
+    }
+
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        try:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baselines = json.load(f) or {}
+        except Exception:
+            baselines = {}
+
+    chave = f"{args.modo}:{args.devices}x{args.ticks}"
+    codigo = 0
+    if chave in baselines and not args.salvar_baseline:
+        print(f"\nComparando com baseline [{chave}] ({baselines[chave].get('gerado_em')}):")
+        regressoes = _comparar(resultado, baselines[chave], args.tolerancia)
+        if regressoes:
+            print(f"\nREGRESSAO (> {args.tolerancia:.0%}): {', '.join(regressoes)}")
+            codigo = 1
+        else:
+            print("\nOK: dentro da tolerancia.")
+    elif not args.salvar_baseline:
+        print(f"\nSem baseline para [{chave}]. Rode com --salvar-baseline para gravar.")
+
+    if args.salvar_baseline:
+        baselines[chave] = resultado
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2, ensure_ascii=False, sort_keys=True)
+            f.write("\n")
+        print(f"\nBaseline [{chave}] salvo em {args.baseline}")
+
+    if args.manter_db:
+        print(f"Banco mantido em {db_path}")
+
+    return codigo
+
+
+if __name__ == "__main__":
+    sys.exit(main())
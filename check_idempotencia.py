@@ -0,0 +1,117 @@
+# PATH: indflow/check_idempotencia.py
+# LAST_RECODE: 2026-10-18 02:10 America/Bahia
+# MOTIVO: Confere a idempotencia do producao_evento no banco (sem a janela em memoria): leitura do ESP
+#         so com ts_ms (sem seq) grava seq 0 e o UNIQUE ux_producao_evento_dev_ts_seq descarta o retry
+#         depois de reinicio/eviccao da janela; e documenta o limite: sem ts_ms do ESP o evento usa o
+#         relogio do servidor e seq NULL (retry nao e identificavel, sem dedupe no banco).
+#
+# Uso:
+#   python check_idempotencia.py
+#
+# Sempre roda num banco temporario (nunca no indflow.db). Sai com codigo 1 se alguma conferencia falhar.
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+API_KEY = "idem-key"
+CLIENTE_ID = "idem-cliente"
+MAC = "AA:BB:CC:00:00:01"
+MAQUINA = "idem01"
+
+
+def main() -> int:
+    tmp = tempfile.mkdtemp(prefix="indflow_idem_")
+    os.environ["INDFLOW_DB_PATH"] = os.path.join(tmp, "indflow.db")
+    os.environ["INDFLOW_EVENT_JOURNAL"] = "0"
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+
+    try:
+        from server import app
+        from modules.db_indflow import get_db
+        from modules.machine import device_helpers
+        from modules.machine_routes import _registrar_evento_producao
+
+        falhas = []
+
+        def conferir(nome: str, ok: bool) -> None:
+            print(f"[{'ok' if ok else 'FALHA'}] {nome}")
+            if not ok:
+                falhas.append(nome)
+
+        conn = get_db()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO clientes (id, nome, api_key_hash, status, created_at) "
+                "VALUES (?, 'Idem', ?, 'active', datetime('now'))",
+                (CLIENTE_ID, hashlib.sha256(API_KEY.encode()).hexdigest()),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        client = app.test_client()
+        headers = {"X-API-Key": API_KEY}
+        t0 = int(time.time() * 1000) - 120_000
+
+        def leitura(ts_ms, abs_pcs) -> dict:
+            r = {"mac": MAC, "machine_id": MAQUINA, "producao_turno": abs_pcs, "status": "AUTO", "run": 1}
+            if ts_ms is not None:
+                r["ts_ms"] = ts_ms
+            return r
+
+        def eventos() -> list:
+            c = get_db()
+            try:
+                return [
+                    tuple(x) for x in c.execute(
+                        "SELECT ts_ms, delta, seq FROM producao_evento WHERE device_id IS NOT NULL ORDER BY ts_ms"
+                    ).fetchall()
+                ]
+            finally:
+                c.close()
+
+        def esquecer_janela() -> None:
+            # reinicio do processo / eviccao: a janela em memoria nao ve mais as chaves
+            with device_helpers._DEDUPE_LOCK:
+                device_helpers._DEDUPE_JANELAS.clear()
+
+        for ts, abs_pcs in ((t0, 0), (t0 + 60_000, 10)):
+            r = client.post("/machine/update", json=leitura(ts, abs_pcs), headers=headers)
+            if r.status_code != 200:
+                raise SystemExit(f"/machine/update {r.status_code}: {r.get_data(as_text=True)[:200]}")
+
+        conferir("leitura so com ts_ms grava seq 0", [e[2] for e in eventos()] == [0])
+
+        # retry do mesmo pacote depois de reinicio/eviccao: a janela em memoria e o machine_data
+        # nao lembram a leitura; o escritor recebe a mesma chave (device_id, ts_ms, seq 0)
+        esquecer_janela()
+        ts_retry = t0 + 60_000
+        for _ in range(2):
+            _registrar_evento_producao(
+                CLIENTE_ID, MAQUINA, ts_retry, 10, 10, "2026-10-17 00:00:00", device_id=device_helpers.norm_device_id(MAC), seq=0,
+            )
+        conferir("retry so com ts_ms descartado pelo banco", [e[2] for e in eventos()] == [0])
+
+        # limite documentado: sem ts_ms do ESP o ts e do servidor e seq fica NULL (sem chave de retry)
+        client.post("/machine/update", json=leitura(None, 13), headers=headers)
+        sem_ts = [e for e in eventos() if e[2] is None]
+        conferir("sem ts_ms do ESP: evento com seq NULL", len(sem_ts) == 1)
+
+        if falhas:
+            print(f"\n{len(falhas)} conferencia(s) falharam.")
+            return 1
+        print("\nOK: retry sem seq descartado pelo banco.")
+        return 0
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+# PATH: indflow/check_machine_pk.py
+# LAST_RECODE: 2026-10-18 01:50 America/Bahia
+# MOTIVO: Confere que 1 maquina fisica tem 1 machine_pk mesmo escrita pelos 2 caminhos: ingest (com
+#         cliente_id) e escritores legados da diaria (cliente_id NULL: trigger da migracao 10/12,
+#         _recalc_diaria_from_horaria_safe sem cliente, machine_pk(None, ...)); e que a migracao 12
+#         une a chave ('', code) ja dividida a chave do dono.
+#
+# Uso:
+#   python check_machine_pk.py
+#
+# Sempre roda num banco temporario (nunca no indflow.db). Sai com codigo 1 se alguma conferencia falhar.
+
+import os
+import shutil
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DIA = "2026-10-17"
+
+
+def _pks(conn, tabela: str, code: str) -> set:
+    return {
+        r[0] for r in conn.execute(
+            f"SELECT DISTINCT t.machine_pk FROM {tabela} t JOIN machines mm ON mm.id = t.machine_pk WHERE mm.code = ?",
+            (code,),
+        ).fetchall()
+    }
+
+
+def main() -> int:
+    tmp = tempfile.mkdtemp(prefix="indflow_pk_")
+    os.environ["INDFLOW_DB_PATH"] = os.path.join(tmp, "indflow.db")
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+
+    try:
+        from modules.db_indflow import _m012_machine_pk_sem_cliente, init_db, get_db
+        from modules.machine_calc import _recalc_diaria_from_horaria_safe
+        from modules.machine_registry import esquecer, machine_pk
+
+        init_db()
+        falhas = []
+
+        def conferir(nome: str, ok: bool) -> None:
+            print(f"[{'ok' if ok else 'FALHA'}] {nome}")
+            if not ok:
+                falhas.append(nome)
+
+        conn = get_db()
+        try:
+            conn.execute(
+                "INSERT INTO clientes (id, nome, api_key_hash, status, created_at) "
+                "VALUES ('c1', 'C1', 'x', 'active', datetime('now'))"
+            )
+            conn.commit()
+
+            # caminho 1: ingest (cliente resolvido, machine_pk gravada)
+            pk = machine_pk("c1", "m1", conn=conn)
+            conn.execute(
+                "INSERT INTO producao_horaria (machine_id, cliente_id, data_ref, hora_idx, baseline_esp, esp_last, "
+                "produzido, meta, percentual, updated_at, machine_pk) VALUES ('m1', 'c1', ?, 8, 0, 10, 10, 0, 0, "
+                "datetime('now'), ?)",
+                (DIA, pk),
+            )
+            conn.execute(
+                "INSERT INTO producao_diaria (machine_id, cliente_id, data, produzido, meta, percentual, machine_pk) "
+                "VALUES ('m1', 'c1', ?, 10, 0, 0, ?)",
+                (DIA, pk),
+            )
+            conn.commit()
+
+            # caminho 2: escritores legados sem cliente_id
+            conn.execute(
+                "INSERT INTO producao_diaria (machine_id, data, produzido, meta, percentual) VALUES ('m1', '2026-10-16', 5, 0, 0)"
+            )
+            conn.commit()
+            _recalc_diaria_from_horaria_safe("m1", DIA, 0)
+            esquecer()
+            pk_sem_cliente = machine_pk(None, "m1", conn=conn)
+
+            conferir("machine_pk(None, 'm1') == machine_pk('c1', 'm1')", pk_sem_cliente == pk)
+            conferir(
+                "machines: 1 chave para 'm1'",
+                conn.execute("SELECT COUNT(*) FROM machines WHERE code = 'm1'").fetchone()[0] == 1,
+            )
+            conferir("producao_diaria: 1 machine_pk para 'm1'", _pks(conn, "producao_diaria", "m1") == {pk})
+            linhas = conn.execute(
+                "SELECT COUNT(*), SUM(produzido) FROM producao_diaria WHERE machine_pk = ? AND data = ?", (pk, DIA)
+            ).fetchone()
+            conferir("producao_diaria: recalculo sem cliente nao divide o dia", tuple(linhas) == (1, 10))
+
+            # legado ja dividido antes da migracao 12: ('', 'm2') ao lado de ('c1', 'm2')
+            conn.execute("INSERT INTO machines (cliente_id, code, created_at) VALUES ('c1', 'm2', datetime('now'))")
+            conn.execute("INSERT INTO machines (cliente_id, code, created_at) VALUES ('', 'm2', datetime('now'))")
+            orfa = conn.execute("SELECT id FROM machines WHERE cliente_id = '' AND code = 'm2'").fetchone()[0]
+            conn.execute(
+                "INSERT INTO producao_diaria (machine_id, data, produzido, meta, percentual, machine_pk) "
+                "VALUES ('m2', ?, 3, 0, 0, ?)",
+                (DIA, orfa),
+            )
+            _m012_machine_pk_sem_cliente(conn)
+            conn.commit()
+            dono = conn.execute("SELECT id FROM machines WHERE cliente_id = 'c1' AND code = 'm2'").fetchone()[0]
+            conferir("migracao 12: chave ('', 'm2') unida a do dono", _pks(conn, "producao_diaria", "m2") == {dono})
+        finally:
+            conn.close()
+
+        if falhas:
+            print(f"\n{len(falhas)} conferencia(s) falharam.")
+            return 1
+        print("\nOK: 1 machine_pk por maquina.")
+        return 0
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+# PATH: indflow/check_query_plan.py
+# LAST_RECODE: 2026-10-18 00:45 America/Bahia
+# MOTIVO: Confere (EXPLAIN QUERY PLAN) que as consultas quentes usam indice e nao varrem a tabela:
+#         producao_diaria por (machine_id, data) e por machine_pk, snapshot do ESP, contagem por OP,
+#         OPs por periodo, pulsos do dia, eventos por machine_pk (inclusive o evento que cobre uma
+#         leitura atrasada do lote) e machine_id efetivo do historico.
+#
+# Uso:
+#   python check_query_plan.py          # lista o plano de cada consulta
+#
+# Sempre roda num banco temporario (nunca no indflow.db) com o schema completo (migracoes + init_op_db).
+# Sai com codigo 1 se alguma consulta cair em SCAN da tabela sem indice.
+
+import os
+import shutil
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# (nome, tabela, sql, params) — mesmas consultas (mesma forma) do codigo da aplicacao
+def _consultas() -> list:
+    from modules.producao.historico_routes import _sql_machine_pks
+
+    where_pk, params_pk = _sql_machine_pks("m1")
+    return [
+        (
+            "producao_diaria: update por maquina/dia (ingest)",
+            "producao_diaria",
+            "UPDATE producao_diaria SET produzido = ? WHERE data = ? AND machine_id = ?",
+            (1, "2026-10-17", "m1"),
+        ),
+        (
+            "producao_diaria: faixa de dias (historico)",
+            "producao_diaria",
+            "SELECT data, produzido, meta FROM producao_diaria WHERE machine_id = ? AND data >= ? AND data <= ?",
+            ("m1", "2026-10-01", "2026-10-17"),
+        ),
+        (
+            "producao_diaria: overview do cliente",
+            "producao_diaria",
+            "SELECT machine_id, produzido, meta FROM producao_diaria WHERE cliente_id = ? AND data = ?",
+            ("c1", "2026-10-17"),
+        ),
+        (
+            "_get_current_esp_snapshot: baseline_diario",
+            "baseline_diario",
+            "SELECT esp_last, updated_at FROM baseline_diario WHERE machine_id = ? "
+            "ORDER BY dia_ref DESC, updated_at DESC, id DESC LIMIT 1",
+            ("m1",),
+        ),
+        (
+            "_get_current_esp_snapshot: producao_horaria",
+            "producao_horaria",
+            "SELECT esp_last, updated_at FROM producao_horaria WHERE machine_id = ? "
+            "ORDER BY data_ref DESC, hora_idx DESC, updated_at DESC, id DESC LIMIT 1",
+            ("m1",),
+        ),
+        (
+            "_registrar_eventos_atrasados: evento que cobre a leitura",
+            "producao_evento",
+            "SELECT id, esp_absoluto, delta FROM producao_evento WHERE machine_pk = ? AND ts_ms > ? "
+            "ORDER BY ts_ms ASC LIMIT 1",
+            (1, 0),
+        ),
+        (
+            "_enrich_ops_with_esp_counts: producao_evento",
+            "producao_evento",
+            "SELECT COALESCE(SUM(delta), 0), MIN(esp_absoluto), MAX(esp_absoluto) FROM producao_evento "
+            "WHERE cliente_id = ? AND machine_id = ? AND ts_ms >= ? AND ts_ms <= ?",
+            ("c1", "m1", 0, 1),
+        ),
+        (
+            "_fetch_ops_for_range: ordens_producao",
+            "ordens_producao",
+            "SELECT id, started_at, ended_at FROM ordens_producao "
+            "WHERE machine_id = ? AND started_at < ? AND (ended_at IS NULL OR ended_at >= ?) "
+            "ORDER BY started_at DESC",
+            ("m1", "2026-10-18", "2026-10-01"),
+        ),
+        (
+            "detalhe-dia backfill: pulsos do dia",
+            "producao_evento",
+            "SELECT ts_ms FROM producao_evento WHERE machine_id = ? AND ts_ms >= ? AND ts_ms < ? ORDER BY ts_ms ASC",
+            ("m1", 0, 86400000),
+        ),
+        (
+            "_sync_producao_diaria_absoluta: update por machine_pk",
+            "producao_diaria",
+            "UPDATE producao_diaria SET produzido = ? WHERE machine_pk = ? AND data = ?",
+            (1, 1, "2026-10-17"),
+        ),
+        (
+            "_recalc_diaria_from_horaria_safe: soma da horaria por machine_pk",
+            "producao_horaria",
+            "SELECT COALESCE(SUM(produzido),0) FROM producao_horaria WHERE machine_pk=? AND data_ref=?",
+            (1, "2026-10-17"),
+        ),
+        (
+            "_sum_eventos_por_dia: producao_evento por machine_pk",
+            "producao_evento",
+            "SELECT machine_id, cliente_id, date(ts_ms/1000, 'unixepoch', '-3 hours') AS dia_ref, SUM(COALESCE(delta, 0)) "
+            "FROM producao_evento WHERE machine_pk = ? AND ts_ms >= ? AND ts_ms <= ? GROUP BY machine_id, cliente_id, dia_ref",
+            (1, 0, 1),
+        ),
+        (
+            "_resolve_effective_machine_id: producao_diaria",
+            "producao_diaria",
+            f"SELECT machine_id FROM producao_diaria WHERE {where_pk} AND data = ? "
+            f"AND instr(machine_id, '::') > 0 ORDER BY produzido DESC LIMIT 1",
+            (*params_pk, "2026-10-17"),
+        ),
+    ]
+
+
+def _plano(conn, sql: str, params: tuple) -> list:
+    return [str(r[3]) for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+
+
+def _varre(linhas: list, tabela: str) -> bool:
+    """SCAN da tabela sem indice (SEARCH ... USING INDEX / SCAN ... USING INDEX sao ok)."""
+    for d in linhas:
+        partes = d.split()
+        if len(partes) >= 2 and partes[0] == "SCAN" and partes[1] == tabela and "USING" not in d:
+            return True
+    return False
+
+
+def main() -> int:
+    tmp = tempfile.mkdtemp(prefix="indflow_qp_")
+    os.environ["INDFLOW_DB_PATH"] = os.path.join(tmp, "indflow.db")
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+
+    try:
+        from modules.db_indflow import init_db, get_db
+        from modules.producao.routes import init_op_db
+
+        init_db()
+        init_op_db()
+
+        conn = get_db()
+        falhas = 0
+        try:
+            for nome, tabela, sql, params in _consultas():
+                linhas = _plano(conn, sql, params)
+                ruim = _varre(linhas, tabela)
+                falhas += int(ruim)
+                print(f"[{'FALHA' if ruim else 'ok'}] {nome}")
+                for d in linhas:
+                    print(f"        {d}")
+        finally:
+            conn.close()
+
+        if falhas:
+            print(f"\n{falhas} consulta(s) varrendo tabela sem indice.")
+            return 1
+        print("\nOK: todas as consultas usam indice.")
+        return 0
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
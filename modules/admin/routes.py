@@ -10,6 +10,7 @@ import os
 from functools import wraps
 
 from modules.db_indflow import get_db
+from modules.clientes.services import invalidar_cache_api_key
 
 admin_bp = Blueprint("admin", __name__, template_folder="templates")
 
@@ -789,6 +790,7 @@ def bootstrap():
             (usuario_id, email.strip().lower(), senha_hash, cliente_id, now),
         )
         conn.commit()
+        invalidar_cache_api_key(cliente_id)
     except Exception as e:
         conn.rollback()
         try:
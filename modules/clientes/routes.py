@@ -1,6 +1,6 @@
 # PATH: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\clientes\routes.py
-# LAST_RECODE: 2026-02-20 21:55 America/Bahia
-# MOTIVO: Migracao automatica da tabela clientes para suportar campos completos e CRUD (visualizar/editar/excluir fisico) usando templates.
+# LAST_RECODE: 2026-10-18 01:40 America/Bahia
+# MOTIVO: Shard: _ensure_clientes_table nao cria copia vazia de clientes no shard do cliente.
 
 from __future__ import annotations
 
@@ -10,8 +10,9 @@ import secrets
 import uuid
 from datetime import datetime, timezone
 
-from modules.db_indflow import get_db
+from modules.db_indflow import get_db, em_shard
 from modules.admin.routes import login_required
+from modules.clientes.services import invalidar_cache_api_key
 
 clientes_bp = Blueprint("clientes", __name__, template_folder="templates")
 
@@ -81,21 +82,23 @@ def _table_has_column(conn, table: str, col: str) -> bool:
 
 
 def _ensure_clientes_table(conn):
-    # Tabela base (v1)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS clientes (
-            id TEXT PRIMARY KEY,
-            nome TEXT NOT NULL,
-            api_key_hash TEXT NOT NULL,
-            status TEXT NOT NULL DEFAULT 'active',
-            created_at TEXT NOT NULL
-        )
-    """)
-    conn.execute("""
-        CREATE INDEX IF NOT EXISTS ix_clientes_status
-        ON clientes(status)
-    """)
-    conn.commit()
+    # Tabela base (v1). No shard do cliente ela fica no central anexado: CREATE sem prefixo
+    # criaria uma copia vazia no shard (o ALTER abaixo ja acha a do central).
+    if not em_shard():
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS clientes (
+                id TEXT PRIMARY KEY,
+                nome TEXT NOT NULL,
+                api_key_hash TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'active',
+                created_at TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS ix_clientes_status
+            ON clientes(status)
+        """)
+        conn.commit()
 
     # Migracao v2: colunas adicionais para cadastro completo
     # Obs: SQLite suporta ALTER TABLE ADD COLUMN. Mantemos idempotente.
@@ -286,6 +289,8 @@ def update_cliente(cid: str):
     finally:
         conn.close()
 
+    invalidar_cache_api_key(cid)
+
     return redirect(url_for("clientes.home"))
 
 
@@ -347,6 +352,8 @@ def create_cliente():
     finally:
         conn.close()
 
+    invalidar_cache_api_key(cliente_id)
+
     # Exibe a API Key uma vez (nao persistimos em texto)
     return render_template(
         "clientes_form.html",
@@ -386,6 +393,7 @@ def deactivate_cliente():
             conn.commit()
         finally:
             conn.close()
+        invalidar_cache_api_key(cid)
 
     return redirect(url_for("clientes.home"))
 
@@ -406,6 +414,7 @@ def activate_cliente():
             conn.commit()
         finally:
             conn.close()
+        invalidar_cache_api_key(cid)
 
     return redirect(url_for("clientes.home"))
 
@@ -425,6 +434,8 @@ def delete_cliente(cid: str):
     finally:
         conn.close()
 
+    invalidar_cache_api_key(cid)
+
     return redirect(url_for("clientes.home"))
 
 
@@ -0,0 +1,88 @@
+# PATH: modules/clientes/services.py
+# LAST_RECODE: 2026-10-18 00:55 America/Bahia
+# MOTIVO: Cache api_key_hash -> cliente: geracao de invalidacao; leitura que estava em voo quando a
+#         chave foi revogada / cliente suspenso nao devolve a linha antiga ao cache.
+
+import os
+import threading
+import time
+
+from modules.db_indflow import get_db
+
+
+# ============================================================
+# CACHE API KEY -> CLIENTE
+# ============================================================
+# Guarda a linha do cliente (id, nome, status) mesmo se inativo: quem decide se o status
+# vale e o chamador. Hash desconhecido tambem fica em cache (None) para nao martelar o banco
+# com chave invalida; create/activate limpam esses negativos.
+# _API_KEY_CACHE_GERACAO sobe a cada invalidacao: leitura do banco que comecou antes dela nao
+# preenche o cache (senao a chave revogada voltaria a valer ate o TTL).
+
+_API_KEY_CACHE: dict = {}
+_API_KEY_CACHE_LOCK = threading.Lock()
+_API_KEY_CACHE_MAX = 2000
+_API_KEY_CACHE_GERACAO = 0
+
+
+def _cache_ttl_sec() -> float:
+    try:
+        v = float((os.getenv("INDFLOW_API_KEY_CACHE_TTL") or "").strip() or 60)
+        return v if v >= 0 else 60.0
+    except Exception:
+        return 60.0
+
+
+def get_cliente_by_api_key_hash(api_key_hash: str) -> dict | None:
+    """Retorna {id, nome, status} do cliente dono do hash (com cache TTL) ou None."""
+    if not api_key_hash:
+        return None
+
+    agora = time.monotonic()
+    with _API_KEY_CACHE_LOCK:
+        hit = _API_KEY_CACHE.get(api_key_hash)
+        geracao = _API_KEY_CACHE_GERACAO
+    if hit is not None and hit[0] > agora:
+        return dict(hit[1]) if hit[1] else None
+
+    conn = get_db()
+    try:
+        row = conn.execute(
+            "SELECT id, nome, status FROM clientes WHERE api_key_hash = ?",
+            (api_key_hash,),
+        ).fetchone()
+    finally:
+        conn.close()
+
+    cliente = {"id": row["id"], "nome": row["nome"], "status": row["status"]} if row else None
+
+    ttl = _cache_ttl_sec()
+    if ttl > 0:
+        with _API_KEY_CACHE_LOCK:
+            if geracao != _API_KEY_CACHE_GERACAO:
+                # invalidado durante a leitura: nao cachear o que pode ja estar velho
+                return dict(cliente) if cliente else None
+            if len(_API_KEY_CACHE) >= _API_KEY_CACHE_MAX:
+                _API_KEY_CACHE.clear()
+            _API_KEY_CACHE[api_key_hash] = (agora + ttl, cliente)
+
+    return dict(cliente) if cliente else None
+
+
+def invalidar_cache_api_key(cliente_id: str | None = None) -> None:
+    """
+    Invalida o cache:
+      - cliente_id informado: remove as entradas desse cliente + os negativos
+      - sem cliente_id: limpa tudo
+    """
+    global _API_KEY_CACHE_GERACAO
+    cid = (cliente_id or "").strip()
+    with _API_KEY_CACHE_LOCK:
+        _API_KEY_CACHE_GERACAO += 1
+        if not cid:
+            _API_KEY_CACHE.clear()
+            return
+        for h in list(_API_KEY_CACHE.keys()):
+            cliente = _API_KEY_CACHE[h][1]
+            if not cliente or str(cliente.get("id") or "") == cid:
+                _API_KEY_CACHE.pop(h, None)
@@ -3,13 +3,22 @@
 # Motivo: Criar estrutura SQLite para bobinas (eventos e pendencia) no init_db, suportando N bobinas por OP e evitando travamento na troca 2->3.
 
 # PATH: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\db_indflow.py
-# LAST_RECODE: 2026-02-24 21:35 America/Bahia
-# MOTIVO: Garantir persistência da configuração V2 adicionando coluna machine_config.config_json no SQLite (migração defensiva), evitando perda após deploy.
+# LAST_RECODE: 2026-10-18 02:15 America/Bahia
+# MOTIVO: run_migrations: cada migracao + registro em schema_version numa transacao explicita (BEGIN
+#         IMMEDIATE ... COMMIT, rollback no erro); antes o DDL gravava em autocommit no modo legado.
 
+import logging
 import os
+import re
 import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
 
+log = logging.getLogger("indflow")
+
 
 def _is_railway() -> bool:
     keys = ["RAILWAY_ENVIRONMENT", "RAILWAY_PROJECT_ID", "RAILWAY_SERVICE_ID", "RAILWAY_STATIC_URL"]
@@ -33,14 +42,770 @@ def _ensure_db_dir(db_path: str) -> None:
         db_file.parent.mkdir(parents=True, exist_ok=True)
 
 
-def get_db():
-    db_path = _default_db_path()
+def get_db_path() -> str:
+    """Caminho do banco usado por todo o app (mesma regra para rotas, admin e scripts)."""
+    return _default_db_path()
+
+
+# ============================================================
+# CONEXOES (1 por thread, reaproveitada, com PRAGMAs de desempenho)
+# ============================================================
+# Antes cada get_db() abria um sqlite3.connect novo (e alguns modulos abriam o proprio, cada um
+# com sua regra de caminho). Agora cada thread (worker do waitress, journal, agendador) mantem
+# UMA conexao aberta, configurada uma vez:
+#   journal_mode=WAL (leitores nao bloqueiam o escritor do ESP), synchronous=NORMAL,
+#   cache_size, mmap_size, temp_store=MEMORY e busy_timeout.
+# get_db() devolve um "handle" leve sobre essa conexao:
+#   - commit()/rollback() valem para a conexao da thread
+#   - close() so libera o handle; ao liberar o ultimo handle, transacao ainda aberta e desfeita
+#     (mesmo efeito do close() de uma conexao propria)
+#   - row_factory e por handle (padrao sqlite3.Row); mudar num handle nao afeta os outros
+# ATENCAO (atomicidade): todos os get_db() da thread dividem a MESMA transacao. Helper aninhado
+# (get_db() dentro de um bloco que ja escreveu sem commit) que chama commit() grava tambem a escrita
+# pela metade do chamador; rollback() dele desfaz a do chamador. Antes cada get_db() era uma conexao
+# propria e isso nao acontecia. Fluxo que precisa ser atomico usa unit_of_work() (commit unico;
+# rollback de helper desfaz tudo). pool_stats()["commits_aninhados"] conta commit/rollback feitos
+# com mais de um handle aberto na conexao.
+# Liberacao explicita: close() (ou o fim do request, liberar_conexao_thread) libera o handle; nao
+# ha __del__. O contador de handles e por conexao e o handle guarda o seu: close() em outra
+# thread so marca a conexao, e a thread dona desfaz a sobra no proximo get_db().
+# Env: INDFLOW_SQLITE_JOURNAL_MODE (WAL), INDFLOW_SQLITE_SYNCHRONOUS (NORMAL),
+#      INDFLOW_SQLITE_CACHE_KB (8192), INDFLOW_SQLITE_MMAP_MB (256), INDFLOW_SQLITE_BUSY_MS (30000).
+
+_CONN_LOCAL = threading.local()
+_POOL_LOCK = threading.Lock()
+_POOL_STATS = {
+    "opened": 0,
+    "handles": 0,
+    "released_rollbacks": 0,
+    "ro_opened": 0,
+    "ro_handles": 0,
+    "writer_waits": 0,
+    "commits_aninhados": 0,
+}
+
+
+class _EstadoConn:
+    """Handles abertos de 1 conexao de escrita da thread dona."""
+
+    __slots__ = ("handles", "dono", "rollback_pendente")
+
+    def __init__(self):
+        self.handles = 0
+        self.dono = threading.get_ident()
+        self.rollback_pendente = False
+
+
+def _env_str(name: str, default: str) -> str:
+    return (os.getenv(name) or "").strip() or default
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = int((os.getenv(name) or "").strip() or default)
+        return v if v >= 0 else default
+    except Exception:
+        return default
+
+
+def _aplicar_pragmas(conn: sqlite3.Connection) -> None:
+    busy_ms = _env_int("INDFLOW_SQLITE_BUSY_MS", 30000)
+    pragmas = [
+        f"PRAGMA busy_timeout={busy_ms}",
+        f"PRAGMA journal_mode={_env_str('INDFLOW_SQLITE_JOURNAL_MODE', 'WAL')}",
+        f"PRAGMA synchronous={_env_str('INDFLOW_SQLITE_SYNCHRONOUS', 'NORMAL')}",
+        f"PRAGMA cache_size=-{_env_int('INDFLOW_SQLITE_CACHE_KB', 8192)}",
+        f"PRAGMA mmap_size={_env_int('INDFLOW_SQLITE_MMAP_MB', 256) * 1024 * 1024}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+    for sql in pragmas:
+        try:
+            conn.execute(sql)
+        except Exception:
+            pass
+
+
+def _open_conn(db_path: str | None = None) -> sqlite3.Connection:
+    db_path = db_path or _default_db_path()
     _ensure_db_dir(db_path)
     conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    _aplicar_pragmas(conn)
+    with _POOL_LOCK:
+        _POOL_STATS["opened"] += 1
+    return conn
+
+
+def _conns_da_thread(nome: str) -> OrderedDict:
+    """Conexoes abertas da thread por caminho (central + shards usados por ela), mais recente no fim."""
+    conns = getattr(_CONN_LOCAL, nome, None)
+    if conns is None:
+        conns = OrderedDict()
+        setattr(_CONN_LOCAL, nome, conns)
+    return conns
+
+
+def _guardar_conn(conns: OrderedDict, db_path: str, conn: sqlite3.Connection) -> None:
+    """Guarda a conexao da thread; acima do limite fecha a menos usada (fora de transacao, sem handle)."""
+    conns[db_path] = conn
+    conns.move_to_end(db_path)
+    estados = _conns_da_thread("estados")
+    limite = max(1, _env_int("INDFLOW_SHARD_CONNS_POR_THREAD", 8)) if shard_ativo() else 1
+    for velho in list(conns.keys())[:-1]:
+        if len(conns) <= limite:
+            break
+        c = conns[velho]
+        estado = estados.get(velho)
+        if c.in_transaction or (estado is not None and estado.handles > 0):
+            continue
+        conns.pop(velho, None)
+        estados.pop(velho, None)
+        try:
+            c.close()
+        except Exception:
+            pass
+
+
+def _conn_da_thread() -> sqlite3.Connection:
+    """
+    Conexao reaproveitada da thread atual para o banco alvo (central ou shard do cliente atual).
+    Troca de caminho reaproveita a conexao ja aberta daquele banco (ou abre uma nova).
+    """
+    db_path = _db_alvo()
+    atual = getattr(_CONN_LOCAL, "conn", None)
+    if atual is not None and getattr(_CONN_LOCAL, "path", None) == db_path:
+        return atual
+    conns = _conns_da_thread("conns")
+    conn = conns.get(db_path)
+    novo_shard = False
+    if conn is None:
+        if db_path == _default_db_path():
+            conn = _open_conn(db_path)
+        else:
+            conn, novo_shard = _open_conn_shard(db_path, cliente_atual())
+    _guardar_conn(conns, db_path, conn)
+    estados = _conns_da_thread("estados")
+    if db_path not in estados:
+        estados[db_path] = _EstadoConn()
+    _CONN_LOCAL.conn = conn
+    _CONN_LOCAL.path = db_path
+    _CONN_LOCAL.estado = estados[db_path]
+    if novo_shard:
+        try:
+            _preparar_schema_shard(db_path)
+        finally:
+            conn.set_authorizer(None)
+    return conn
+
+
+def _liberar_handle(conn: sqlite3.Connection, estado: _EstadoConn) -> None:
+    with _POOL_LOCK:
+        estado.handles = max(0, estado.handles - 1)
+        zerou = estado.handles == 0
+    if not zerou:
+        return
+    if estado.dono != threading.get_ident():
+        # a conexao nao e desta thread: a dona desfaz a sobra no proximo get_db()
+        estado.rollback_pendente = True
+        return
+    _desfazer_sobra(conn)
+
+
+def _desfazer_sobra(conn: sqlite3.Connection) -> None:
+    """Ultimo handle liberado com transacao aberta (fora de unidade de trabalho): desfaz."""
+    if current_unit_of_work() is None and conn.in_transaction:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        with _POOL_LOCK:
+            _POOL_STATS["released_rollbacks"] += 1
+
+
+class _ConnHandle:
+    """Handle de get_db() sobre a conexao da thread (ver bloco acima)."""
+
+    def __init__(self, conn: sqlite3.Connection, somente_leitura: bool = False, estado: _EstadoConn | None = None):
+        self._conn = conn
+        self._aberto = True
+        self._somente_leitura = somente_leitura
+        self._estado = estado
+        self.row_factory = sqlite3.Row
+
+    def cursor(self, *args, **kwargs):
+        cur = self._conn.cursor(*args, **kwargs)
+        cur.row_factory = self.row_factory
+        if self._somente_leitura:
+            _cursores_leitura_da_thread().add(cur)
+        return cur
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def _contar_aninhado(self) -> None:
+        if self._estado is not None and self._estado.handles > 1 and self._conn.in_transaction:
+            with _POOL_LOCK:
+                _POOL_STATS["commits_aninhados"] += 1
+
+    def commit(self):
+        self._contar_aninhado()
+        return self._conn.commit()
+
+    def rollback(self):
+        self._contar_aninhado()
+        return self._conn.rollback()
+
+    def close(self):
+        if self._aberto:
+            self._aberto = False
+            if self._estado is not None:
+                _liberar_handle(self._conn, self._estado)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # mesma semantica do "with sqlite3.Connection": commit/rollback, sem fechar
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def _cursores_leitura_da_thread() -> weakref.WeakSet:
+    cursores = getattr(_CONN_LOCAL, "ro_cursores", None)
+    if cursores is None:
+        cursores = weakref.WeakSet()
+        _CONN_LOCAL.ro_cursores = cursores
+    return cursores
+
+
+def _fechar_cursores_leitura() -> None:
+    """Cursor ro lido pela metade segura o snapshot antigo: fechar para o proximo request ver dado novo."""
+    cursores = getattr(_CONN_LOCAL, "ro_cursores", None)
+    if not cursores:
+        return
+    for cur in list(cursores):
+        try:
+            cur.close()
+        except Exception:
+            pass
+    cursores.clear()
+
+
+def liberar_conexao_thread() -> None:
+    """
+    Fim de request: desfaz transacao esquecida aberta na conexao da thread (helper que escreveu
+    e saiu por excecao sem commit/close) para ela nao vazar para o proximo request.
+    """
+    _fechar_cursores_leitura()
+    if current_unit_of_work() is not None:
+        return
+    # handle esquecido sem close() nao passa para o proximo request
+    with _POOL_LOCK:
+        for estado in _conns_da_thread("estados").values():
+            estado.handles = 0
+            estado.rollback_pendente = False
+    for conn in list(_conns_da_thread("conns").values()):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+                with _POOL_LOCK:
+                    _POOL_STATS["released_rollbacks"] += 1
+        except Exception:
+            pass
+
+
+def pool_stats() -> dict:
+    with _POOL_LOCK:
+        out = dict(_POOL_STATS)
+    conn = getattr(_CONN_LOCAL, "conn", None)
+    out["thread_conn_open"] = conn is not None
+    out["thread_ro_conn_open"] = bool(getattr(_CONN_LOCAL, "ro", None))
+    out["readonly_enabled"] = _leitura_ro_ativa()
+    out["db_path"] = _default_db_path()
+    out["shard_mode"] = shard_ativo()
+    out["cliente_atual"] = cliente_atual()
+    out["db_alvo"] = _db_alvo()
+    if conn is not None:
+        try:
+            out["journal_mode"] = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        except Exception:
+            out["journal_mode"] = None
+    return out
+
+
+def get_db():
+    uow = current_unit_of_work()
+    if uow is not None:
+        return uow
+    conn = _conn_da_thread()
+    estado = _CONN_LOCAL.estado
+    if estado.rollback_pendente and estado.handles == 0:
+        estado.rollback_pendente = False
+        _desfazer_sobra(conn)
+    with _POOL_LOCK:
+        _POOL_STATS["handles"] += 1
+        estado.handles += 1
+    return _ConnHandle(conn, estado=estado)
+
+
+# ============================================================
+# LEITURA SOMENTE-LEITURA x ESCRITOR SERIALIZADO
+# ============================================================
+# Relatorios GET (historico, detalhe-dia, db-check, listas do status/overview) varrem
+# producao_evento/producao_diaria por varios dias. Na conexao de escrita da thread qualquer
+# helper esquecido podia deixar a leitura dentro de transacao e segurar o lock junto do ingest.
+#
+# get_db_leitura(): segunda conexao da thread, aberta com URI mode=ro + PRAGMA query_only.
+#   Em WAL o leitor le o ultimo snapshot commitado e nunca pega lock de escrita, entao uma
+#   varredura longa nao atrasa o /machine/update. Dentro de unidade de trabalho devolve a
+#   propria unidade (le o que ela acabou de gravar). Sem o arquivo do banco (ou com
+#   INDFLOW_DB_READONLY=0) cai no get_db() normal. No fim do request liberar_conexao_thread()
+#   fecha cursores ro que ficaram abertos (cursor vivo prende o leitor num snapshot antigo).
+#
+# escritor_serializado(): 1 escritor por banco. unit_of_work() e o journal de eventos pegam
+#   este lock antes do BEGIN; quem chega depois espera na fila do lock (em ordem) em vez de
+#   girar no busy_timeout do SQLite. Reentrante (journal sincrono dentro de unidade de trabalho).
+#   Com shard por cliente, shards diferentes escrevem em paralelo.
+
+_ESCRITOR_LOCKS: dict = {}
+
+
+def _leitura_ro_ativa() -> bool:
+    return _env_str("INDFLOW_DB_READONLY", "1").lower() not in ("0", "false", "no", "off")
+
+
+def _uri_leitura(db_path: str) -> str:
+    return Path(db_path).resolve().as_uri() + "?mode=ro"
+
+
+def _open_conn_leitura(db_path: str) -> sqlite3.Connection | None:
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(_uri_leitura(db_path), uri=True, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    pragmas = [
+        f"PRAGMA busy_timeout={_env_int('INDFLOW_SQLITE_BUSY_MS', 30000)}",
+        "PRAGMA query_only=ON",
+        f"PRAGMA cache_size=-{_env_int('INDFLOW_SQLITE_CACHE_KB', 8192)}",
+        f"PRAGMA mmap_size={_env_int('INDFLOW_SQLITE_MMAP_MB', 256) * 1024 * 1024}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+    for sql in pragmas:
+        try:
+            conn.execute(sql)
+        except Exception:
+            pass
+    central = _default_db_path()
+    if db_path != central:
+        # shard: cadastros globais (clientes/usuarios/devices) vem do central, tambem so leitura
+        try:
+            conn.execute("ATTACH DATABASE ? AS central", (_uri_leitura(central),))
+        except Exception:
+            conn.close()
+            return None
+    with _POOL_LOCK:
+        _POOL_STATS["ro_opened"] += 1
+    return conn
+
+
+def _conn_leitura_da_thread() -> sqlite3.Connection | None:
+    """Conexao somente-leitura reaproveitada da thread atual (None se nao deu para abrir)."""
+    db_path = _db_alvo()
+    conns = _conns_da_thread("ro")
+    conn = conns.get(db_path)
+    if conn is None:
+        try:
+            conn = _open_conn_leitura(db_path)
+        except Exception:
+            conn = None
+        if conn is None:
+            return None
+    _guardar_conn(conns, db_path, conn)
     return conn
 
 
+def get_db_leitura():
+    """Conexao para leitura de relatorio (ver bloco acima). Escrita nela falha (query_only)."""
+    uow = current_unit_of_work()
+    if uow is not None:
+        return uow
+    if not _leitura_ro_ativa():
+        return get_db()
+    conn = _conn_leitura_da_thread()
+    if conn is None:
+        return get_db()
+    with _POOL_LOCK:
+        _POOL_STATS["ro_handles"] += 1
+    return _ConnHandle(conn, somente_leitura=True)
+
+
+@contextmanager
+def escritor_serializado(db_path: str | None = None):
+    """Segura o lock do escritor unico do banco (padrao: banco alvo da thread; ver bloco acima)."""
+    chave = db_path or _db_alvo()
+    with _POOL_LOCK:
+        lock = _ESCRITOR_LOCKS.get(chave)
+        if lock is None:
+            lock = _ESCRITOR_LOCKS[chave] = threading.RLock()
+    if not lock.acquire(blocking=False):
+        with _POOL_LOCK:
+            _POOL_STATS["writer_waits"] += 1
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+# ============================================================
+# SHARD POR CLIENTE (opcional: INDFLOW_SHARD_MODE=cliente)
+# ============================================================
+# Com todos os clientes no mesmo indflow.db, a exportacao grande de um cliente disputa o banco
+# com a escrita dos ESPs de todos os outros. No modo shard cada cliente tem o proprio arquivo
+# (INDFLOW_SHARD_DIR, padrao <pasta do banco>/tenants/<cliente_id>.db) com as tabelas
+# operacionais (eventos, horaria, diaria, estado, refugo, NP, baseline, config, OPs, machines).
+#
+# - Roteador: definir_cliente_atual()/usar_cliente() marcam o cliente da thread (o before_request
+#   resolve pelo X-API-Key do ESP ou pela sessao web). get_db(), get_db_leitura() e
+#   unit_of_work() abrem o shard desse cliente; sem cliente (ou modo desligado) usam o central.
+# - O shard abre como main com o central anexado (ATTACH ... AS central). clientes/usuarios/devices
+#   nao existem no shard, entao o SQL sem prefixo desses nomes cai no central sem mudar as rotas.
+#   Enquanto o shard e preparado (migracoes + registrar_schema_shard) um autorizador ignora
+#   CREATE TABLE/INDEX desses nomes no main (ensure_* legados nao criam copia vazia que esconderia
+#   o central); depois ele sai da conexao (callback por statement fora do caminho do ingest).
+#   ensure_* de tabela global chamados depois checam em_shard() antes do CREATE.
+# - Migracoes: rodam no shard na primeira abertura (sem o central anexado); depois as tabelas
+#   globais sao removidas do shard e os triggers de machine_pk usam o cliente do shard.
+#   registrar_schema_shard(fn) soma o schema criado fora das migracoes (ex.: init_op_db).
+# - Escrita: BEGIN + escrita vazia no main pega so o lock do shard (BEGIN IMMEDIATE travaria o
+#   central anexado e serializaria todos os clientes de novo).
+# - Unidade que pode escrever no central abre com unit_of_work(central=True): pega tambem o
+#   escritor_serializado do central (sempre DEPOIS do lock do shard: ordem fixa) e reserva a escrita
+#   do central ja no BEGIN. Sem isso o upgrade adiado do central (a unidade ja leu devices no
+#   snapshot) pode falhar com SQLITE_BUSY_SNAPSHOT, que o busy_timeout nao repete.
+#   exigir_central() antes da escrita global barra a unidade de shard aberta sem central=True.
+# - Commit entre arquivos NAO e atomico em WAL: o commit grava o shard e o central um depois do
+#   outro; queda no meio pode deixar so um dos dois gravado. O que vai ao central junto com o shard
+#   (upsert do device) e refeito pelo proximo pacote do ESP; last_seen coalescido nem entra na
+#   transacao do shard (vai ao central no on_commit).
+# Dados ja gravados no central nao sao copiados para os shards ao ligar o modo.
+
+_CLIENTE_LOCAL = threading.local()
+_TABELAS_GLOBAIS = ("clientes", "usuarios", "devices")
+_SHARD_LOCK = threading.RLock()
+_SHARDS_PRONTOS: set = set()
+_SCHEMA_SHARD_FNS: list = []
+
+
+def shard_ativo() -> bool:
+    return _env_str("INDFLOW_SHARD_MODE", "off").lower() in ("cliente", "tenant", "1", "on")
+
+
+def shard_db_path(cliente_id: str) -> str:
+    """Arquivo do shard do cliente."""
+    base = _env_str("INDFLOW_SHARD_DIR", "")
+    if not base:
+        base = os.path.join(os.path.dirname(os.path.abspath(_default_db_path())), "tenants")
+    nome = re.sub(r"[^A-Za-z0-9_.-]", "_", str(cliente_id).strip())
+    return os.path.join(base, f"{nome}.db")
+
+
+def clientes_com_shard() -> list:
+    """Clientes cadastrados (central) que ja tem arquivo de shard: rotas admin que varrem todos os bancos."""
+    with usar_cliente(None):
+        conn = get_db()
+        try:
+            ids = [str(r[0]) for r in conn.execute("SELECT id FROM clientes ORDER BY id").fetchall()]
+        finally:
+            conn.close()
+    return [cid for cid in ids if os.path.exists(shard_db_path(cid))]
+
+
+def cliente_atual() -> str | None:
+    return getattr(_CLIENTE_LOCAL, "cliente_id", None)
+
+
+def definir_cliente_atual(cliente_id: str | None) -> None:
+    """Cliente da thread (inicio/fim de request). None volta para o banco central."""
+    _CLIENTE_LOCAL.cliente_id = (str(cliente_id).strip() or None) if cliente_id else None
+
+
+@contextmanager
+def usar_cliente(cliente_id: str | None):
+    """Roda o bloco no banco do cliente (threads de fundo: journal, agendador do status)."""
+    anterior = cliente_atual()
+    definir_cliente_atual(cliente_id)
+    try:
+        yield
+    finally:
+        definir_cliente_atual(anterior)
+
+
+def _db_alvo() -> str:
+    cid = cliente_atual()
+    if cid and shard_ativo():
+        return shard_db_path(cid)
+    return _default_db_path()
+
+
+def get_db_path_atual() -> str:
+    """Banco que get_db() usa agora nesta thread (shard do cliente atual ou o central)."""
+    return _db_alvo()
+
+
+def em_shard() -> bool:
+    """True quando get_db() desta thread abre o shard de um cliente (tabelas globais no central anexado)."""
+    return _db_alvo() != _default_db_path()
+
+
+def registrar_schema_shard(fn) -> None:
+    """fn() roda 1 vez por shard novo (get_db() ja aponta para ele), como no startup do central."""
+    if fn not in _SCHEMA_SHARD_FNS:
+        _SCHEMA_SHARD_FNS.append(fn)
+
+
+def _autorizar_shard(acao, arg1, arg2, banco, _gatilho):
+    if banco == "main":
+        if acao == sqlite3.SQLITE_CREATE_TABLE and arg1 in _TABELAS_GLOBAIS:
+            return sqlite3.SQLITE_IGNORE
+        if acao == sqlite3.SQLITE_CREATE_INDEX and arg2 in _TABELAS_GLOBAIS:
+            return sqlite3.SQLITE_IGNORE
+    return sqlite3.SQLITE_OK
+
+
+def _podar_shard(conn: sqlite3.Connection, cliente_id: str) -> None:
+    """Tira do shard as tabelas globais (ficam no central) e amarra os triggers ao cliente do shard."""
+    for tabela in _TABELAS_GLOBAIS:
+        conn.execute(f"DROP TABLE IF EXISTS {tabela}")
+    for tabela in TABELAS_MACHINE_PK:
+        if _table_exists(conn, tabela):
+            _criar_trigger_machine_pk(conn, tabela, cliente_fixo=cliente_id)
+    conn.commit()
+
+
+def _open_conn_shard(db_path: str, cliente_id: str) -> tuple:
+    """(conexao do shard com o central anexado, True se o shard ainda nao foi preparado neste processo)."""
+    conn = _open_conn(db_path)
+    try:
+        novo = db_path not in _SHARDS_PRONTOS
+        if novo:
+            with _SHARD_LOCK:
+                run_migrations(conn)
+                _podar_shard(conn, cliente_id)
+        conn.execute("ATTACH DATABASE ? AS central", (_default_db_path(),))
+        if novo:
+            # so na preparacao (ver _preparar_schema_shard)
+            conn.set_authorizer(_autorizar_shard)
+    except Exception:
+        conn.close()
+        raise
+    return conn, novo
+
+
+def _preparar_schema_shard(db_path: str) -> None:
+    """Schema de fora das migracoes (registrar_schema_shard) no shard recem-aberto da thread."""
+    with _SHARD_LOCK:
+        if db_path in _SHARDS_PRONTOS:
+            return
+        for fn in _SCHEMA_SHARD_FNS:
+            try:
+                fn()
+            except Exception:
+                pass
+        _SHARDS_PRONTOS.add(db_path)
+
+
+# ============================================================
+# UNIDADE DE TRABALHO (1 conexao / 1 transacao por requisicao)
+# ============================================================
+# O /machine/update passa por varios helpers (devices, eventos, baseline, horaria, NP, bobinas...)
+# e cada um fazia get_db() + commit() + close(). Com 40 ESPs postando a cada 1s isso vira
+# dezenas de fsyncs por segundo disputando o lock de escrita.
+#
+# Dentro de `with unit_of_work():` todo get_db() da mesma thread devolve a MESMA conexao
+# (proxy abaixo). commit()/close() dos helpers viram no-op e a transacao e fechada uma unica
+# vez na saida do bloco (commit; rollback se houver excecao).
+# rollback() de helper (desfazer a propria escrita pela metade) nao pode virar commit no fim:
+# marca a unidade como desfeita; a saida do bloco desfaz TUDO e levanta UnidadeDeTrabalhoDesfeita.
+# on_commit(fn): efeito que so pode acontecer se a transacao for gravada (ex.: enfileirar no journal).
+# Roda depois do commit e FORA do escritor_serializado (pode esperar sem travar o escritor).
+# BEGIN que falha (lock nao veio no busy_timeout) sobe a excecao: nada roda em autocommit.
+
+_UOW_LOCAL = threading.local()
+
+
+class UnidadeDeTrabalhoDesfeita(RuntimeError):
+    """Um helper chamou rollback() dentro da unidade de trabalho: a transacao inteira foi desfeita."""
+
+
+class CentralNaoReservado(RuntimeError):
+    """Escrita no central dentro de unidade de trabalho de shard aberta sem central=True."""
+
+
+class _UnitOfWorkConn:
+    """Proxy da conexao compartilhada: delega tudo, exceto o controle da transacao."""
+
+    def __init__(self, conn: sqlite3.Connection, central: bool = False):
+        self._conn = conn
+        self._central = central
+        self._ao_desfazer = []
+        self._ao_confirmar = []
+        self._desfeita = False
+
+    def commit(self):
+        return None
+
+    def rollback(self):
+        self._desfeita = True
+        return None
+
+    def close(self):
+        return None
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def current_unit_of_work():
+    """Conexao da unidade de trabalho ativa nesta thread (ou None)."""
+    return getattr(_UOW_LOCAL, "conn", None)
+
+
+def on_rollback(fn) -> None:
+    """
+    Registra fn() para rodar se a unidade de trabalho ativa for desfeita (caches em memoria que
+    ja refletem uma escrita ainda nao commitada). Fora de unidade de trabalho: no-op.
+    """
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow._ao_desfazer.append(fn)
+
+
+def on_commit(fn) -> None:
+    """
+    Registra fn() para rodar depois do commit da unidade de trabalho ativa (descartado no rollback).
+    Fora de unidade de trabalho nao ha transacao a esperar: roda na hora.
+    """
+    uow = current_unit_of_work()
+    if uow is None:
+        fn()
+        return
+    uow._ao_confirmar.append(fn)
+
+
+def exigir_central() -> None:
+    """
+    Chamar antes de escrever tabela global (devices/clientes/usuarios) pelo get_db(). Unidade de
+    trabalho de shard sem central=True nao tem o escritor do central: levanta CentralNaoReservado.
+    """
+    uow = current_unit_of_work()
+    if uow is not None and not uow._central:
+        raise CentralNaoReservado("escrita no central: abra a unidade de trabalho com central=True")
+
+
+def _rodar_ao_confirmar(fns: list) -> None:
+    """Roda todos os on_commit; a 1a excecao sobe depois (o commit ja aconteceu)."""
+    erro = None
+    for fn in fns:
+        try:
+            fn()
+        except Exception as e:
+            if erro is None:
+                erro = e
+    if erro is not None:
+        raise erro
+
+
+@contextmanager
+def unit_of_work(central: bool = False):
+    """
+    Abre a unidade de trabalho da thread atual.
+    - central=True (shard): a unidade pode escrever no central; pega o escritor dele e reserva a
+      escrita do central no BEGIN (ver bloco SHARD POR CLIENTE). No central e no-op.
+    - BEGIN IMMEDIATE: pega o lock de escrita logo no inicio (evita deadlock de upgrade SHARED->RESERVED
+      entre dois pacotes concorrentes; o segundo espera no busy_timeout).
+    - Aninhado: se ja existe uma ativa, apenas reutiliza (quem abriu e quem fecha).
+    - Escritor unico: BEGIN..commit rodam dentro de escritor_serializado().
+    - rollback() de helper desfaz a unidade inteira (UnidadeDeTrabalhoDesfeita na saida).
+    - on_commit(fn): roda apos o commit, ja fora do escritor_serializado.
+    """
+    atual = current_unit_of_work()
+    if atual is not None:
+        yield atual
+        return
+
+    conn = _conn_da_thread()
+    if conn.in_transaction:
+        # sobra de helper fora da unidade de trabalho: nao herdar escrita pela metade
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+
+    db_path = getattr(_CONN_LOCAL, "path", None)
+    no_central = db_path == _default_db_path()
+    reservar_central = central and not no_central
+    ao_confirmar = []
+    with escritor_serializado(db_path), (
+        escritor_serializado(_default_db_path()) if reservar_central else nullcontext()
+    ):
+        try:
+            if no_central:
+                conn.execute("BEGIN IMMEDIATE")
+            else:
+                # shard: lock de escrita so do main (ver bloco SHARD POR CLIENTE)
+                conn.execute("BEGIN")
+                conn.execute("UPDATE main.schema_version SET version = version WHERE 0")
+                if reservar_central:
+                    conn.execute("UPDATE central.schema_version SET version = version WHERE 0")
+        except Exception:
+            if conn.in_transaction:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            raise
+
+        uow = _UnitOfWorkConn(conn, central=no_central or reservar_central)
+        _UOW_LOCAL.conn = uow
+        try:
+            yield uow
+            if uow._desfeita:
+                raise UnidadeDeTrabalhoDesfeita("rollback() dentro da unidade de trabalho")
+            _UOW_LOCAL.conn = None
+            conn.commit()
+            ao_confirmar = uow._ao_confirmar
+        except BaseException:
+            _UOW_LOCAL.conn = None
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            for fn in uow._ao_desfazer:
+                try:
+                    fn()
+                except Exception:
+                    pass
+            raise
+        finally:
+            # conexao da thread continua aberta para o proximo get_db()/unidade de trabalho
+            _UOW_LOCAL.conn = None
+
+    _rodar_ao_confirmar(ao_confirmar)
+
+
 def _has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
     cur = conn.execute(f"PRAGMA table_info({table})")
     cols = [r[1] for r in cur.fetchall()]
@@ -83,8 +848,29 @@ def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
         return False
 
 
-def init_db():
-    conn = get_db()
+# ============================================================
+# MIGRACOES VERSIONADAS (schema_version)
+# ============================================================
+# Cada migracao roda UMA vez por banco (registrada em schema_version) a partir do init_db().
+# Depois disso schema_ready() == True e os ensure_* dos hot paths viram no-op
+# (nada de CREATE/ALTER/PRAGMA table_info por request).
+#
+# Regras:
+# - nunca editar uma migracao ja publicada; criar uma nova com o proximo numero
+# - migracoes devem ser idempotentes (bancos antigos podem ter parte do schema)
+# - tambem rodam em cada shard de cliente, onde clientes/usuarios/devices nao existem:
+#   migracao nova que mexa nessas tabelas deve checar _table_exists antes
+
+_SCHEMA_READY = False
+
+
+def schema_ready() -> bool:
+    """True quando todas as migracoes ja foram aplicadas neste processo (init_db ok)."""
+    return _SCHEMA_READY
+
+
+def _m001_schema_base(conn: sqlite3.Connection) -> None:
+    """Schema que o init_db sempre garantiu (auth, devices, producao, config, baseline, timeline, bobinas)."""
     cur = conn.cursor()
 
     # -------------------- auth --------------------
@@ -343,6 +1129,473 @@ def init_db():
     cur.execute("CREATE INDEX IF NOT EXISTS ix_op_bobina_pend_opid ON ordens_producao_bobina_pendencia(op_id)")
 
 
+def _try_exec(conn: sqlite3.Connection, sql: str) -> None:
+    """Indices UNIQUE sobre dados legados podem falhar (duplicados); nao derruba o deploy."""
+    try:
+        conn.execute(sql)
+    except Exception:
+        pass
+
+
+def _m002_producao_evento(conn: sqlite3.Connection) -> None:
+    """Eventos de contagem do ESP (antes: _ensure_producao_evento_table a cada pacote)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS producao_evento (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cliente_id TEXT,
+            machine_id TEXT NOT NULL,
+            ts_ms INTEGER NOT NULL,
+            esp_absoluto INTEGER NOT NULL,
+            delta INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_producao_evento_mid_ts ON producao_evento(machine_id, ts_ms)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_producao_evento_cid_mid_ts ON producao_evento(cliente_id, machine_id, ts_ms)")
+
+
+def _m003_machine_state_event_indices(conn: sqlite3.Connection) -> None:
+    """Indices da timeline criados pelo _ensure_machine_state_event_schema (machine_routes)."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mse_mid_day ON machine_state_event (effective_machine_id, data_ref, ts_ms)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mse_mid_ts ON machine_state_event (effective_machine_id, ts_ms)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mse_cid_mid_day ON machine_state_event (cliente_id, effective_machine_id, data_ref, ts_ms)")
+
+
+def _m004_machine_stop_e_reset_cmd(conn: sqlite3.Connection) -> None:
+    """Relogio de parada (machine_stop) e comandos de reset do ESP (esp_reset_cmd)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS machine_stop (
+            machine_id TEXT PRIMARY KEY,
+            stopped_since_ms INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_machine_stop_updated_at ON machine_stop(updated_at)")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS esp_reset_cmd (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cliente_id TEXT,
+            machine_id TEXT NOT NULL,
+            cmd_id TEXT NOT NULL,
+            pending INTEGER NOT NULL DEFAULT 1,
+            created_at TEXT NOT NULL,
+            applied_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_esp_reset_cmd_mid_pending ON esp_reset_cmd(machine_id, pending)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_esp_reset_cmd_cid_mid_pending ON esp_reset_cmd(cliente_id, machine_id, pending)")
+
+
+def _m005_horaria_refugo_config(conn: sqlite3.Connection) -> None:
+    """producao_horaria (indice por cliente), refugo_horaria (com dedupe unico) e colunas extras de machine_config."""
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_producao_horaria_cliente_id ON producao_horaria(cliente_id)")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS refugo_horaria (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            machine_id TEXT NOT NULL,
+            dia_ref TEXT NOT NULL,
+            hora_dia INTEGER NOT NULL,
+            refugo INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    _add_column_if_missing(conn, "refugo_horaria", "cliente_id", "TEXT")
+    # dedupe roda AQUI (uma vez), nao mais a cada load_refugo_24
+    try:
+        _dedupe_keep_latest(conn, "refugo_horaria", ["machine_id", "dia_ref", "hora_dia"])
+    except Exception:
+        pass
+    conn.execute("DROP INDEX IF EXISTS ux_refugo_horaria")
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_refugo_horaria_cliente
+        ON refugo_horaria(cliente_id, machine_id, dia_ref, hora_dia)
+    """)
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_refugo_horaria_legacy
+        ON refugo_horaria(machine_id, dia_ref, hora_dia)
+        WHERE cliente_id IS NULL
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_refugo_horaria_cliente_id ON refugo_horaria(cliente_id)")
+
+    _add_column_if_missing(conn, "machine_config", "unidade_1", "TEXT")
+    _add_column_if_missing(conn, "machine_config", "unidade_2", "TEXT")
+    _add_column_if_missing(conn, "machine_config", "conv_m_por_pcs", "REAL")
+    _add_column_if_missing(conn, "machine_config", "alerta_sem_contagem_seg", "INTEGER")
+
+
+def _m006_nao_programado_horaria(conn: sqlite3.Connection) -> None:
+    """NP por hora/dia + migracao de schema legado que o ensure_table do repo sondava a cada chamada."""
+    from modules.repos.nao_programado_horaria_repo import (
+        DDL_NAO_PROGRAMADO_HORARIA,
+        _migrate_nao_programado_horaria_if_needed,
+    )
+
+    conn.execute(DDL_NAO_PROGRAMADO_HORARIA)
+    _migrate_nao_programado_horaria_if_needed(conn)
+    _try_exec(conn, "CREATE UNIQUE INDEX IF NOT EXISTS ux_np_horaria ON nao_programado_horaria(machine_id, data_ref, hora_dia)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_np_horaria_data ON nao_programado_horaria(data_ref)")
+
+    # NP diario (machine_calc_nao_programado)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS nao_programado_diario (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            machine_id TEXT NOT NULL,
+            data_ref TEXT NOT NULL,
+            np_producao INTEGER NOT NULL DEFAULT 0,
+            np_minutos INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    _add_column_if_missing(conn, "nao_programado_diario", "np_hour_ref", "INTEGER")
+    _add_column_if_missing(conn, "nao_programado_diario", "np_hour_baseline", "INTEGER")
+    _try_exec(conn, "CREATE UNIQUE INDEX IF NOT EXISTS ux_np_diario ON nao_programado_diario(machine_id, data_ref)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_np_diario_data ON nao_programado_diario(data_ref)")
+
+
+def _m007_machine_op_fila(conn: sqlite3.Connection) -> None:
+    """Fila de OPs por maquina (antes: _ensure_machine_op_fila_table por chamada)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS machine_op_fila (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cliente_id TEXT,
+            machine_id TEXT NOT NULL,
+            posicao INTEGER NOT NULL,
+            op TEXT,
+            status TEXT NOT NULL DEFAULT 'VAZIO',
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_machine_op_fila_mid ON machine_op_fila(machine_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_machine_op_fila_cid_mid ON machine_op_fila(cliente_id, machine_id)")
+    _try_exec(conn, """
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_machine_op_fila_cliente
+        ON machine_op_fila(cliente_id, machine_id, posicao)
+        WHERE cliente_id IS NOT NULL
+    """)
+    _try_exec(conn, """
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_machine_op_fila_legacy
+        ON machine_op_fila(machine_id, posicao)
+        WHERE cliente_id IS NULL
+    """)
+
+
+def _m008_producao_evento_idempotencia(conn: sqlite3.Connection) -> None:
+    """
+    Chave de idempotencia do ingest: (device_id, ts_ms, seq).
+    Linhas legadas ficam com device_id NULL (NULL nunca conflita no UNIQUE).
+    """
+    _add_column_if_missing(conn, "producao_evento", "device_id", "TEXT")
+    _add_column_if_missing(conn, "producao_evento", "seq", "INTEGER")
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_producao_evento_dev_ts_seq
+        ON producao_evento(device_id, ts_ms, seq)
+        WHERE device_id IS NOT NULL AND seq IS NOT NULL
+    """)
+
+
+def _m009_indices_consultas_quentes(conn: sqlite3.Connection) -> None:
+    """
+    Indices compostos das consultas quentes (chave maquina + dia) e machine_id gravado em minusculo:
+    a leitura compara por igualdade/faixa e usa o indice (sem lower(machine_id) nem LIKE '%...').
+    Conferencia dos planos: check_query_plan.py.
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_producao_diaria_mid_data ON producao_diaria(machine_id, data)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_producao_diaria_cid_data ON producao_diaria(cliente_id, data)")
+    # (cliente_id) sozinho vira prefixo redundante do indice acima
+    conn.execute("DROP INDEX IF EXISTS ix_producao_diaria_cliente_id")
+    # os UNIQUE existentes comecam por cliente_id (ou sao parciais): leitura so por maquina nao usava indice
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_baseline_diario_mid_dia ON baseline_diario(machine_id, dia_ref)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_producao_horaria_mid_data ON producao_horaria(machine_id, data_ref, hora_idx)")
+
+    # Ingest ja grava minusculo (_norm_machine_id); normaliza o legado. OR IGNORE: se a versao
+    # minuscula ja existe na mesma chave unica, a linha antiga fica como estava (resolvida na 11).
+    for tabela in ("producao_diaria", "producao_horaria", "baseline_diario", "producao_evento"):
+        if _table_exists(conn, tabela):
+            conn.execute(
+                f"UPDATE OR IGNORE {tabela} SET machine_id = lower(machine_id) WHERE machine_id <> lower(machine_id)"
+            )
+
+
+# tabela -> colunas (alem de cliente_id/machine_id) da chave unica
+_CHAVES_MACHINE_ID_MINUSCULO = {
+    "producao_horaria": "data_ref, hora_idx",
+    "baseline_diario": "dia_ref",
+}
+
+
+def _m011_machine_id_minusculo_colisoes(conn: sqlite3.Connection) -> str:
+    """
+    Linhas legadas que a 9 deixou em maiusculo por colidirem com a versao minuscula na chave unica
+    ficavam ilegiveis (a leitura compara por igualdade). Por chave, mantem a linha mais recente
+    (updated_at, id), apaga as outras e normaliza o que sobrou. Retorna o resumo das colisoes.
+    """
+    removidas = {}
+    for tabela, cols in _CHAVES_MACHINE_ID_MINUSCULO.items():
+        if not _table_exists(conn, tabela):
+            continue
+        cur = conn.execute(f"""
+            DELETE FROM {tabela} WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (
+                        PARTITION BY COALESCE(cliente_id, '__NULL__'), lower(machine_id), {cols}
+                        ORDER BY updated_at DESC, id DESC
+                    ) AS rn
+                    FROM {tabela}
+                    WHERE lower(machine_id) IN (
+                        SELECT DISTINCT lower(machine_id) FROM {tabela} WHERE machine_id <> lower(machine_id)
+                    )
+                ) WHERE rn > 1
+            )
+        """)
+        removidas[tabela] = max(int(cur.rowcount or 0), 0)
+
+    # sem OR IGNORE: depois da limpeza, qualquer colisao restante e erro de verdade
+    for tabela in ("producao_diaria", "producao_horaria", "baseline_diario", "producao_evento"):
+        if _table_exists(conn, tabela):
+            conn.execute(f"UPDATE {tabela} SET machine_id = lower(machine_id) WHERE machine_id <> lower(machine_id)")
+
+    total = sum(removidas.values())
+    if total:
+        log.warning(
+            "migracao 11: %d linha(s) com machine_id em maiusculo colidiam com a versao minuscula e foram "
+            "removidas (mantida a mais recente): %s", total, removidas,
+        )
+    return ", ".join(f"{t}={n}" for t, n in removidas.items()) or "nada a resolver"
+
+
+# ------------------------------------------------------------
+# Cadastro de maquinas (machines): chave inteira por (cliente_id, code)
+# ------------------------------------------------------------
+# Identidade a partir das colunas legadas (mesma regra de machine_registry.chave_maquina):
+#   cliente = cliente_id da linha; sem ele, o prefixo '<cliente>::' se for cliente cadastrado; senao ''
+#   code    = machine_id minusculo, sem o prefixo '<cliente>::'
+# Assim 'maquina01' e '<cliente>::maquina01' do mesmo cliente viram a MESMA machine_pk.
+
+# tabela -> (coluna do machine_id, tem cliente_id, colunas do indice apos machine_pk)
+TABELAS_MACHINE_PK = {
+    "producao_evento": ("machine_id", True, "ts_ms"),
+    "producao_horaria": ("machine_id", True, "data_ref, hora_idx"),
+    "producao_diaria": ("machine_id", True, "data"),
+    "refugo_horaria": ("machine_id", True, "dia_ref, hora_dia"),
+    "nao_programado_horaria": ("machine_id", False, "data_ref, hora_dia"),
+    "nao_programado_diario": ("machine_id", False, "data_ref"),
+    "machine_state_event": ("effective_machine_id", True, "data_ref, ts_ms"),
+}
+
+
+def _sql_chave_maquina(mid: str, cid: str | None, cliente_fixo: str | None = None) -> str:
+    """
+    SELECT de 1 linha (mid, cli) com a regra de identidade sobre as expressoes mid/cid.
+    cliente_fixo (shard): o prefixo so e reconhecido se for o cliente do shard (sem tabela clientes).
+    Sem cliente nem prefixo (escritor legado com cliente_id NULL): maquina ja cadastrada para um
+    unico cliente usa a chave dele; no shard, o cliente do shard. So entao cai em ''.
+    """
+    m = f"lower(trim({mid}))"
+    partes = [f"NULLIF(trim({cid}), '')"] if cid else []
+    if cliente_fixo:
+        lit = cliente_fixo.replace("'", "''")
+        partes.append(
+            f"(CASE WHEN instr({m}, '::') > 0 AND substr({m}, 1, instr({m}, '::') - 1) = lower('{lit}') "
+            f"THEN '{lit}' END)"
+        )
+    else:
+        partes.append(
+            f"(SELECT c.id FROM clientes c WHERE instr({m}, '::') > 0 "
+            f"AND lower(c.id) = substr({m}, 1, instr({m}, '::') - 1))"
+        )
+    partes.append(
+        f"(SELECT MIN(d.cliente_id) FROM machines d WHERE d.code = {m} AND d.cliente_id <> '' HAVING COUNT(*) = 1)"
+    )
+    if cliente_fixo:
+        partes.append(f"'{lit}'")
+    partes.append("''")
+    return f"SELECT {m} AS mid, COALESCE({', '.join(partes)}) AS cli"
+
+
+_SQL_CODE = (
+    "CASE WHEN k.cli <> '' AND substr(k.mid, 1, length(k.cli) + 2) = lower(k.cli) || '::' "
+    "THEN substr(k.mid, length(k.cli) + 3) ELSE k.mid END"
+)
+
+
+def _criar_trigger_machine_pk(conn: sqlite3.Connection, tabela: str, cliente_fixo: str | None = None) -> None:
+    """
+    Escritor que nao informa machine_pk (caminhos legados, scripts): o trigger cadastra a maquina
+    e preenche a chave. O ingest ja grava a machine_pk resolvida e nao dispara o corpo.
+    """
+    col, tem_cliente, _ = TABELAS_MACHINE_PK[tabela]
+    chave = _sql_chave_maquina(f"NEW.{col}", "NEW.cliente_id" if tem_cliente else None, cliente_fixo)
+    conn.execute(f"DROP TRIGGER IF EXISTS tr_{tabela}_machine_pk")
+    conn.execute(f"""
+        CREATE TRIGGER tr_{tabela}_machine_pk
+        AFTER INSERT ON {tabela}
+        WHEN NEW.machine_pk IS NULL AND NEW.{col} IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO machines (cliente_id, code, created_at)
+            SELECT k.cli, {_SQL_CODE}, datetime('now') FROM ({chave}) k;
+            UPDATE {tabela} SET machine_pk = (
+                SELECT mm.id FROM machines mm, ({chave}) k
+                 WHERE mm.cliente_id = k.cli AND mm.code = {_SQL_CODE}
+            ) WHERE rowid = NEW.rowid;
+        END
+    """)
+
+
+def _m010_machines(conn: sqlite3.Connection) -> None:
+    """
+    Tabela machines + coluna machine_pk (indice (machine_pk, dia)) nas tabelas de evento,
+    horaria, diaria, refugo, NP e estado, com backfill unico das linhas existentes.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS machines (
+            id INTEGER PRIMARY KEY,
+            cliente_id TEXT NOT NULL DEFAULT '',
+            code TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_machines_cliente_code ON machines(cliente_id, code)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_machines_code ON machines(code)")
+
+    # Backfill por par distinto (machine_id, cliente_id): poucos pares, UPDATE pelo indice de machine_id.
+    # A regra e a mesma do trigger (mesmo SQL, com parametros nomeados no lugar de NEW.*).
+    sql_chave = f"SELECT k.cli, {_SQL_CODE} FROM ({_sql_chave_maquina(':mid', ':cid')}) k"
+
+    def _pk_de(mid, cid) -> int:
+        cli, code = conn.execute(sql_chave, {"mid": mid, "cid": cid}).fetchone()
+        conn.execute(
+            "INSERT OR IGNORE INTO machines (cliente_id, code, created_at) VALUES (?, ?, datetime('now'))",
+            (cli, code),
+        )
+        return int(conn.execute("SELECT id FROM machines WHERE cliente_id = ? AND code = ?", (cli, code)).fetchone()[0])
+
+    # maquinas ja conhecidas pelo cadastro (mesmo sem producao ainda)
+    for tabela in ("devices", "machine_config"):
+        if _table_exists(conn, tabela) and _has_column(conn, tabela, "cliente_id"):
+            for mid, cid in conn.execute(
+                f"SELECT DISTINCT machine_id, cliente_id FROM {tabela} WHERE trim(COALESCE(machine_id, '')) <> ''"
+            ).fetchall():
+                _pk_de(mid, cid)
+
+    for tabela, (col, tem_cliente, idx_cols) in TABELAS_MACHINE_PK.items():
+        if not _table_exists(conn, tabela):
+            continue
+        _add_column_if_missing(conn, tabela, "machine_pk", "INTEGER")
+        cid_col = "cliente_id" if tem_cliente else "NULL"
+        pares = conn.execute(
+            f"SELECT DISTINCT {col}, {cid_col} FROM {tabela} WHERE {col} IS NOT NULL AND machine_pk IS NULL"
+        ).fetchall()
+        for mid, cid in pares:
+            conn.execute(
+                f"UPDATE {tabela} SET machine_pk = ? WHERE {col} = ? AND {cid_col} IS ? AND machine_pk IS NULL",
+                (_pk_de(mid, cid), mid, cid),
+            )
+        conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{tabela}_machine_pk ON {tabela}(machine_pk, {idx_cols})")
+        _criar_trigger_machine_pk(conn, tabela)
+
+
+def _m012_machine_pk_sem_cliente(conn: sqlite3.Connection) -> str:
+    """
+    Escritores legados sem cliente_id (recalculo/fechamento da diaria) criavam uma 2a chave
+    ('', code) para a maquina do cliente e a producao_diaria ficava dividida entre as duas.
+    Triggers recriados com a regra nova (_sql_chave_maquina: dono unico da maquina) e as linhas
+    da chave ('', code) passam para a do dono quando ha exatamente 1 cliente com esse code.
+    """
+    if not _table_exists(conn, "machines"):
+        return ""
+    pares = conn.execute("""
+        SELECT o.id, MIN(d.id) FROM machines o
+          JOIN machines d ON d.code = o.code AND d.cliente_id <> ''
+         WHERE o.cliente_id = ''
+         GROUP BY o.id
+        HAVING COUNT(d.id) = 1
+    """).fetchall()
+    for tabela in TABELAS_MACHINE_PK:
+        if not _table_exists(conn, tabela):
+            continue
+        if _has_column(conn, tabela, "machine_pk"):
+            conn.executemany(f"UPDATE {tabela} SET machine_pk = ? WHERE machine_pk = ?", [(d, o) for o, d in pares])
+        _criar_trigger_machine_pk(conn, tabela)
+    conn.executemany("DELETE FROM machines WHERE id = ?", [(o,) for o, _d in pares])
+    if pares:
+        log.warning("migracao 12: %d maquina(s) com chave sem cliente unidas a chave do dono", len(pares))
+    return f"maquinas unidas={len(pares)}"
+
+
+# (versao, descricao, funcao) — ordem importa
+MIGRATIONS = [
+    (1, "schema base do init_db", _m001_schema_base),
+    (2, "producao_evento", _m002_producao_evento),
+    (3, "indices machine_state_event", _m003_machine_state_event_indices),
+    (4, "machine_stop + esp_reset_cmd", _m004_machine_stop_e_reset_cmd),
+    (5, "producao_horaria/refugo_horaria/machine_config", _m005_horaria_refugo_config),
+    (6, "nao_programado_horaria", _m006_nao_programado_horaria),
+    (7, "machine_op_fila", _m007_machine_op_fila),
+    (8, "producao_evento idempotencia (device_id, ts_ms, seq)", _m008_producao_evento_idempotencia),
+    (9, "indices (machine_id, dia) + machine_id minusculo", _m009_indices_consultas_quentes),
+    (10, "machines (chave inteira) + machine_pk nas tabelas por maquina", _m010_machines),
+    (11, "machine_id minusculo: colisoes do legado resolvidas (mantem a linha mais recente)",
+     _m011_machine_id_minusculo_colisoes),
+    (12, "machine_pk: escritor sem cliente usa a chave do dono da maquina", _m012_machine_pk_sem_cliente),
+]
+
+
+def run_migrations(conn: sqlite3.Connection) -> list[int]:
+    """
+    Aplica (em ordem) as migracoes que ainda nao estao em schema_version.
+    Cada migracao roda numa transacao explicita (BEGIN IMMEDIATE) junto com o seu registro: no modo
+    legado do sqlite3 o DDL nao abre transacao sozinho e cada CREATE/ALTER ficaria gravado na hora;
+    falha no meio desfaz o DDL e o registro juntos. Migracoes nao chamam commit(). Retorna as versoes
+    aplicadas agora. Migracao que devolve texto (ex.: quantas linhas resolveu) tem ele anexado a
+    descricao registrada.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descricao TEXT,
+            applied_at TEXT NOT NULL
+        )
+    """)
     conn.commit()
-    conn.close()
+
+    ja = {int(r[0]) for r in conn.execute("SELECT version FROM schema_version").fetchall()}
+
+    aplicadas = []
+    for version, descricao, fn in MIGRATIONS:
+        if version in ja:
+            continue
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # outro processo pode ter aplicado entre a leitura de `ja` e o lock de escrita
+            if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (int(version),)).fetchone():
+                conn.rollback()
+                continue
+            resumo = fn(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, descricao, applied_at) VALUES (?, ?, datetime('now'))",
+                (int(version), f"{descricao} ({resumo})" if resumo else descricao),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        aplicadas.append(version)
+    return aplicadas
+
+
+def init_db():
+    global _SCHEMA_READY
+
+    conn = _open_conn()
+    try:
+        run_migrations(conn)
+    finally:
+        conn.close()
+
+    _SCHEMA_READY = True
 ##
\ No newline at end of file
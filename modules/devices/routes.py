@@ -2,8 +2,13 @@ from flask import Blueprint, render_template, request, redirect, url_for
 from datetime import datetime
 import re
 
-from modules.db_indflow import get_db
+from modules.db_indflow import get_db, em_shard
 from modules.admin.routes import login_required
+from modules.machine.device_helpers import (
+    device_registry_update,
+    device_registry_forget,
+    flush_devices_seen,
+)
 
 devices_bp = Blueprint("devices", __name__, template_folder="templates")
 
@@ -14,6 +19,9 @@ devices_bp = Blueprint("devices", __name__, template_folder="templates")
 
 def _ensure_devices_table(conn):
     # Tabela mínima para cadastro/vínculo de devices (MAC = device_id)
+    # No shard do cliente ela fica no central anexado: CREATE sem prefixo criaria copia vazia no shard
+    if em_shard():
+        return
     conn.execute("""
         CREATE TABLE IF NOT EXISTS devices (
             device_id TEXT PRIMARY KEY,
@@ -65,6 +73,12 @@ def _now_str() -> str:
 @devices_bp.route("/", methods=["GET"])
 @login_required
 def home():
+    # last_seen do ESP e gravado em lote; garante a tela com o valor mais recente
+    try:
+        flush_devices_seen(force=True)
+    except Exception:
+        pass
+
     db = get_db()
     _ensure_devices_table(db)
 
@@ -127,6 +141,7 @@ def link_device():
     """, (device_id, machine_id, now))
 
     db.commit()
+    device_registry_update(device_id, machine_id=machine_id)
     return redirect(url_for("devices.home"))
 
 
@@ -147,6 +162,7 @@ def unlink_device():
         (_now_str(), device_id),
     )
     db.commit()
+    device_registry_update(device_id, machine_id=None)
     return redirect(url_for("devices.home"))
 
 
@@ -172,6 +188,7 @@ def delete_device():
 
     db.execute("DELETE FROM devices WHERE device_id = ?", (device_id,))
     db.commit()
+    device_registry_forget(device_id)
     return redirect(url_for("devices.home"))
 
 
@@ -198,6 +215,7 @@ def set_alias():
         (alias if alias else None, _now_str(), device_id),
     )
     db.commit()
+    device_registry_update(device_id, alias=(alias if alias else None))
     return redirect(url_for("devices.home"))
 
 
@@ -227,4 +245,6 @@ def cleanup_invalid():
         db.execute("DELETE FROM devices WHERE device_id = ?", (device_id,))
 
     db.commit()
+    for device_id in to_delete:
+        device_registry_forget(device_id)
     return redirect(url_for("devices.home"))
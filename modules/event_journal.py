@@ -0,0 +1,347 @@
+# PATH: modules/event_journal.py
+# LAST_RECODE: 2026-10-18 01:45 America/Bahia
+# MOTIVO: ultimos_pendentes(tabela) no lugar de ultimo_pendente: machine_state re-prima o ultimo estado
+#         com as transicoes enfileiradas e ainda nao gravadas (valor = {state, ts_ms}).
+#
+# Regras:
+# - Fila em memoria limitada (INDFLOW_JOURNAL_MAX_QUEUE). Cheia => o request espera ate
+#   INDFLOW_JOURNAL_PUT_TIMEOUT_MS (backpressure); se ainda estiver cheia grava direto (sem perder dado).
+# - Group commit: INDFLOW_JOURNAL_FLUSH_MS (janela) / INDFLOW_JOURNAL_MAX_BATCH (linhas por commit).
+# - Shutdown: atexit drena a fila antes de sair.
+# - INDFLOW_EVENT_JOURNAL=0 desliga (helpers voltam a gravar sincrono).
+# - Cada flush (e o fallback sincrono) passa por escritor_serializado(): mesmo escritor unico
+#   do banco que a unit_of_work() do /machine/update.
+# - Shard por cliente: cada linha leva o cliente da thread que enfileirou; o flush grava cada
+#   cliente no seu banco (1 commit por banco).
+# - Dentro de unit_of_work(): a linha so entra na fila no on_commit da unidade (rollback do pacote
+#   descarta o evento) e o put roda fora do escritor_serializado (fila cheia nao trava o escritor).
+# - Flush que falha (SQLITE_BUSY, disco, shard que nao abre): o grupo e regravado com backoff
+#   (INDFLOW_JOURNAL_RETRIES / INDFLOW_JOURNAL_RETRY_MS); esgotado, tenta linha a linha e so o que
+#   ainda falhar e descartado, com log.error e contagem em "dropped".
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from modules.db_indflow import cliente_atual, escritor_serializado, get_db, on_commit, usar_cliente
+
+log = logging.getLogger("indflow")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = int((os.getenv(name) or "").strip() or default)
+        return v if v > 0 else default
+    except Exception:
+        return default
+
+
+def journal_enabled() -> bool:
+    return (os.getenv("INDFLOW_EVENT_JOURNAL") or "1").strip().lower() not in {"0", "false", "no", "n", "off"}
+
+
+_FLUSH_MS = _env_int("INDFLOW_JOURNAL_FLUSH_MS", 200)
+_MAX_BATCH = _env_int("INDFLOW_JOURNAL_MAX_BATCH", 500)
+_MAX_QUEUE = _env_int("INDFLOW_JOURNAL_MAX_QUEUE", 20000)
+_PUT_TIMEOUT_MS = _env_int("INDFLOW_JOURNAL_PUT_TIMEOUT_MS", 1000)
+_RETRIES = _env_int("INDFLOW_JOURNAL_RETRIES", 5)
+_RETRY_MS = _env_int("INDFLOW_JOURNAL_RETRY_MS", 100)
+_RETRY_MAX_MS = 2000
+
+_STOP = object()
+
+_QUEUE: "queue.Queue" = queue.Queue(maxsize=_MAX_QUEUE)
+_LOCK = threading.Lock()
+_WRITER: threading.Thread | None = None
+
+# tabela -> {"sql": INSERT ..., "ensure": fn(conn) | None}
+_TABELAS: dict = {}
+
+# (tabela, chave) -> [linhas_pendentes, ultimo_valor]  (ex.: ultimo estado enfileirado por maquina)
+_PENDENTES: dict = {}
+
+_STATS = {
+    "enqueued": 0,
+    "written": 0,
+    "commits": 0,
+    "sync_fallback": 0,
+    "errors": 0,
+    "retries": 0,
+    "dropped": 0,
+    "last_error": None,
+    "last_flush_at": None,
+}
+
+
+def registrar_tabela(tabela: str, insert_sql: str, ensure_fn=None) -> None:
+    """Registra o INSERT (e o ensure de schema opcional) usado pelo escritor para a tabela."""
+    _TABELAS[tabela] = {"sql": insert_sql, "ensure": ensure_fn}
+
+
+# ============================================================
+# ENFILEIRAR
+# ============================================================
+def enqueue(tabela: str, row: tuple, chave=None, valor=None) -> None:
+    """
+    Enfileira 1 linha para a tabela registrada.
+    chave/valor (opcionais): permitem consultar o ultimo valor ainda nao gravado (ultimos_pendentes).
+    Dentro de unit_of_work() so enfileira depois do commit da unidade.
+    """
+    if tabela not in _TABELAS:
+        raise KeyError(f"tabela nao registrada no journal: {tabela}")
+
+    # cliente da thread: com shard por cliente o escritor grava no banco certo
+    item = (tabela, tuple(row), chave, valor, cliente_atual())
+    on_commit(lambda: _enfileirar(item))
+
+
+def _enfileirar(item: tuple) -> None:
+    _ensure_writer()
+
+    tabela, _row, chave, valor, cliente_id = item
+    with _LOCK:
+        if chave is not None:
+            p = _PENDENTES.setdefault((tabela, chave), [0, None])
+            p[0] += 1
+            p[1] = valor
+        _STATS["enqueued"] += 1
+
+    try:
+        _QUEUE.put(item, timeout=_PUT_TIMEOUT_MS / 1000.0)
+        return
+    except queue.Full:
+        pass
+
+    # Backpressure esgotado: grava direto na conexao do chamador (nao perde o evento)
+    with _LOCK:
+        _STATS["sync_fallback"] += 1
+    try:
+        _gravar_grupo(cliente_id, [item])
+    finally:
+        _liberar_pendentes([item])
+
+
+def enqueue_many(tabela: str, rows: list) -> None:
+    for row in rows or []:
+        enqueue(tabela, row)
+
+
+def ultimos_pendentes(tabela: str) -> dict:
+    """{chave: ultimo valor} enfileirado na tabela e ainda nao gravado (ex.: re-primar o ultimo estado)."""
+    with _LOCK:
+        return {chave: p[1] for (t, chave), p in _PENDENTES.items() if t == tabela}
+
+
+def journal_depth() -> int:
+    return int(_QUEUE.qsize())
+
+
+def journal_stats() -> dict:
+    with _LOCK:
+        out = dict(_STATS)
+    out.update({
+        "enabled": journal_enabled(),
+        "depth": journal_depth(),
+        "max_queue": _MAX_QUEUE,
+        "flush_ms": _FLUSH_MS,
+        "max_batch": _MAX_BATCH,
+        "writer_alive": bool(_WRITER is not None and _WRITER.is_alive()),
+    })
+    return out
+
+
+def flush_journal(timeout: float = 5.0) -> bool:
+    """Espera a fila esvaziar (tudo gravado). Retorna False se estourar o timeout."""
+    limite = time.monotonic() + max(0.0, float(timeout))
+    while time.monotonic() < limite:
+        if _QUEUE.unfinished_tasks == 0:
+            return True
+        time.sleep(0.005)
+    return _QUEUE.unfinished_tasks == 0
+
+
+# ============================================================
+# ESCRITOR (thread de fundo)
+# ============================================================
+def _ensure_writer() -> None:
+    global _WRITER
+    if _WRITER is not None and _WRITER.is_alive():
+        return
+    with _LOCK:
+        if _WRITER is not None and _WRITER.is_alive():
+            return
+        _WRITER = threading.Thread(target=_writer_loop, name="indflow-event-journal", daemon=True)
+        _WRITER.start()
+
+
+def _gravar(conn, itens: list) -> None:
+    por_tabela: dict = {}
+    for tabela, row, _chave, _valor, _cliente in itens:
+        por_tabela.setdefault(tabela, []).append(row)
+
+    for tabela, rows in por_tabela.items():
+        cfg = _TABELAS.get(tabela) or {}
+        ensure_fn = cfg.get("ensure")
+        if ensure_fn is not None:
+            try:
+                ensure_fn(conn)
+            except Exception:
+                pass
+        conn.executemany(cfg["sql"], rows)
+
+
+def _gravar_grupo(cliente_id, itens: list) -> None:
+    """1 transacao no banco do cliente (sem shard: o central). Falha => rollback e a excecao sobe."""
+    conn = None
+    try:
+        with usar_cliente(cliente_id):
+            conn = get_db()
+            with escritor_serializado():
+                try:
+                    _gravar(conn, itens)
+                    conn.commit()
+                except Exception:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass
+                    raise
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def _gravar_com_retry(cliente_id, grupo: list) -> None:
+    """
+    Grava o grupo tentando de novo com backoff exponencial. Esgotadas as tentativas, grava linha
+    a linha (isola a linha ruim) e descarta so o que ainda falhar, com log.error.
+    """
+    erro = None
+    for tentativa in range(_RETRIES + 1):
+        try:
+            _gravar_grupo(cliente_id, grupo)
+            with _LOCK:
+                _STATS["written"] += len(grupo)
+                _STATS["commits"] += 1
+                _STATS["last_flush_at"] = time.time()
+            return
+        except Exception as e:
+            erro = e
+            with _LOCK:
+                _STATS["errors"] += 1
+                _STATS["last_error"] = str(e)
+            if tentativa >= _RETRIES:
+                break
+            espera_ms = min(_RETRY_MAX_MS, _RETRY_MS * (2 ** tentativa))
+            with _LOCK:
+                _STATS["retries"] += 1
+            log.warning(
+                "event_journal: flush de %d linhas (cliente=%s) falhou (%s); nova tentativa em %d ms",
+                len(grupo), cliente_id, e, espera_ms,
+            )
+            time.sleep(espera_ms / 1000.0)
+
+    perdidas = []
+    for item in grupo:
+        try:
+            _gravar_grupo(cliente_id, [item])
+            with _LOCK:
+                _STATS["written"] += 1
+                _STATS["commits"] += 1
+        except Exception as e:
+            erro = e
+            perdidas.append(item)
+    if perdidas:
+        with _LOCK:
+            _STATS["dropped"] += len(perdidas)
+            _STATS["last_error"] = str(erro)
+        log.error(
+            "event_journal: desistiu de %d de %d linhas (cliente=%s, tabelas=%s) apos %d tentativas: %s",
+            len(perdidas), len(grupo), cliente_id, sorted({it[0] for it in perdidas}), _RETRIES + 1, erro,
+        )
+
+
+def _liberar_pendentes(itens: list) -> None:
+    with _LOCK:
+        for tabela, _row, chave, _valor, _cliente in itens:
+            if chave is None:
+                continue
+            p = _PENDENTES.get((tabela, chave))
+            if not p:
+                continue
+            p[0] -= 1
+            if p[0] <= 0:
+                _PENDENTES.pop((tabela, chave), None)
+
+
+def _writer_loop() -> None:
+    parar = False
+    while not parar:
+        try:
+            item = _QUEUE.get()
+        except Exception:
+            continue
+
+        if item is _STOP:
+            _QUEUE.task_done()
+            break
+
+        itens = [item]
+        limite = time.monotonic() + (_FLUSH_MS / 1000.0)
+        while len(itens) < _MAX_BATCH:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                nxt = _QUEUE.get(timeout=restante)
+            except queue.Empty:
+                break
+            if nxt is _STOP:
+                _QUEUE.task_done()
+                parar = True
+                # drena o que ainda estiver na fila antes de sair
+                while True:
+                    try:
+                        resto = _QUEUE.get_nowait()
+                    except queue.Empty:
+                        break
+                    if resto is not _STOP:
+                        itens.append(resto)
+                    else:
+                        _QUEUE.task_done()
+                break
+            itens.append(nxt)
+
+        # 1 commit por banco (sem shard: 1 grupo so, o central)
+        for cliente_id, grupo in _por_cliente(itens):
+            try:
+                _gravar_com_retry(cliente_id, grupo)
+            finally:
+                _liberar_pendentes(grupo)
+                for _ in grupo:
+                    _QUEUE.task_done()
+
+
+def _por_cliente(itens: list) -> list:
+    grupos: dict = {}
+    for item in itens:
+        grupos.setdefault(item[4], []).append(item)
+    return list(grupos.items())
+
+
+def shutdown_journal(timeout: float = 10.0) -> None:
+    """Drena a fila e encerra o escritor (chamado no atexit)."""
+    w = _WRITER
+    if w is None or not w.is_alive():
+        return
+    try:
+        _QUEUE.put(_STOP, timeout=timeout)
+    except Exception:
+        pass
+    w.join(timeout=timeout)
+
+
+atexit.register(shutdown_journal)
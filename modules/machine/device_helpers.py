@@ -1,8 +1,16 @@
 # modules/machine/device_helpers.py
+# LAST_RECODE: 2026-10-18 02:10 America/Bahia
+# MOTIVO: Comentario do dedupe explicita o limite do UNIQUE do producao_evento: leitura so com ts_ms grava
+#         seq 0 (dedupe no banco); sem ts_ms do ESP (seq NULL) so a janela em memoria protege.
+import atexit
+import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from typing import Optional
 
-from modules.db_indflow import get_db
+from modules.db_indflow import em_shard, get_db, on_commit, on_rollback, schema_ready, usar_cliente
 from modules.machine_calc import now_bahia
 
 
@@ -31,6 +39,9 @@ def norm_device_id(v: str) -> str:
 
 
 def ensure_devices_table(conn) -> None:
+    # schema criado pelas migracoes do init_db (schema_version); no shard a tabela fica no central
+    if schema_ready() or em_shard():
+        return
     # Segurança extra: mesmo que init_db não tenha rodado ainda
     conn.execute("""
         CREATE TABLE IF NOT EXISTS devices (
@@ -44,17 +55,258 @@ def ensure_devices_table(conn) -> None:
     conn.commit()
 
 
+# ============================================================
+# REGISTRO EM MEMORIA (device -> cliente/maquina/alias)
+# ============================================================
+# Fonte da verdade continua sendo a tabela devices. O registro e carregado sob demanda
+# (1 SELECT por device na primeira vez) e mantido em sincronia por:
+#   - ingest do ESP (insert / takeover / cliente_id)
+#   - rotas /devices/link, /unlink, /alias, /delete, /cleanup-invalid
+
+_DEVICE_REGISTRY: dict = {}
+_DEVICE_REGISTRY_LOCK = threading.Lock()
+
+# last_seen coalescido: device -> "YYYY-mm-dd HH:MM:SS" ainda nao gravado
+_DEVICE_SEEN_PENDING: dict = {}
+_DEVICE_SEEN_LAST_FLUSH = [0.0]
+
+
+def _seen_flush_sec() -> float:
+    try:
+        v = float((os.getenv("INDFLOW_DEVICE_SEEN_FLUSH_SEC") or "").strip() or 5)
+        return v if v >= 0 else 5.0
+    except Exception:
+        return 5.0
+
+
+def device_registry_get(device_id: str) -> Optional[dict]:
+    """
+    Retorna copia de {device_id, cliente_id, machine_id, alias} ou None se o device nao existe.
+    """
+    if not device_id:
+        return None
+
+    with _DEVICE_REGISTRY_LOCK:
+        hit = _DEVICE_REGISTRY.get(device_id)
+    if hit is not None:
+        return dict(hit)
+
+    conn = get_db()
+    try:
+        row = conn.execute(
+            "SELECT device_id, cliente_id, machine_id, alias FROM devices WHERE device_id = ? LIMIT 1",
+            (device_id,),
+        ).fetchone()
+    finally:
+        conn.close()
+
+    if not row:
+        return None
+
+    entry = {
+        "device_id": row["device_id"],
+        "cliente_id": row["cliente_id"],
+        "machine_id": row["machine_id"],
+        "alias": row["alias"],
+    }
+    with _DEVICE_REGISTRY_LOCK:
+        _DEVICE_REGISTRY[device_id] = entry
+    return dict(entry)
+
+
+def device_registry_put(device_id: str, **campos) -> None:
+    """Cria/atualiza a entrada do device no registro (apenas os campos informados)."""
+    if not device_id:
+        return
+    with _DEVICE_REGISTRY_LOCK:
+        entry = _DEVICE_REGISTRY.get(device_id)
+        if entry is None:
+            entry = {"device_id": device_id, "cliente_id": None, "machine_id": None, "alias": None}
+            _DEVICE_REGISTRY[device_id] = entry
+        for k, v in campos.items():
+            if k in ("cliente_id", "machine_id", "alias"):
+                entry[k] = v
+
+
+def device_registry_update(device_id: str, **campos) -> None:
+    """Atualiza campos SE o device ja estiver no registro (senao o proximo acesso recarrega do banco)."""
+    if not device_id:
+        return
+    with _DEVICE_REGISTRY_LOCK:
+        entry = _DEVICE_REGISTRY.get(device_id)
+        if entry is None:
+            return
+        for k, v in campos.items():
+            if k in ("cliente_id", "machine_id", "alias"):
+                entry[k] = v
+
+
+def device_registry_forget(device_id: str) -> None:
+    with _DEVICE_REGISTRY_LOCK:
+        _DEVICE_REGISTRY.pop(device_id, None)
+        _DEVICE_SEEN_PENDING.pop(device_id, None)
+
+
+def mark_device_seen(device_id: str, now_str: Optional[str] = None) -> None:
+    """
+    Marca last_seen em memoria e grava em lote (1 UPDATE executemany) no maximo
+    a cada INDFLOW_DEVICE_SEEN_FLUSH_SEC segundos.
+    """
+    if not device_id:
+        return
+    ts = now_str or now_bahia().strftime("%Y-%m-%d %H:%M:%S")
+    with _DEVICE_REGISTRY_LOCK:
+        _DEVICE_SEEN_PENDING[device_id] = ts
+    if em_shard():
+        # devices fica no central: grava depois do commit, fora da transacao do shard
+        on_commit(flush_devices_seen)
+        return
+    flush_devices_seen()
+
+
+def flush_devices_seen(force: bool = False) -> int:
+    """Grava os last_seen pendentes. Retorna quantos devices foram atualizados."""
+    agora = time.monotonic()
+    with _DEVICE_REGISTRY_LOCK:
+        if not _DEVICE_SEEN_PENDING:
+            return 0
+        if not force and (agora - _DEVICE_SEEN_LAST_FLUSH[0]) < _seen_flush_sec():
+            return 0
+        pend = list(_DEVICE_SEEN_PENDING.items())
+        _DEVICE_SEEN_PENDING.clear()
+        _DEVICE_SEEN_LAST_FLUSH[0] = agora
+
+    try:
+        with usar_cliente(None):  # conexao do central (devices nao existe no shard)
+            conn = get_db()
+        try:
+            conn.executemany(
+                "UPDATE devices SET last_seen = ? WHERE device_id = ?",
+                [(ts, did) for did, ts in pend],
+            )
+            conn.commit()
+            # dentro de unit_of_work o commit acima e no-op: unidade desfeita devolve os last_seen
+            on_rollback(lambda: _devolver_seen_pendentes(pend))
+        finally:
+            conn.close()
+    except Exception:
+        _devolver_seen_pendentes(pend)
+        return 0
+    return len(pend)
+
+
+def _devolver_seen_pendentes(pend: list) -> None:
+    """Volta para a proxima tentativa (sem sobrescrever um last_seen mais novo)."""
+    with _DEVICE_REGISTRY_LOCK:
+        for did, ts in pend:
+            _DEVICE_SEEN_PENDING.setdefault(did, ts)
+
+
+# ============================================================
+# DEDUPE DE LEITURAS (retry do ESP)
+# ============================================================
+# Chave de idempotencia por origem (device ou cliente::maquina): (seq, ts_ms do ESP).
+# Janela em memoria limitada por origem (INDFLOW_DEDUPE_WINDOW chaves); o UNIQUE
+# ux_producao_evento_dev_ts_seq cobre o que a janela nao ve (ex.: retry logo apos deploy). Leitura so
+# com ts_ms grava seq 0 e entra no UNIQUE; sem ts_ms do ESP o evento usa o relogio do servidor e seq
+# NULL: retry nao tem chave e so a janela protege (check_idempotencia.py).
+# seq so (sem ts_ms): ESP reinicia a contagem no boot; seq <= 1 abaixo do ultimo limpa a janela.
+
+_DEDUPE_JANELAS: dict = {}
+_DEDUPE_LOCK = threading.Lock()
+
+
+def _dedupe_window_size() -> int:
+    try:
+        v = int((os.getenv("INDFLOW_DEDUPE_WINDOW") or "").strip() or 256)
+        return v if v > 0 else 256
+    except Exception:
+        return 256
+
+
+def get_seq_from_payload(data: dict) -> Optional[int]:
+    """Numero de sequencia opcional do ESP (seq / msg_seq). None se ausente/invalido."""
+    if not isinstance(data, dict):
+        return None
+    for k in ("seq", "msg_seq"):
+        if k in data and data.get(k) is not None:
+            try:
+                v = int(data.get(k))
+            except Exception:
+                return None
+            return v if v >= 0 else None
+    return None
+
+
+def leitura_chave(seq: Optional[int], ts_ms_esp: Optional[int]) -> Optional[tuple]:
+    """Chave de idempotencia da leitura; None quando o ESP nao mandou nem seq nem ts_ms."""
+    if seq is None and ts_ms_esp is None:
+        return None
+    return (seq, ts_ms_esp)
+
+
+def leitura_duplicada(origem: str, chave: Optional[tuple]) -> bool:
+    """True se a chave ja foi processada para a origem (retry). Nao toca no banco."""
+    if not origem or chave is None:
+        return False
+    with _DEDUPE_LOCK:
+        janela = _DEDUPE_JANELAS.get(origem)
+        if not janela:
+            return False
+        if chave in janela["chaves"]:
+            return True
+        seq, ts_ms_esp = chave
+        ultimo = janela.get("ultimo_seq")
+        if ts_ms_esp is None and seq is not None and ultimo is not None and seq <= 1 < ultimo:
+            # seq recomecou (boot do ESP): chaves antigas nao valem mais
+            janela["chaves"].clear()
+        return False
+
+
+def marcar_leitura_processada(origem: str, chave: Optional[tuple]) -> None:
+    """Registra a chave depois que a leitura foi aplicada (commit)."""
+    if not origem or chave is None:
+        return
+    limite = _dedupe_window_size()
+    with _DEDUPE_LOCK:
+        janela = _DEDUPE_JANELAS.get(origem)
+        if janela is None:
+            janela = {"chaves": OrderedDict(), "ultimo_seq": None}
+            _DEDUPE_JANELAS[origem] = janela
+        janela["chaves"][chave] = True
+        janela["chaves"].move_to_end(chave)
+        while len(janela["chaves"]) > limite:
+            janela["chaves"].popitem(last=False)
+        if chave[0] is not None:
+            janela["ultimo_seq"] = chave[0]
+
+
+def _flush_devices_seen_atexit() -> None:
+    try:
+        flush_devices_seen(force=True)
+    except Exception:
+        pass
+
+
+atexit.register(_flush_devices_seen_atexit)
+
+
 def touch_device_seen(device_id: str) -> None:
     """
     Registra 'last_seen' do device SEM NUNCA apagar:
     - machine_id (vínculo)
     - alias (apelido)
 
-    Usa UPSERT para ser robusto.
+    Device ja conhecido: last_seen coalescido (mark_device_seen).
+    Device novo: UPSERT para ser robusto.
     """
     if not device_id:
         return
 
+    if device_registry_get(device_id) is not None:
+        mark_device_seen(device_id)
+        return
+
     conn = get_db()
     try:
         ensure_devices_table(conn)
@@ -72,6 +324,7 @@ def touch_device_seen(device_id: str) -> None:
         """, (device_id, now_iso, now_iso))
 
         conn.commit()
+        device_registry_forget(device_id)
     finally:
         try:
             conn.close()
@@ -87,26 +340,9 @@ def get_machine_from_device(device_id: str) -> Optional[str]:
     if not device_id:
         return None
 
-    conn = get_db()
-    try:
-        ensure_devices_table(conn)
-        cur = conn.execute(
-            "SELECT machine_id FROM devices WHERE device_id = ?",
-            (device_id,),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-
-        try:
-            mid = row["machine_id"]
-        except Exception:
-            mid = row[0]
+    entry = device_registry_get(device_id)
+    if not entry:
+        return None
 
-        mid = (mid or "").strip().lower()
-        return mid or None
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+    mid = (entry.get("machine_id") or "").strip().lower()
+    return mid or None
@@ -0,0 +1,370 @@
+# PATH: modules/machine_agenda.py
+# LAST_RECODE: 2026-10-17 21:30 America/Bahia
+# MOTIVO: Agenda de turnos compilada 1x por versao da config: tabela de 1440 minutos (turno, pausa)
+#         + slots/metas pre-calculados, para responder "minuto X do dia Y cai em qual turno/slot/pausa"
+#         sem re-parsear HH:MM nem varrer turnos e pausas a cada request.
+#
+# Regras:
+# - Os turnos do config_v2 sao iguais em todos os dias; o dia da semana so liga/desliga (active_days).
+#   Por isso a tabela e de 1 dia (1440 min) + mascara de dias ativos, e nao 7x1440.
+# - Sobreposicao de turnos: vale o primeiro da lista (mesma regra do antigo _cfgv2_pick_shift).
+# - horas_turno/meta_por_hora: slots de 1h a partir do inicio do turno; slot com >= 30min de pausa
+#   tem meta 0 (regra do _cfgv2_apply_to_memory). meta_24: meta constante por hora do relogio
+#   (regra do detalhe-dia do historico).
+# - agenda_de(cfg) / agenda_turno_unico(inicio, fim) guardam a agenda compilada em cache.
+
+import json
+import re
+import threading
+from functools import lru_cache
+
+MIN_DIA = 24 * 60
+
+_HHMM_RE = re.compile(r"^(\d{1,2}):(\d{2})$")
+
+
+@lru_cache(maxsize=512)
+def hhmm_para_min(hhmm) -> int | None:
+    """'HH:MM' -> minutos do dia (None se invalido)."""
+    m = _HHMM_RE.match(str(hhmm or "").strip())
+    if not m:
+        return None
+    hh = int(m.group(1))
+    mm = int(m.group(2))
+    if hh < 0 or hh > 23 or mm < 0 or mm > 59:
+        return None
+    return hh * 60 + mm
+
+
+def duracao_turno(start_min: int, end_min: int) -> int:
+    if end_min <= start_min:
+        return (MIN_DIA - start_min) + end_min
+    return end_min - start_min
+
+
+def pausa_relativa(shift_start: int, br_start: int, br_end: int) -> tuple[int, int]:
+    # Converte break para eixo do turno (0..dur)
+    b0 = br_start
+    b1 = br_end
+    if b0 < shift_start:
+        b0 += MIN_DIA
+    if b1 < shift_start:
+        b1 += MIN_DIA
+    if b1 <= b0:
+        b1 += MIN_DIA
+    return (b0 - shift_start, b1 - shift_start)
+
+
+def _safe_int(v, default=0) -> int:
+    try:
+        return int(v)
+    except Exception:
+        return default
+
+
+# ============================================================
+# COMPILACAO
+# ============================================================
+def _compilar_turno(s: dict, rampa: int) -> dict | None:
+    if not isinstance(s, dict):
+        return None
+    start_min = hhmm_para_min(s.get("start"))
+    end_min = hhmm_para_min(s.get("end"))
+    if start_min is None or end_min is None:
+        return None
+    dur = duracao_turno(start_min, end_min)
+
+    pausas = []
+    for br in (s.get("breaks") or []):
+        if not isinstance(br, dict):
+            continue
+        b0 = hhmm_para_min(br.get("start"))
+        b1 = hhmm_para_min(br.get("end"))
+        if b0 is None or b1 is None:
+            continue
+        pausas.append(pausa_relativa(start_min, b0, b1))
+
+    # slots de 1h a partir do inicio (o ultimo pode ser parcial)
+    horas_turno = []
+    slot_pausa = []
+    t = 0
+    while t < dur:
+        t2 = min(dur, t + 60)
+        abs0 = (start_min + t) % MIN_DIA
+        abs1 = (start_min + t2) % MIN_DIA
+        horas_turno.append(f"{abs0//60:02d}:{abs0%60:02d} - {abs1//60:02d}:{abs1%60:02d}")
+
+        overlap = 0
+        for b0, b1 in pausas:
+            lo = max(t, b0)
+            hi = min(t2, b1)
+            if hi > lo:
+                overlap = max(overlap, hi - lo)
+        slot_pausa.append(overlap >= 30)
+        t = t2
+
+    meta_pcs = _safe_int(s.get("meta_pcs", 0) or 0, 0)
+    prod_slots = [i for i, isb in enumerate(slot_pausa) if not isb]
+    metas = [0 for _ in horas_turno]
+    if meta_pcs > 0 and prod_slots:
+        ramp = max(0, min(100, int(rampa or 0)))
+        qtd_prod = len(prod_slots)
+        meta_base = meta_pcs / qtd_prod
+        meta_primeira = round(meta_base * (ramp / 100))
+        if meta_primeira < 0:
+            meta_primeira = 0
+        if meta_primeira > meta_pcs:
+            meta_primeira = meta_pcs
+
+        restante = meta_pcs - meta_primeira
+        horas_restantes = qtd_prod - 1
+
+        metas[prod_slots[0]] = meta_primeira
+        if horas_restantes > 0:
+            base = restante // horas_restantes
+            sobra = restante % horas_restantes
+            for i in range(horas_restantes):
+                metas[prod_slots[i + 1]] = int(base + (1 if i < sobra else 0))
+
+    return {
+        "inicio": start_min,
+        "fim": end_min,
+        "dur": dur,
+        "meta_pcs": meta_pcs,
+        "pausas": pausas,
+        "horas_turno": horas_turno,
+        "slot_pausa": slot_pausa,
+        "meta_por_hora": metas,
+    }
+
+
+def _meta_24_turnos(shifts: list) -> list[int] | None:
+    """meta[24] por hora do relogio (regra do detalhe-dia do historico)."""
+    if not shifts:
+        return None
+
+    def _cruza(a_s, a_e, b_s, b_e):
+        return (a_s < b_e) and (b_s < a_e)
+
+    meta24 = [0] * 24
+    for sh in shifts:
+        if not isinstance(sh, dict):
+            continue
+        s_min = hhmm_para_min(sh.get("start"))
+        e_min = hhmm_para_min(sh.get("end"))
+        if s_min is None or e_min is None:
+            continue
+        if e_min <= s_min:
+            e_min += MIN_DIA  # vira o dia
+
+        br_intervals = []
+        for br in (sh.get("breaks") if isinstance(sh.get("breaks"), list) else []):
+            if not isinstance(br, dict):
+                continue
+            bs = hhmm_para_min(br.get("start"))
+            be = hhmm_para_min(br.get("end"))
+            if bs is None or be is None:
+                continue
+            if be <= bs:
+                be += MIN_DIA
+            # break antes do inicio num turno que vira o dia => pertence ao dia seguinte
+            if bs < s_min and e_min > MIN_DIA:
+                bs += MIN_DIA
+                be += MIN_DIA
+            br_intervals.append((bs, be))
+
+        meta_pcs = _safe_int(sh.get("meta_pcs"), 0)
+        planned_min = None
+        calc = sh.get("calc")
+        if isinstance(calc, dict):
+            planned_min = _safe_int(calc.get("planned_min"), 0)
+        if planned_min is None or planned_min <= 0:
+            planned_min = max(0, (e_min - s_min) - sum(max(0, be - bs) for bs, be in br_intervals))
+
+        planned_hours = planned_min / 60.0 if planned_min else 0.0
+        if meta_pcs <= 0 or planned_hours <= 0:
+            meta_h = 0
+        else:
+            meta_h = int(round(float(meta_pcs) / float(planned_hours)))
+
+        for hh in range(24):
+            h0_s = hh * 60
+            h0_e = (hh + 1) * 60
+            h1_s = h0_s + MIN_DIA
+            h1_e = h0_e + MIN_DIA
+            if not (_cruza(h0_s, h0_e, s_min, e_min) or _cruza(h1_s, h1_e, s_min, e_min)):
+                continue
+            em_pausa = False
+            for bs, be in br_intervals:
+                if _cruza(h0_s, h0_e, bs, be) or _cruza(h1_s, h1_e, bs, be):
+                    em_pausa = True
+                    break
+            if em_pausa:
+                meta24[hh] = 0
+            elif meta_h > meta24[hh]:
+                meta24[hh] = meta_h
+    return meta24
+
+
+class AgendaTurnos:
+    """
+    Agenda compilada de uma config de turnos. Consultas por minuto do dia (0..1439) em O(1):
+      turno_em / turno_ativo / slot / em_pausa / consultar / minutos_em_turno_ate / segundos_em_turno.
+    Imutavel depois de montada (pode ser compartilhada entre threads).
+    """
+
+    __slots__ = ("turnos", "dias_ativos", "_turno_min", "_pausa_min", "_acum", "_meta24", "_tem_turnos")
+
+    def __init__(self, shifts: list, active_days=None, rampa: int = 0):
+        shifts = shifts if isinstance(shifts, list) else []
+        self.turnos = [_compilar_turno(s, rampa) for s in shifts]
+        self._tem_turnos = bool(shifts)
+
+        try:
+            dias = {int(d) for d in (active_days or [])}
+        except Exception:
+            dias = set()
+        self.dias_ativos = frozenset(dias or {1, 2, 3, 4, 5, 6, 7})
+
+        # minuto -> indice do turno + 1 (0 = fora de turno); primeiro turno da lista vence
+        turno_min = bytearray(MIN_DIA)
+        pausa_min = bytearray(MIN_DIA)
+        for idx in range(len(self.turnos) - 1, -1, -1):
+            t = self.turnos[idx]
+            if t is None:
+                continue
+            for rel in range(t["dur"]):
+                minuto = (t["inicio"] + rel) % MIN_DIA
+                turno_min[minuto] = idx + 1
+                pausa_min[minuto] = 1 if any(b0 <= rel < b1 for b0, b1 in t["pausas"]) else 0
+        self._turno_min = bytes(turno_min)
+        self._pausa_min = bytes(pausa_min)
+
+        # acumulado de minutos em turno (acum[m] = minutos em turno em [0, m))
+        acum = [0] * (MIN_DIA + 1)
+        for i in range(MIN_DIA):
+            acum[i + 1] = acum[i] + (1 if turno_min[i] else 0)
+        self._acum = acum
+
+        self._meta24 = _meta_24_turnos(shifts)
+
+    # ---------------- consultas ----------------
+    def turno_em(self, minuto: int):
+        """Indice do turno que contem o minuto (ou None)."""
+        v = self._turno_min[int(minuto) % MIN_DIA]
+        return (v - 1) if v else None
+
+    def turno_ativo(self, minuto: int):
+        """Turno do minuto; fora de turno cai no primeiro (regra do _cfgv2_pick_shift)."""
+        idx = self.turno_em(minuto)
+        if idx is not None:
+            return idx
+        return 0 if self._tem_turnos else None
+
+    def slot(self, idx_turno: int, minuto: int):
+        """Slot de 1h (0..n-1) do turno para o minuto; None se o minuto cai depois do ultimo slot."""
+        t = self.turnos[idx_turno] if 0 <= idx_turno < len(self.turnos) else None
+        if t is None:
+            return None
+        s = ((int(minuto) - t["inicio"]) % MIN_DIA) // 60
+        return s if s < len(t["horas_turno"]) else None
+
+    def em_pausa(self, minuto: int) -> bool:
+        return bool(self._pausa_min[int(minuto) % MIN_DIA])
+
+    def dia_ativo(self, dia_semana: int) -> bool:
+        """dia_semana: 1=segunda .. 7=domingo."""
+        return int(dia_semana) in self.dias_ativos
+
+    def consultar(self, dia_semana: int, minuto: int) -> dict:
+        """{turno, slot, pausa, meta_slot, dia_ativo} do minuto do dia."""
+        idx = self.turno_em(minuto)
+        slot = self.slot(idx, minuto) if idx is not None else None
+        meta_slot = 0
+        if slot is not None:
+            meta_slot = int(self.turnos[idx]["meta_por_hora"][slot])
+        return {
+            "turno": idx,
+            "slot": slot,
+            "pausa": self.em_pausa(minuto) if idx is not None else False,
+            "meta_slot": meta_slot,
+            "dia_ativo": self.dia_ativo(dia_semana),
+        }
+
+    def meta_24(self, dia_semana: int):
+        """meta[24] do dia (zerada em dia inativo; None se nao ha turnos)."""
+        if not self.dia_ativo(dia_semana):
+            return [0] * 24
+        return list(self._meta24) if self._meta24 is not None else None
+
+    def minutos_em_turno_ate(self, minuto: int) -> int:
+        return self._acum[max(0, min(MIN_DIA, int(minuto)))]
+
+    def segundos_em_turno(self, dt0, dt1) -> int:
+        """Segundos de [dt0, dt1) dentro de algum turno (datetimes no fuso local da agenda)."""
+        if dt1 <= dt0:
+            return 0
+        return max(0, self._acumulado_seg(dt1) - self._acumulado_seg(dt0))
+
+    def _acumulado_seg(self, dt) -> int:
+        minuto = dt.hour * 60 + dt.minute
+        seg = dt.second
+        total = dt.toordinal() * self._acum[MIN_DIA] * 60 + self._acum[minuto] * 60
+        if self._turno_min[minuto]:
+            total += seg
+        return total
+
+
+# ============================================================
+# CACHE
+# ============================================================
+_CACHE_LOCK = threading.Lock()
+_CACHE_POR_ID: dict = {}
+_CACHE_POR_CONTEUDO: dict = {}
+_CACHE_MAX = 512
+
+
+def agenda_de(cfg_v2: dict | None):
+    """
+    Agenda compilada do config_v2 (None se nao for dict). O registro de config (machine_routes)
+    entrega sempre o mesmo objeto por versao, entao o caminho quente e 1 lookup por id; configs
+    lidas avulsas (ex.: historico) caem no cache por conteudo.
+    """
+    if not isinstance(cfg_v2, dict):
+        return None
+
+    hit = _CACHE_POR_ID.get(id(cfg_v2))
+    if hit is not None and hit[0] is cfg_v2:
+        return hit[1]
+
+    shifts = cfg_v2.get("shifts")
+    active_days = cfg_v2.get("active_days")
+    oee = cfg_v2.get("oee") if isinstance(cfg_v2.get("oee"), dict) else {}
+    rampa = _safe_int(oee.get("ramp_percent") or 0, 0)
+    try:
+        chave = json.dumps([shifts, active_days, rampa], sort_keys=True, default=str)
+    except Exception:
+        chave = None
+
+    with _CACHE_LOCK:
+        ag = _CACHE_POR_CONTEUDO.get(chave) if chave is not None else None
+    if ag is None:
+        ag = AgendaTurnos(shifts, active_days, rampa)
+
+    with _CACHE_LOCK:
+        if len(_CACHE_POR_ID) >= _CACHE_MAX:
+            _CACHE_POR_ID.clear()
+        if len(_CACHE_POR_CONTEUDO) >= _CACHE_MAX:
+            _CACHE_POR_CONTEUDO.clear()
+        _CACHE_POR_ID[id(cfg_v2)] = (cfg_v2, ag)
+        if chave is not None:
+            _CACHE_POR_CONTEUDO[chave] = ag
+    return ag
+
+
+@lru_cache(maxsize=256)
+def agenda_turno_unico(inicio, fim):
+    """Agenda de 1 turno legado (turno_inicio/turno_fim do estado da maquina); None se invalido."""
+    if hhmm_para_min(inicio) is None or hhmm_para_min(fim) is None:
+        return None
+    return AgendaTurnos([{"start": str(inicio).strip(), "end": str(fim).strip()}])
@@ -1,11 +1,16 @@
 # PATH: modules/machine_calc.py
-# LAST_RECODE: 2026-03-04 01:27 America/Bahia
-# MOTIVO: Virada de hora: usar horario do servidor para bucketing (zera na hora exata, independente de tela).
+# LAST_RECODE: 2026-10-18 01:50 America/Bahia
+# MOTIVO: Recalculo da diaria pela horaria recebe o cliente da maquina e soma/apaga/insere por machine_pk
+#         (a mesma chave do ingest; nada de 2a chave sem cliente).
 #
 # modules/machine_calc.py
+import threading
+from contextlib import contextmanager
 from datetime import datetime, time, timedelta
 from zoneinfo import ZoneInfo
 
+from modules.machine_agenda import MIN_DIA, hhmm_para_min
+
 UNIDADES_VALIDAS = {"pcs", "m", "m2"}
 
 # ============================================================
@@ -17,10 +22,28 @@ TZ_BAHIA = ZoneInfo("America/Bahia")
 DIA_OPERACIONAL_VIRA = time(00,1)
 
 
+# Relogio de replay: durante o reenvio de leituras bufferizadas (batch), o "agora" do pipeline
+# e o horario da leitura, para bucket de hora/NP/timeline cairem onde a peca foi produzida.
+_RELOGIO_LOCAL = threading.local()
+
+
 def now_bahia():
+    fixo = getattr(_RELOGIO_LOCAL, "agora", None)
+    if fixo is not None:
+        return fixo
     return datetime.now(TZ_BAHIA)
 
 
+@contextmanager
+def relogio_replay(agora: datetime):
+    anterior = getattr(_RELOGIO_LOCAL, "agora", None)
+    _RELOGIO_LOCAL.agora = agora
+    try:
+        yield agora
+    finally:
+        _RELOGIO_LOCAL.agora = anterior
+
+
 
 def agora_ref(m, fallback: datetime | None = None) -> datetime:
     """Hora de referência p/ bucket: prioriza timestamp do ESP; fallback backend."""
@@ -137,19 +160,12 @@ def salvar_conversao(m, data):
 # TURNO / HORA
 # ============================================================
 def get_turno_inicio_dt(m, agora):
-    inicio_str = m.get("turno_inicio")
-    if not inicio_str:
+    inicio_min = hhmm_para_min(m.get("turno_inicio"))
+    if inicio_min is None:
         return None
 
-    inicio_dt = datetime.strptime(inicio_str, "%H:%M")
-
     # garante data + fuso da Bahia
-    inicio_dt = inicio_dt.replace(
-        year=agora.year,
-        month=agora.month,
-        day=agora.day,
-        tzinfo=TZ_BAHIA
-    )
+    inicio_dt = datetime(agora.year, agora.month, agora.day, inicio_min // 60, inicio_min % 60, tzinfo=TZ_BAHIA)
 
     # turno atravessou meia-noite
     if agora < inicio_dt:
@@ -186,22 +202,12 @@ def calcular_ultima_hora_idx(m, agora: datetime | None = None):
     if isinstance(horas, (list, tuple)) and len(horas) == 24:
         return int(getattr(agora, 'hour', 0))
 
-    inicio_dt = get_turno_inicio_dt(m, agora)
-    if not inicio_dt:
-        return None
-
-    fim_dt = inicio_dt + timedelta(hours=len(horas))
-
-    if agora < inicio_dt:
+    # inicio ja em minutos (agenda compilada): horas desde o inicio do turno, sem strptime
+    inicio_min = hhmm_para_min(m.get("turno_inicio"))
+    if inicio_min is None:
         return None
 
-    if agora >= fim_dt:
-        return None
-
-    diff_h = int((agora - inicio_dt).total_seconds() // 3600)
-
-    if diff_h < 0:
-        return None
+    diff_h = ((int(agora.hour) * 60 + int(agora.minute) - inicio_min) % MIN_DIA) // 60
     if diff_h >= len(horas):
         return None
 
@@ -756,30 +762,36 @@ def reset_contexto(m, machine_id):
 
     if dia_ref is not None:
         conn = get_db()
-        cur = conn.cursor()
-    
-        # remove qualquer registro anterior desse dia (se existir)
         try:
+            cur = conn.cursor()
+
+            # remove qualquer registro anterior desse dia (se existir)
+            try:
+                cur.execute("""
+                    DELETE FROM producao_diaria
+                    WHERE machine_id = ? AND data = ?
+                """, (scoped_machine_id, dia_ref))
+            except Exception:
+                pass
+
             cur.execute("""
-                DELETE FROM producao_diaria
-                WHERE machine_id = ? AND data = ?
-            """, (scoped_machine_id, dia_ref))
+                INSERT INTO producao_diaria (machine_id, data, produzido, meta, percentual)
+                VALUES (?, ?, ?, ?, ?)
+            """, (
+                scoped_machine_id,
+                dia_ref,
+                int(m.get("producao_turno", 0) or 0),
+                int(m.get("meta_turno", 0) or 0),
+                int(m.get("percentual_turno", 0) or 0)
+            ))
+
+            conn.commit()
         except Exception:
-            pass
-    
-        cur.execute("""
-            INSERT INTO producao_diaria (machine_id, data, produzido, meta, percentual)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            scoped_machine_id,
-            dia_ref,
-            int(m.get("producao_turno", 0) or 0),
-            int(m.get("meta_turno", 0) or 0),
-            int(m.get("percentual_turno", 0) or 0)
-        ))
-    
-        conn.commit()
-        conn.close()
+            # DELETE sem o INSERT: desfaz antes de subir (conexao da thread e compartilhada)
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
 
     m["baseline_diario"] = m["esp_absoluto"]
     m["producao_turno"] = 0
@@ -909,6 +921,10 @@ except Exception:
     _TZ_BAHIA = None
 
 def _now_bahia_safe():
+    try:
+        return now_bahia()
+    except Exception:
+        pass
     try:
         return datetime.now(_TZ_BAHIA) if _TZ_BAHIA else datetime.now()
     except Exception:
@@ -923,26 +939,48 @@ def _dia_operacional_str_safe(dt):
     except Exception:
         return dt.date().isoformat()
 
-def _recalc_diaria_from_horaria_safe(machine_id, data_ref, meta_dia=0):
+def _recalc_diaria_from_horaria_safe(machine_id, data_ref, meta_dia=0, cliente_id=None):
+    conn = None
     try:
         from modules.db_indflow import get_db
+        from modules.machine_registry import machine_pk
         conn = get_db()
         cur = conn.cursor()
-        cur.execute(
-            "SELECT COALESCE(SUM(produzido),0) FROM producao_horaria WHERE machine_id=? AND data_ref=?",
-            (machine_id, data_ref),
-        )
+        # machine_pk ja resolvida (mapa em memoria) com o cliente da maquina: a mesma chave do ingest
+        # (sem ela o trigger cadastrava uma 2a chave ('', code) e a diaria ficava dividida)
+        pk = machine_pk(cliente_id, machine_id, conn=conn)
+        if pk is not None:
+            cur.execute(
+                "SELECT COALESCE(SUM(produzido),0) FROM producao_horaria WHERE machine_pk=? AND data_ref=?",
+                (pk, data_ref),
+            )
+        else:
+            cur.execute(
+                "SELECT COALESCE(SUM(produzido),0) FROM producao_horaria WHERE machine_id=? AND data_ref=?",
+                (machine_id, data_ref),
+            )
         produzido_dia = int(cur.fetchone()[0] or 0)
         percentual = int((produzido_dia / meta_dia) * 100) if meta_dia and meta_dia > 0 else None
-        cur.execute("DELETE FROM producao_diaria WHERE machine_id=? AND data=?", (machine_id, data_ref))
+        if pk is not None:
+            cur.execute("DELETE FROM producao_diaria WHERE machine_pk=? AND data=?", (pk, data_ref))
+        else:
+            cur.execute("DELETE FROM producao_diaria WHERE machine_id=? AND data=?", (machine_id, data_ref))
         cur.execute(
-            "INSERT INTO producao_diaria (machine_id, data, produzido, meta, percentual) VALUES (?,?,?,?,?)",
-            (machine_id, data_ref, produzido_dia, meta_dia or 0, percentual),
+            "INSERT INTO producao_diaria (machine_id, cliente_id, data, produzido, meta, percentual, machine_pk) "
+            "VALUES (?,?,?,?,?,?,?)",
+            (machine_id, cliente_id, data_ref, produzido_dia, meta_dia or 0, percentual, pk),
         )
         conn.commit()
-        conn.close()
     except Exception:
-        pass
+        # DELETE sem o INSERT nao pode ficar pendente na conexao (compartilhada) da thread
+        if conn is not None:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+    finally:
+        if conn is not None:
+            conn.close()
 
 # Hook nao-invasivo: se existir atualizar_producao_hora, envolve com recalc diaria
 if "atualizar_producao_hora" in globals():
@@ -956,7 +994,7 @@ if "atualizar_producao_hora" in globals():
                 dt = _now_bahia_safe()
                 data_ref = _dia_operacional_str_safe(dt)
                 meta_dia = int(m.get("meta_turno", 0) or 0) if isinstance(m, dict) else 0
-                _recalc_diaria_from_horaria_safe(machine_id, data_ref, meta_dia)
+                _recalc_diaria_from_horaria_safe(machine_id, data_ref, meta_dia, m.get("cliente_id"))
         except Exception:
             pass
         return res
@@ -1,11 +1,12 @@
 # Caminho: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\machine_calc_nao_programado.py
-# Último recode: 2026-01-21 22:55 (America/Bahia)
-# Motivo: Corrigir baseline do NP por hora: np_hour_baseline deve ancorar no esp_absoluto (contador real), não no acumulado np_producao. Evita explosão (baseline pequeno tipo 3071) e garante np_producao_hora consistente.
+# Último recode: 2026-10-17 20:30 (America/Bahia)
+# Motivo: upsert_np_horaria mantém o cache NP 24h do repo (nao_programado_horaria_repo) em dia com o total gravado.
 
 from datetime import datetime, time, timedelta
 from zoneinfo import ZoneInfo
 
-from modules.db_indflow import get_db
+from modules.db_indflow import get_db, schema_ready
+from modules.repos.nao_programado_horaria_repo import upsert_absoluto_cache
 
 TZ_BAHIA = ZoneInfo("America/Bahia")
 
@@ -78,6 +79,9 @@ def _ensure_np_table(conn) -> None:
     Tabela diária para persistir hora extra / fora do planejado.
     Mantém np_producao (dia) e np_minutos (dia) + controle de hora atual (baseline).
     """
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute("""
         CREATE TABLE IF NOT EXISTS nao_programado_diario (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -175,6 +179,9 @@ def _upsert_np_diario_to_db(machine_id: str, data_ref: str, np_producao: int, np
 # ✅ NOVO: PERSISTÊNCIA - HORA (para "não sumir" ao virar a hora)
 # ============================================================
 def _ensure_np_horaria_table(conn) -> None:
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute("""
         CREATE TABLE IF NOT EXISTS nao_programado_horaria (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -220,6 +227,7 @@ def upsert_np_horaria(machine_id: str, data_ref: str, hora_dia: int, produzido:
             (machine_id, (data_ref or "").strip(), int(hora_dia), int(produzido), updated_at),
         )
         conn.commit()
+        upsert_absoluto_cache(machine_id, data_ref, hora_dia, produzido)
     finally:
         conn.close()
 
@@ -0,0 +1,115 @@
+# PATH: modules/machine_registry.py
+# LAST_RECODE: 2026-10-18 01:50 America/Bahia
+# MOTIVO: machine_pk sem cliente resolve para a chave do dono unico da maquina (no shard, do cliente do
+#         shard) em vez de criar a 2a chave ('', code).
+
+import threading
+from datetime import datetime
+
+from modules.db_indflow import cliente_atual, em_shard, get_db, get_db_path_atual, on_rollback
+
+# (banco, cliente_id, code) -> machine_pk (com shard por cliente cada banco tem as suas chaves)
+_MAPA: dict = {}
+# prefixo minusculo -> cliente_id cadastrado ('' = nao e cliente)
+_PREFIXOS: dict = {}
+_LOCK = threading.Lock()
+
+
+def chave_maquina(cliente_id: str | None, machine_id: str, conn=None) -> tuple[str, str]:
+    """
+    (cliente_id, code) da maquina. Mesma regra do backfill/trigger da migracao 10:
+      - cliente: cliente_id informado; sem ele, o prefixo '<cliente>::' se for cliente cadastrado
+      - code: machine_id minusculo sem o prefixo '<cliente>::'
+    """
+    mid = (machine_id or "").strip().lower()
+    cli = (cliente_id or "").strip()
+    if not cli and "::" in mid:
+        cli = _cliente_do_prefixo(mid.split("::", 1)[0], conn)
+    if cli and mid.startswith(cli.lower() + "::"):
+        mid = mid[len(cli) + 2:]
+    return cli, mid
+
+
+def _cliente_do_prefixo(prefixo: str, conn=None) -> str:
+    with _LOCK:
+        hit = _PREFIXOS.get(prefixo)
+    if hit is not None:
+        return hit
+    c = conn or get_db()
+    try:
+        row = c.execute("SELECT id FROM clientes WHERE lower(id) = ? LIMIT 1", (prefixo,)).fetchone()
+    except Exception:
+        row = None
+    finally:
+        if conn is None:
+            c.close()
+    cli = str(row[0]) if row else ""
+    with _LOCK:
+        _PREFIXOS[prefixo] = cli
+    return cli
+
+
+def machine_pk(cliente_id: str | None, machine_id: str, criar: bool = True, conn=None) -> int | None:
+    """
+    Chave inteira da maquina. Cache em memoria; no miss busca em machines e, com criar=True,
+    cadastra (INSERT OR IGNORE). Dentro de unidade de trabalho, rollback tira a entrada do cache.
+    Sem cliente (escritor legado): mesma regra do trigger da migracao 12 — maquina de um unico
+    cliente usa a chave dele; no shard, a do cliente do shard. Nunca cria a 2a chave ('', code).
+    """
+    if not (machine_id or "").strip():
+        return None
+    cli, code = chave_maquina(cliente_id, machine_id, conn)
+    chave = (get_db_path_atual(), cli, code)
+    with _LOCK:
+        pk = _MAPA.get(chave)
+    if pk is not None:
+        return pk
+
+    c = conn or get_db()
+    try:
+        row = None
+        if not cli:
+            donos = c.execute(
+                "SELECT id FROM machines WHERE code = ? AND cliente_id <> '' LIMIT 2", (code,)
+            ).fetchall()
+            if len(donos) == 1:
+                row = donos[0]
+            elif not donos and em_shard() and cliente_atual():
+                cli = cliente_atual()
+        if row is None:
+            row = c.execute("SELECT id FROM machines WHERE cliente_id = ? AND code = ?", (cli, code)).fetchone()
+        if row is None and criar:
+            c.execute(
+                "INSERT OR IGNORE INTO machines (cliente_id, code, created_at) VALUES (?, ?, ?)",
+                (cli, code, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+            )
+            row = c.execute("SELECT id FROM machines WHERE cliente_id = ? AND code = ?", (cli, code)).fetchone()
+            if row is not None:
+                on_rollback(lambda: esquecer(chave))
+                if cli:
+                    # chave sem cliente em cache passa a resolver para este dono
+                    esquecer((chave[0], "", code))
+                if conn is None:
+                    c.commit()
+    except Exception:
+        row = None
+    finally:
+        if conn is None:
+            c.close()
+
+    if row is None:
+        return None
+    pk = int(row[0])
+    with _LOCK:
+        _MAPA[chave] = pk
+    return pk
+
+
+def esquecer(chave: tuple | None = None) -> None:
+    """Tira 1 chave (ou tudo, sem argumento) do cache. Ex.: rollback, hard reset, troca de banco."""
+    with _LOCK:
+        if chave is None:
+            _MAPA.clear()
+            _PREFIXOS.clear()
+        else:
+            _MAPA.pop(chave, None)
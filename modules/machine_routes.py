@@ -1,6 +1,7 @@
 # Arquivo: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\machine_routes.py
-# Ultimo recode: 2026-03-06 01:45:34 -0300
-# Motivo: Fazer o /machine/update consumir e limpar corretamente a pendencia de troca de bobina, evitando travar da segunda para a terceira bobina.
+# Ultimo recode: 2026-10-18 02:10:00 -0300
+# Motivo: docstring de _registrar_evento_producao: leitura so com ts_ms chega com seq 0 (UNIQUE do banco);
+#         seq None so com ts do servidor, sem dedupe no banco (check_idempotencia.py).
 
 # PATH: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\producao\machine_routes.py
 # LAST_RECODE: 2026-03-05 19:46 America/Bahia
@@ -8,15 +9,38 @@
 
 import os
 import json
+import logging
+import queue
+import time
 import sqlite3
 import hashlib
 import uuid
 import re
+import threading
+from contextlib import contextmanager
 from urllib.parse import urlencode
-from flask import Blueprint, request, jsonify, render_template, session, redirect, url_for
+from flask import Blueprint, Response, request, jsonify, render_template, session, redirect, url_for
 from datetime import datetime, timedelta
-from modules.db_indflow import get_db
-from modules.machine_state import get_machine
+from modules.db_indflow import (
+    get_db,
+    get_db_leitura,
+    unit_of_work,
+    on_rollback,
+    em_shard,
+    exigir_central,
+    schema_ready,
+    pool_stats,
+    shard_ativo,
+    definir_cliente_atual,
+    usar_cliente,
+)
+from modules import event_journal, machine_status_view
+from modules.machine_registry import chave_maquina, machine_pk
+from modules.machine_agenda import agenda_de, agenda_turno_unico, hhmm_para_min, duracao_turno, pausa_relativa
+from modules.machine_state import (
+    get_machine, get_last_state, set_last_state, forget_last_states, reset_stop_clocks,
+    bump_version, bump_all_versions, etag_for_version, machine_data, lock_maquina,
+)
 from modules.machine_calc import (
     aplicar_unidades,
     salvar_conversao,
@@ -28,21 +52,32 @@ from modules.machine_calc import (
     aplicar_derivados_ml,
     carregar_baseline_diario,
     now_bahia,
+    relogio_replay,
     dia_operacional_ref_str,
     TZ_BAHIA,
 )
 from modules.machine_service import processar_nao_programado
-from modules.repos.nao_programado_horaria_repo import load_np_por_hora_24
+from modules.repos.nao_programado_horaria_repo import load_np_por_hora_24, load_np_por_hora_24_many, invalidar_np_cache
 from modules.repos.machine_config_repo import upsert_machine_config
-from modules.repos.refugo_repo import load_refugo_24, upsert_refugo
+from modules.repos.refugo_repo import load_refugo_24, load_refugo_24_many, upsert_refugo, invalidar_refugo_cache
 from modules.admin.routes import login_required
+from modules.clientes.services import get_cliente_by_api_key_hash
 
 from modules.machine.device_helpers import (
     norm_device_id,
-    touch_device_seen,
     get_machine_from_device,
+    device_registry_get,
+    device_registry_update,
+    device_registry_forget,
+    mark_device_seen,
+    get_seq_from_payload,
+    leitura_chave,
+    leitura_duplicada,
+    marcar_leitura_processada,
 )
 
+log = logging.getLogger("indflow")
+
 machine_bp = Blueprint("machine_bp", __name__)
 
 
@@ -57,6 +92,9 @@ machine_bp = Blueprint("machine_bp", __name__)
 # =====================================================
 
 def _ensure_op_bobina_eventos_table(conn: sqlite3.Connection) -> None:
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS ordens_producao_bobina_eventos (
@@ -205,6 +243,9 @@ def _create_bobina_event(conn: sqlite3.Connection, op_id: int, seq: int, comprim
 
 
 def _ensure_op_bobina_pendencia_table(conn: sqlite3.Connection) -> None:
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS ordens_producao_bobina_pendencia (
@@ -344,6 +385,9 @@ def _maybe_open_next_bobina_on_update(conn: sqlite3.Connection, machine_id: str,
     _create_bobina_event(conn, op_id, next_seq, bobinas[next_seq], ts_iso, int(esp_now), created_at)
 
 def _ensure_machine_op_fila_table(conn: sqlite3.Connection) -> None:
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS machine_op_fila (
@@ -719,6 +763,9 @@ def _ensure_machine_state_event_schema(conn: sqlite3.Connection) -> None:
 
     Salva apenas transicoes (quando muda de RUN/STOP/NP).
     """
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute(
         "CREATE TABLE IF NOT EXISTS machine_state_event ("
         "id INTEGER PRIMARY KEY AUTOINCREMENT, "
@@ -729,7 +776,8 @@ def _ensure_machine_state_event_schema(conn: sqlite3.Connection) -> None:
         "ts_iso TEXT NOT NULL, "
         "data_ref TEXT NOT NULL, "
         "hora_idx INTEGER NOT NULL, "
-        "state TEXT NOT NULL"
+        "state TEXT NOT NULL, "
+        "machine_pk INTEGER"
         ")"
     )
     conn.execute(
@@ -758,6 +806,75 @@ def _get_last_machine_state(conn: sqlite3.Connection, effective_machine_id: str,
         return None
 
 
+# ============================================================
+# EVENTOS EM LOTE (/machine/update/batch)
+# ============================================================
+# Enquanto um lote esta aberto na thread, producao_evento e machine_state_event sao
+# acumulados em memoria e gravados no fim com executemany (mesma transacao do lote).
+_EVT_LOTE_LOCAL = threading.local()
+
+
+def _eventos_lote_atual() -> dict | None:
+    return getattr(_EVT_LOTE_LOCAL, "lote", None)
+
+
+@contextmanager
+def _eventos_em_lote():
+    lote = {"producao_evento": [], "machine_state_event": []}
+    _EVT_LOTE_LOCAL.lote = lote
+    try:
+        yield lote
+    except Exception:
+        # transicoes nao gravadas: o indice de ultimo estado volta a refletir o banco
+        for eff in {r[1] for r in (lote.get("machine_state_event") or [])}:
+            forget_last_states(eff)
+        raise
+    finally:
+        _EVT_LOTE_LOCAL.lote = None
+
+
+def _flush_eventos_lote(lote: dict) -> dict:
+    """Grava os eventos acumulados (executemany). Retorna contagem por tabela."""
+    evts = lote.get("producao_evento") or []
+    states = lote.get("machine_state_event") or []
+    if not evts and not states:
+        return {"producao_evento": 0, "machine_state_event": 0}
+
+    if event_journal.journal_enabled():
+        event_journal.enqueue_many("producao_evento", evts)
+        for row in states:
+            event_journal.enqueue(
+                "machine_state_event", row, chave=(row[1], row[2]), valor={"state": row[7], "ts_ms": row[3]}
+            )
+        lote["producao_evento"] = []
+        lote["machine_state_event"] = []
+        return {"producao_evento": len(evts), "machine_state_event": len(states)}
+
+    conn = get_db()
+    try:
+        if evts:
+            _ensure_producao_evento_table(conn)
+            conn.executemany(
+                "INSERT OR IGNORE INTO producao_evento (cliente_id, machine_id, ts_ms, esp_absoluto, delta, created_at, device_id, seq, machine_pk) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                evts,
+            )
+        if states:
+            _ensure_machine_state_event_schema(conn)
+            conn.executemany(
+                "INSERT INTO machine_state_event (machine_id, effective_machine_id, cliente_id, ts_ms, ts_iso, data_ref, hora_idx, state, machine_pk) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                states,
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+    lote["producao_evento"] = []
+    lote["machine_state_event"] = []
+    return {"producao_evento": len(evts), "machine_state_event": len(states)}
+
+
 def _record_machine_state_transition(
     raw_machine_id: str,
     effective_machine_id: str,
@@ -777,18 +894,40 @@ def _record_machine_state_transition(
     ts_ms = int(agora.timestamp() * 1000)
     ts_iso = agora.isoformat()
 
+    # Indice em memoria (primado no startup, write-through aqui): sem SELECT por request
+    if get_last_state(effective_machine_id, cliente_id) == st:
+        return
+    set_last_state(effective_machine_id, cliente_id, st, ts_ms)
+    # unidade de trabalho desfeita: a transicao nao foi gravada, o indice volta ao banco
+    on_rollback(lambda: forget_last_states(effective_machine_id))
+
+    key = (effective_machine_id, cliente_id)
+    row = (
+        raw_machine_id, effective_machine_id, cliente_id, ts_ms, ts_iso, data_ref, int(hora_idx), st,
+        machine_pk(cliente_id, effective_machine_id),
+    )
+
+    lote = _eventos_lote_atual()
+    if lote is not None:
+        lote["machine_state_event"].append(row)
+        return
+
+    if event_journal.journal_enabled():
+        event_journal.enqueue("machine_state_event", row, chave=key, valor={"state": st, "ts_ms": ts_ms})
+        return
+
     conn = get_db()
     try:
         _ensure_machine_state_event_schema(conn)
-        last = _get_last_machine_state(conn, effective_machine_id, cliente_id)
-        if last and str(last.get("state") or "").upper() == st:
-            return
         conn.execute(
-            "INSERT INTO machine_state_event (machine_id, effective_machine_id, cliente_id, ts_ms, ts_iso, data_ref, hora_idx, state) "
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (raw_machine_id, effective_machine_id, cliente_id, ts_ms, ts_iso, data_ref, int(hora_idx), st),
+            "INSERT INTO machine_state_event (machine_id, effective_machine_id, cliente_id, ts_ms, ts_iso, data_ref, hora_idx, state, machine_pk) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            row,
         )
         conn.commit()
+    except Exception:
+        forget_last_states(effective_machine_id)
+        raise
     finally:
         conn.close()
 
@@ -868,38 +1007,13 @@ def _calc_produzido_from_ops(ops: list) -> int:
 
     return int(total)
 
-def _parse_hhmm(hhmm: str) -> tuple[int, int] | None:
-    try:
-        h_str, m_str = (hhmm or "").strip().split(":", 1)
-        h = int(h_str)
-        m = int(m_str)
-        if 0 <= h <= 23 and 0 <= m <= 59:
-            return (h, m)
-    except Exception:
-        pass
-    return None
-
 def _calc_minutos_parados_somente_turno(start_ms: int, end_ms: int, turno_inicio: str | None, turno_fim: str | None) -> int:
-    ini = _parse_hhmm(turno_inicio or "")
-    fim = _parse_hhmm(turno_fim or "")
-    if ini is None or fim is None or end_ms <= start_ms:
+    agenda = agenda_turno_unico(turno_inicio, turno_fim)
+    if agenda is None or end_ms <= start_ms:
         return 0
     a0 = datetime.fromtimestamp(int(start_ms) / 1000, TZ_BAHIA)
     a1 = datetime.fromtimestamp(int(end_ms) / 1000, TZ_BAHIA)
-    d = a0.date() - timedelta(days=1)
-    d_end = a1.date() + timedelta(days=1)
-    total = 0
-    while d <= d_end:
-        s = datetime(d.year, d.month, d.day, ini[0], ini[1], 0, tzinfo=TZ_BAHIA)
-        e = datetime(d.year, d.month, d.day, fim[0], fim[1], 0, tzinfo=TZ_BAHIA)
-        if e <= s:
-            e = e + timedelta(days=1)
-        x0 = a0 if a0 > s else s
-        x1 = a1 if a1 < e else e
-        if x1 > x0:
-            total += int((x1 - x0).total_seconds())
-        d = d + timedelta(days=1)
-    return int(total // 60)
+    return int(agenda.segundos_em_turno(a0, a1) // 60)
 
 def _sum_refugo_24(machine_id: str, dia_ref: str) -> int:
     """
@@ -923,10 +1037,11 @@ def _sum_eventos_por_dia(cliente_id: str | None, machine_id: str, inicio: str, f
 
     IMPORTANTE:
     - Em ambiente multi-tenant, a tabela pode conter linhas com machine_id "limpo" (ex: maquina004)
-      e também "scoped" (ex: <cliente_id>::maquina004).
+      e também "scoped" (ex: <cliente_id>::maquina004). As duas tem a mesma machine_pk.
     - Somar os dois ao mesmo tempo dobra o resultado.
-    - Portanto, quando cliente_id existir, priorizamos SEMPRE o scoped_mid.
-      Se não houver dados scoped, fazemos fallback para o mid legado.
+    - Portanto 1 consulta por machine_pk (indice) separando por (machine_id, cliente_id) e usando
+      so a primeira variante com dados, na mesma prioridade de antes: scoped + cliente, mid + cliente,
+      scoped sem cliente, mid sem cliente.
     """
     mid = _norm_machine_id(_unscope_machine_id(machine_id))
 
@@ -949,57 +1064,42 @@ def _sum_eventos_por_dia(cliente_id: str | None, machine_id: str, inicio: str, f
 
         scoped_mid = f"{cliente_id}::{mid}" if cliente_id else None
 
-        def _query_sum(cfilter: str | None, mid_value: str) -> dict:
-            params = []
-            where_parts = []
-
-            if cfilter:
-                where_parts.append("cliente_id = ?")
-                params.append(cfilter)
-
-            where_parts.append("machine_id = ?")
-            params.append(mid_value)
-
-            where_parts.append("ts_ms >= ?")
-            where_parts.append("ts_ms <= ?")
-            params.extend([start_ms, end_ms])
-
-            where = " AND ".join(where_parts)
-
-            sql = f"""
+        def _query_sum(pk: int) -> dict:
+            cur = conn.execute(
+                """
                 SELECT
+                  machine_id,
+                  cliente_id,
                   date(ts_ms/1000, 'unixepoch', '-3 hours') AS dia_ref,
                   SUM(COALESCE(delta, 0)) AS produzido
                 FROM producao_evento
-                WHERE {where}
-                GROUP BY dia_ref
-                ORDER BY dia_ref DESC
-            """
-
-            cur = conn.execute(sql, tuple(params))
-            out_local = {}
+                WHERE machine_pk = ? AND ts_ms >= ? AND ts_ms <= ?
+                GROUP BY machine_id, cliente_id, dia_ref
+                """,
+                (pk, start_ms, end_ms),
+            )
+            por_variante = {}
             for r in cur.fetchall():
-                dia = (r[0] or "").strip()
-                out_local[dia] = _safe_int(r[1], 0)
-            return out_local
-
-        # =====================================================
-        # 1) Se tiver cliente_id: tenta scoped + filtro cliente_id
-        # 2) Fallback: legado (mid limpo) + filtro cliente_id
-        # 3) Se ainda vazio e cliente_id existe: tenta sem filtro cliente_id (banco legado)
-        # =====================================================
-        if cliente_id and scoped_mid:
-            out = _query_sum(cliente_id, scoped_mid)
-            if not out:
-                out = _query_sum(cliente_id, mid)
-            if not out:
-                out = _query_sum(None, scoped_mid)
-            if not out:
-                out = _query_sum(None, mid)
-            return out
-
-        # Sem cliente_id: usa apenas o mid limpo
-        return _query_sum(None, mid)
+                dia = (r[2] or "").strip()
+                por_variante.setdefault((str(r[0] or ""), r[1] or None), {})[dia] = _safe_int(r[3], 0)
+            if not por_variante:
+                return {}
+            for variante in ((scoped_mid, cliente_id), (mid, cliente_id), (scoped_mid, None), (mid, None)):
+                if variante[0] and variante in por_variante:
+                    return por_variante[variante]
+            return next(iter(por_variante.values()))
+
+        out = {}
+        pk = machine_pk(cliente_id, mid, criar=False, conn=conn)
+        if pk is not None:
+            out = _query_sum(pk)
+
+        # Banco legado: eventos gravados sem cliente_id ficam na maquina "sem cliente"
+        if not out and cliente_id:
+            pk_legado = machine_pk(None, mid, criar=False, conn=conn)
+            if pk_legado is not None and pk_legado != pk:
+                out = _query_sum(pk_legado)
+        return out
 
     finally:
         conn.close()
@@ -1099,20 +1199,13 @@ def _get_cliente_from_api_key() -> dict | None:
 
     api_key_hash = hashlib.sha256(api_key.encode()).hexdigest()
 
-    conn = get_db()
-    try:
-        cur = conn.execute(
-            "SELECT id, nome, status FROM clientes WHERE api_key_hash = ?",
-            (api_key_hash,),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        if (row["status"] or "").strip().lower() != "active":
-            return None
-        return {"id": row["id"], "nome": row["nome"], "status": row["status"]}
-    finally:
-        conn.close()
+    # Cache TTL (modules/clientes/services.py), invalidado pelo CRUD de clientes
+    row = get_cliente_by_api_key_hash(api_key_hash)
+    if not row:
+        return None
+    if (row.get("status") or "").strip().lower() != "active":
+        return None
+    return {"id": row["id"], "nome": row["nome"], "status": row["status"]}
 
 def _get_cliente_id_for_request() -> str | None:
     """
@@ -1131,6 +1224,24 @@ def _get_cliente_id_for_request() -> str | None:
 
     return None
 
+# Shard por cliente (INDFLOW_SHARD_MODE=cliente): o request roda no banco do cliente resolvido acima.
+# Cadastros (admin/clientes/devices) continuam no banco central.
+_BLUEPRINTS_CENTRAIS = {"admin", "clientes", "devices"}
+
+@machine_bp.before_app_request
+def _rotear_cliente_request():
+    if not shard_ativo() or request.blueprint in _BLUEPRINTS_CENTRAIS:
+        return None
+    try:
+        definir_cliente_atual(_get_cliente_id_for_request())
+    except Exception:
+        definir_cliente_atual(None)
+    return None
+
+@machine_bp.teardown_app_request
+def _soltar_cliente_request(_exc=None):
+    definir_cliente_atual(None)
+
 def _get_ts_ms_from_payload(data: dict) -> int | None:
     """
     Timestamp preferencial vindo do ESP (epoch ms).
@@ -1197,6 +1308,8 @@ def _enrich_ops_with_esp_counts(conn, cliente_id: str, machine_id: str, rows: li
         return
 
     cur = conn.cursor()
+    # producao_evento grava machine_id minusculo: igualdade usa o indice (cliente_id, machine_id, ts_ms)
+    mid = str(machine_id).strip().lower()
 
     now_ms = int(datetime.now(TZ_BAHIA).timestamp() * 1000)
 
@@ -1228,11 +1341,11 @@ def _enrich_ops_with_esp_counts(conn, cliente_id: str, machine_id: str, rows: li
                     MAX(esp_absoluto) AS esp_fim
                 FROM producao_evento
                 WHERE cliente_id = ?
-                  AND lower(machine_id) = lower(?)
+                  AND machine_id = ?
                   AND ts_ms >= ?
                   AND ts_ms <= ?
                 """,
-                (cliente_id, machine_id, int(start_ms), int(end_ms)),
+                (cliente_id, mid, int(start_ms), int(end_ms)),
             ).fetchone()
 
             if row_sum:
@@ -1274,6 +1387,9 @@ def _backfill_producao_diaria_cliente_id_all(machine_id: str, cliente_id: str) -
         conn.close()
 
 def _ensure_devices_table_min(conn):
+    # schema criado pelas migracoes do init_db (schema_version); no shard a tabela fica no central
+    if schema_ready() or em_shard():
+        return
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS devices (
@@ -1303,84 +1419,93 @@ def _ensure_devices_table_min(conn):
     conn.commit()
 
 def _upsert_device_for_cliente(device_id: str, cliente_id: str, now_str: str, allow_takeover: bool = False) -> bool:
-    conn = get_db()
-    try:
-        _ensure_devices_table_min(conn)
-
-        cur = conn.execute("SELECT device_id, cliente_id FROM devices WHERE device_id = ? LIMIT 1", (device_id,))
-        row = cur.fetchone()
+    """
+    Garante o device do ESP vinculado ao cliente.
+    Usa o registro em memoria (device_helpers): no caminho normal (device ja conhecido e do mesmo
+    cliente) nao escreve nada; last_seen vai coalescido.
+    Dentro de unit_of_work() o registro passa a refletir uma escrita ainda nao commitada:
+    on_rollback esquece o device (proxima leitura volta ao banco). Com shard a escrita vai ao
+    central: a unidade precisa ter sido aberta com central=True (_update_escreve_central).
+    """
+    entry = device_registry_get(device_id)
 
-        if row is None:
+    if entry is None:
+        exigir_central()
+        conn = get_db()
+        try:
+            _ensure_devices_table_min(conn)
             conn.execute(
                 """
                 INSERT INTO devices (device_id, cliente_id, machine_id, alias, created_at, last_seen)
                 VALUES (?, ?, NULL, NULL, ?, ?)
+                ON CONFLICT(device_id) DO NOTHING
             """,
                 (device_id, cliente_id, now_str, now_str),
             )
             conn.commit()
-            return True
+        finally:
+            conn.close()
+        device_registry_forget(device_id)
+        on_rollback(lambda: device_registry_forget(device_id))
+        entry = device_registry_get(device_id) or {"cliente_id": cliente_id}
 
-        try:
-            owner = row["cliente_id"]
-        except Exception:
-            owner = row[1] if len(row) > 1 else None
+    owner = entry.get("cliente_id")
 
-        if owner and owner != cliente_id:
-            if allow_takeover:
-                conn.execute(
-                    """
-                    UPDATE devices
-                       SET cliente_id = ?,
-                           last_seen = ?
-                     WHERE device_id = ?
-                """,
-                    (cliente_id, now_str, device_id),
-                )
-                conn.commit()
-                return True
+    if owner and owner != cliente_id:
+        if not allow_takeover:
             return False
+        exigir_central()
+        conn = get_db()
+        try:
+            conn.execute(
+                """
+                UPDATE devices
+                   SET cliente_id = ?,
+                       last_seen = ?
+                 WHERE device_id = ?
+            """,
+                (cliente_id, now_str, device_id),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        device_registry_update(device_id, cliente_id=cliente_id)
+        on_rollback(lambda: device_registry_forget(device_id))
+        return True
 
-        conn.execute(
-            """
-            UPDATE devices
-               SET last_seen = ?,
-                   cliente_id = COALESCE(cliente_id, ?)
-             WHERE device_id = ?
-        """,
-            (now_str, cliente_id, device_id),
-        )
-        conn.commit()
+    if not owner:
+        exigir_central()
+        conn = get_db()
+        try:
+            conn.execute(
+                """
+                UPDATE devices
+                   SET last_seen = ?,
+                       cliente_id = COALESCE(cliente_id, ?)
+                 WHERE device_id = ?
+            """,
+                (now_str, cliente_id, device_id),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        device_registry_update(device_id, cliente_id=cliente_id)
+        on_rollback(lambda: device_registry_forget(device_id))
         return True
 
-    finally:
-        conn.close()
+    mark_device_seen(device_id, now_str)
+    return True
 
 def _get_linked_machine_for_cliente(device_id: str, cliente_id: str) -> str | None:
-    conn = get_db()
-    try:
-        _ensure_devices_table_min(conn)
-        cur = conn.execute(
-            """
-            SELECT machine_id
-              FROM devices
-             WHERE device_id = ?
-               AND cliente_id = ?
-             LIMIT 1
-        """,
-            (device_id, cliente_id),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        try:
-            return row["machine_id"] or None
-        except Exception:
-            return row[0] or None
-    finally:
-        conn.close()
+    entry = device_registry_get(device_id)
+    if not entry or entry.get("cliente_id") != cliente_id:
+        return None
+    return entry.get("machine_id") or None
 
 def _ensure_machine_stop_table(conn):
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS machine_stop (
@@ -1396,27 +1521,14 @@ def _ensure_machine_stop_table(conn):
         pass
     conn.commit()
 
-def _get_stopped_since_ms(machine_id: str) -> int | None:
-    conn = get_db()
-    try:
-        _ensure_machine_stop_table(conn)
-        cur = conn.execute("SELECT stopped_since_ms FROM machine_stop WHERE machine_id = ? LIMIT 1", (machine_id,))
-        row = cur.fetchone()
-        if not row:
-            return None
-        try:
-            v = row["stopped_since_ms"]
-        except Exception:
-            v = row[0]
-        try:
-            iv = int(v)
-            return iv if iv > 0 else None
-        except Exception:
-            return None
-    finally:
-        conn.close()
+# Relogio de parada: m["stopped_since_ms"] (carregado 1x em get_machine) e a fonte;
+# machine_stop so recebe escrita quando a maquina para (INSERT) ou volta a rodar (DELETE).
+def _stop_clock_iniciar(m: dict, machine_id: str, stopped_since_ms: int, updated_at: str) -> int:
+    """Marca a parada se ainda nao estiver parada. Retorna o stopped_since_ms vigente."""
+    atual = m.get("stopped_since_ms")
+    if isinstance(atual, int) and atual > 0:
+        return atual
 
-def _set_stopped_since_ms(machine_id: str, stopped_since_ms: int, updated_at: str):
     conn = get_db()
     try:
         _ensure_machine_stop_table(conn)
@@ -1434,7 +1546,14 @@ def _set_stopped_since_ms(machine_id: str, stopped_since_ms: int, updated_at: st
     finally:
         conn.close()
 
-def _clear_stopped_since(machine_id: str, updated_at: str):
+    m["stopped_since_ms"] = int(stopped_since_ms)
+    return int(stopped_since_ms)
+
+def _stop_clock_limpar(m: dict, machine_id: str) -> None:
+    """Maquina voltou a rodar: apaga a parada (so se havia uma)."""
+    if m.get("stopped_since_ms") is None:
+        return
+
     conn = get_db()
     try:
         _ensure_machine_stop_table(conn)
@@ -1443,7 +1562,12 @@ def _clear_stopped_since(machine_id: str, updated_at: str):
     finally:
         conn.close()
 
+    m["stopped_since_ms"] = None
+
 def _ensure_baseline_table(conn):
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS baseline_diario (
@@ -1553,6 +1677,9 @@ def _load_baseline_esp_for_day(conn, machine_id: str, dia_ref: str, cliente_id:
 # =====================================================
 
 def _ensure_reset_cmd_table(conn):
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS esp_reset_cmd (
@@ -1695,6 +1822,9 @@ def _force_baseline_for_day(conn, machine_id: str, dia_ref: str, baseline_esp: i
     conn.commit()
 
 def _ensure_producao_evento_table(conn):
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS producao_evento (
@@ -1704,7 +1834,10 @@ def _ensure_producao_evento_table(conn):
             ts_ms INTEGER NOT NULL,
             esp_absoluto INTEGER NOT NULL,
             delta INTEGER NOT NULL,
-            created_at TEXT NOT NULL
+            created_at TEXT NOT NULL,
+            device_id TEXT,
+            seq INTEGER,
+            machine_pk INTEGER
         )
     """
     )
@@ -1718,24 +1851,80 @@ def _ensure_producao_evento_table(conn):
         pass
     conn.commit()
 
-def _registrar_evento_producao(cliente_id: str, machine_id: str, ts_ms: int, esp_absoluto: int, delta: int, created_at: str) -> None:
+def _registrar_evento_producao(
+    cliente_id: str,
+    machine_id: str,
+    ts_ms: int,
+    esp_absoluto: int,
+    delta: int,
+    created_at: str,
+    device_id: str | None = None,
+    seq: int | None = None,
+) -> None:
+    """
+    device_id/seq: chave de idempotencia (UNIQUE device_id, ts_ms, seq); retry do mesmo
+    pacote vira INSERT OR IGNORE. Leitura so com ts_ms do ESP chega com seq 0 (dedupe no banco);
+    seq None so quando ts_ms e do servidor: o retry ganha outro ts, sem dedupe no banco.
+    """
     if delta <= 0:
         return
 
+    row = (
+        cliente_id, machine_id, int(ts_ms), int(esp_absoluto), int(delta), created_at, device_id or None, seq,
+        machine_pk(cliente_id, machine_id),
+    )
+
+    lote = _eventos_lote_atual()
+    if lote is not None:
+        lote["producao_evento"].append(row)
+        return
+
+    if event_journal.journal_enabled():
+        event_journal.enqueue("producao_evento", row)
+        return
+
     conn = get_db()
     try:
         _ensure_producao_evento_table(conn)
         conn.execute(
             """
-            INSERT INTO producao_evento (cliente_id, machine_id, ts_ms, esp_absoluto, delta, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT OR IGNORE INTO producao_evento (cliente_id, machine_id, ts_ms, esp_absoluto, delta, created_at, device_id, seq, machine_pk)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            (cliente_id, machine_id, int(ts_ms), int(esp_absoluto), int(delta), created_at),
+            row,
         )
         conn.commit()
     finally:
         conn.close()
 
+# Journal write-behind: o escritor usa os mesmos INSERTs/ensures dos helpers sincronos
+event_journal.registrar_tabela(
+    "producao_evento",
+    "INSERT OR IGNORE INTO producao_evento (cliente_id, machine_id, ts_ms, esp_absoluto, delta, created_at, device_id, seq, machine_pk) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    _ensure_producao_evento_table,
+)
+event_journal.registrar_tabela(
+    "machine_state_event",
+    "INSERT INTO machine_state_event (machine_id, effective_machine_id, cliente_id, ts_ms, ts_iso, data_ref, hora_idx, state, machine_pk) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    _ensure_machine_state_event_schema,
+)
+
+
+@machine_bp.route("/admin/journal-status", methods=["GET"])
+def admin_journal_status():
+    """Fila/contadores do journal write-behind, assinantes do stream e pool de conexoes (X-Admin-Token)."""
+    if not _admin_token_ok():
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    return jsonify({
+        "ok": True,
+        "journal": event_journal.journal_stats(),
+        "stream": machine_status_view.stream_stats(),
+        "db_pool": pool_stats(),
+    })
+
+
 @machine_bp.route("/admin/hard-reset", methods=["POST"])
 def admin_hard_reset():
     if not _admin_token_ok():
@@ -1775,6 +1964,15 @@ def admin_hard_reset():
     conn.commit()
     conn.close()
 
+    # machine_stop foi apagada: relogio de parada em memoria acompanha
+    reset_stop_clocks()
+    invalidar_refugo_cache()
+    invalidar_np_cache()
+    _cfgv2_registro_invalidar()
+    bump_all_versions()
+    for mid in machine_status_view.snapshot_ids():
+        machine_status_view.solicitar_refresh(mid)
+
     return jsonify(
         {
             "ok": True,
@@ -1791,16 +1989,16 @@ def admin_hard_reset():
 
 _MACHINE_CFG_JSON_READY = False
 
-def _cfgv2_db_path() -> str:
-    p = (os.getenv("INDFLOW_DB_PATH") or "indflow.db").strip()
-    return p or "indflow.db"
-
 def _cfgv2_db_init():
     global _MACHINE_CFG_JSON_READY
     if _MACHINE_CFG_JSON_READY:
         return
+    if schema_ready():
+        # config_json/updated_at garantidos pela migracao 1 (init_db)
+        _MACHINE_CFG_JSON_READY = True
+        return
 
-    conn = sqlite3.connect(_cfgv2_db_path(), check_same_thread=False)
+    conn = get_db()
     try:
         # Tabela pode existir com schema legado (sem config_json). Nao recriamos; apenas garantimos colunas.
         conn.execute(
@@ -1848,7 +2046,7 @@ def _cfgv2_db_upsert(machine_id: str, cfg_v2: dict):
     mid = _norm_machine_id(machine_id)
     payload = json.dumps(cfg_v2, ensure_ascii=True, separators=(",", ":"))
     updated_at = datetime.now(_get_tz()).isoformat(timespec="seconds")
-    conn = sqlite3.connect(_cfgv2_db_path(), check_same_thread=False)
+    conn = get_db()
     try:
         conn.execute(
             """
@@ -1866,70 +2064,185 @@ def _cfgv2_db_upsert(machine_id: str, cfg_v2: dict):
             conn.close()
         except Exception:
             pass
+    _cfgv2_registro_invalidar(mid)
 
 
-def _cfgv2_db_load(machine_id: str) -> dict | None:
-    """Carrega config_v2 persistida (machine_config.config_json)."""
-    mid = _norm_machine_id(_unscope_machine_id(machine_id))
-    conn = sqlite3.connect(_cfgv2_db_path(), check_same_thread=False)
+# ============================================================
+# REGISTRO DE CONFIG V2 (parse/validacao 1x por updated_at)
+# ============================================================
+# machine_id (cru) -> {"updated_at", "cfg", "agenda", "seq", "checado_em"}
+# - cfg: config_v2 ja parseada e validada (None = maquina sem config_json)
+# - agenda: agenda de turnos compilada (modules/machine_agenda) dessa versao
+# - seq: identifica o carregamento (marca em m["_cfgv2_aplicada"] junto com dia/turno ativo)
+# O banco so e reconsultado depois de INDFLOW_CFG_RECHECK_SEC (1 SELECT de updated_at; o
+# config_json so volta quando mudou). O /machine/config invalida na hora.
+
+_CFGV2_REGISTRO: dict = {}
+_CFGV2_REGISTRO_LOCK = threading.Lock()
+_CFGV2_SEQ = [0]
+
+
+def _cfgv2_recheck_sec() -> float:
     try:
-        cur = conn.execute("SELECT config_json FROM machine_config WHERE machine_id = ? LIMIT 1", (mid,))
-        row = cur.fetchone()
-        if not row:
-            return None
-        raw = row[0]
-        if not raw:
-            return None
-        try:
-            return json.loads(raw)
-        except Exception:
-            return None
+        v = float((os.getenv("INDFLOW_CFG_RECHECK_SEC") or "").strip() or 30)
+        return v if v >= 0 else 30.0
     except Exception:
+        return 30.0
+
+
+def _cfgv2_registro_invalidar(machine_id: str | None = None) -> None:
+    """Descarta a config registrada de 1 maquina (ou de todas, sem machine_id)."""
+    with _CFGV2_REGISTRO_LOCK:
+        if machine_id is None:
+            _CFGV2_REGISTRO.clear()
+            return
+        _CFGV2_REGISTRO.pop(_norm_machine_id(_unscope_machine_id(machine_id)), None)
+
+
+def _cfgv2_parse(raw) -> dict | None:
+    if not raw:
         return None
-    finally:
+    try:
+        cfg = json.loads(raw)
+    except Exception:
+        return None
+    if not isinstance(cfg, dict):
+        return None
+    try:
+        return _cfgv2_validate(cfg)
+    except Exception:
+        # config antiga fora do schema atual: aplica como estava gravada
+        return cfg
+
+
+def _cfgv2_registro_guardar(mid: str, updated_at, raw, agora: float) -> dict:
+    cfg = _cfgv2_parse(raw)
+    with _CFGV2_REGISTRO_LOCK:
+        _CFGV2_SEQ[0] += 1
+        ent = {
+            "updated_at": updated_at,
+            "cfg": cfg,
+            "agenda": agenda_de(cfg),
+            "seq": _CFGV2_SEQ[0],
+            "checado_em": agora,
+        }
+        _CFGV2_REGISTRO[mid] = ent
+    return ent
+
+
+def _cfgv2_registro_many(machine_ids) -> dict:
+    """
+    {machine_id (como veio): entrada do registro | None}.
+    Entradas vencidas sao revalidadas em 1 SELECT: updated_at igual => so renova o prazo;
+    diferente => config_json volta no mesmo SELECT e e parseado 1 vez.
+    """
+    agora = time.monotonic()
+    ttl = _cfgv2_recheck_sec()
+
+    alvos = {}
+    for machine_id in machine_ids or []:
+        alvos.setdefault(_norm_machine_id(_unscope_machine_id(machine_id)), []).append(machine_id)
+    out = {machine_id: None for machine_id in (machine_ids or [])}
+    if not alvos:
+        return out
+
+    achados = {}
+    vencidos = {}
+    with _CFGV2_REGISTRO_LOCK:
+        for mid in alvos:
+            ent = _CFGV2_REGISTRO.get(mid)
+            if ent is not None and (agora - ent["checado_em"]) < ttl:
+                achados[mid] = ent
+            else:
+                vencidos[mid] = ent
+
+    if vencidos:
+        _cfgv2_db_init()
+        mids = list(vencidos.keys())
+        params = []
+        casos = []
+        for mid in mids:
+            ent = vencidos[mid]
+            casos.append("WHEN ? THEN ?")
+            # sem versao conhecida: marcador que nunca bate (config_json sempre volta)
+            params.extend([mid, ent["updated_at"] if ent and ent["updated_at"] is not None else "\x00"])
+        sql = (
+            "SELECT machine_id, updated_at, "
+            f"CASE WHEN updated_at IS (CASE machine_id {' '.join(casos)} END) THEN NULL ELSE config_json END "
+            f"FROM machine_config WHERE machine_id IN ({','.join('?' * len(mids))})"
+        )
         try:
-            conn.close()
+            conn = get_db()
+            try:
+                rows = conn.execute(sql, params + mids).fetchall()
+            finally:
+                conn.close()
         except Exception:
-            pass
+            rows = None
+
+        if rows is not None:
+            vistos = set()
+            for mid, updated_at, raw in rows:
+                vistos.add(mid)
+                ent = vencidos.get(mid)
+                if ent is not None and ent["updated_at"] is not None and ent["updated_at"] == updated_at:
+                    ent["checado_em"] = agora
+                    achados[mid] = ent
+                else:
+                    achados[mid] = _cfgv2_registro_guardar(mid, updated_at, raw, agora)
+            for mid in mids:
+                if mid not in vistos:
+                    # sem linha: registra o "nao tem config" para nao consultar a cada request
+                    achados[mid] = _cfgv2_registro_guardar(mid, None, None, agora)
+        else:
+            for mid, ent in vencidos.items():
+                if ent is not None:
+                    achados[mid] = ent
+
+    for mid, originais in alvos.items():
+        ent = achados.get(mid)
+        for machine_id in originais:
+            out[machine_id] = ent
+    return out
 
 
-def _cfgv2_load_apply(m: dict, machine_id: str) -> None:
-    """Recarrega do banco e aplica em memoria. Necessario apos deploy (memoria zera)."""
+def _cfgv2_registro_get(machine_id: str) -> dict | None:
+    return _cfgv2_registro_many([machine_id]).get(machine_id)
+
+
+def _cfgv2_load_apply(m: dict, machine_id: str, cfgs: dict | None = None) -> None:
+    """
+    Aplica em memoria a config persistida (necessario apos deploy: memoria zera).
+    Os campos derivados dos turnos so sao recalculados quando a config registrada muda
+    (updated_at) ou quando o dia da semana / turno ativo vira; nos demais requests so o
+    runtime da hora e reaplicado.
+    cfgs: resultado de _cfgv2_registro_many (lote ja carregado; evita 1 SELECT por maquina).
+    """
     try:
-        _cfgv2_db_init()
-        cfg = _cfgv2_db_load(machine_id)
-        if cfg:
-            _cfgv2_apply_to_memory(m, cfg)
+        ent = cfgs.get(machine_id) if cfgs is not None else _cfgv2_registro_get(machine_id)
+        if not ent or not ent.get("cfg"):
+            return
+        dt_now = now_bahia()
+        agenda = ent.get("agenda")
+        turno_idx = agenda.turno_ativo(dt_now.hour * 60 + dt_now.minute) if agenda is not None else None
+        chave = (ent["seq"], _cfgv2_weekday(dt_now), turno_idx)
+        if m.get("_cfgv2_aplicada") == chave:
+            if m.get("active_shift"):
+                _cfgv2_apply_runtime(m)
+            return
+        _cfgv2_apply_to_memory(m, ent["cfg"], dt_now)
+        m["_cfgv2_aplicada"] = chave
     except Exception:
         pass
 
 def _cfgv2_hhmm_to_min(hhmm: str) -> int:
-    s = str(hhmm or "").strip()
-    m = re.match(r"^(\d{1,2}):(\d{2})$", s)
-    if not m:
-        raise ValueError(f"Horario invalido: {s}")
-    hh = int(m.group(1))
-    mm = int(m.group(2))
-    if hh < 0 or hh > 23 or mm < 0 or mm > 59:
-        raise ValueError(f"Horario invalido: {s}")
-    return hh * 60 + mm
-
-def _cfgv2_shift_duration(start_min: int, end_min: int) -> int:
-    if end_min <= start_min:
-        return (24 * 60 - start_min) + end_min
-    return end_min - start_min
-
-def _cfgv2_break_rel(shift_start: int, br_start: int, br_end: int) -> tuple[int, int]:
-    # Converte break para eixo do turno (0..dur)
-    b0 = br_start
-    b1 = br_end
-    if b0 < shift_start:
-        b0 += 24 * 60
-    if b1 < shift_start:
-        b1 += 24 * 60
-    if b1 <= b0:
-        b1 += 24 * 60
-    return (b0 - shift_start, b1 - shift_start)
+    v = hhmm_para_min(hhmm)
+    if v is None:
+        raise ValueError(f"Horario invalido: {str(hhmm or '').strip()}")
+    return v
+
+_cfgv2_shift_duration = duracao_turno
+_cfgv2_break_rel = pausa_relativa
 
 def _cfgv2_validate(raw: dict) -> dict:
     cfg = {}
@@ -2103,25 +2416,7 @@ def _cfgv2_normalize_payload(data: dict) -> dict:
 def _cfgv2_weekday(dt) -> int:
     return int(dt.weekday()) + 1
 
-def _cfgv2_is_now_in_shift(dt_now, shift: dict) -> bool:
-    start_min = _cfgv2_hhmm_to_min(shift.get("start"))
-    end_min = _cfgv2_hhmm_to_min(shift.get("end"))
-    now_min = int(dt_now.hour) * 60 + int(dt_now.minute)
-    if end_min > start_min:
-        return start_min <= now_min < end_min
-    return (now_min >= start_min) or (now_min < end_min)
-
-def _cfgv2_pick_shift(cfg_v2: dict, dt_now):
-    shifts = cfg_v2.get("shifts") or []
-    for s in shifts:
-        try:
-            if _cfgv2_is_now_in_shift(dt_now, s):
-                return s
-        except Exception:
-            continue
-    return shifts[0] if shifts else None
-
-def _cfgv2_apply_to_memory(m: dict, cfg_v2: dict):
+def _cfgv2_apply_to_memory(m: dict, cfg_v2: dict, dt_now=None):
     m["config_v2"] = cfg_v2
     m["active_days"] = cfg_v2.get("active_days") or [1, 2, 3, 4, 5, 6, 7]
     m["shifts"] = cfg_v2.get("shifts") or []
@@ -2149,10 +2444,14 @@ def _cfgv2_apply_to_memory(m: dict, cfg_v2: dict):
         except Exception:
             pass
 
-    dt_now = datetime.now(_get_tz())
+    if dt_now is None:
+        dt_now = now_bahia()
     m["is_active_day"] = (_cfgv2_weekday(dt_now) in (m.get("active_days") or []))
 
-    shift = _cfgv2_pick_shift(cfg_v2, dt_now)
+    agenda = agenda_de(cfg_v2)
+    shifts = m.get("shifts") or []
+    idx = agenda.turno_ativo(int(dt_now.hour) * 60 + int(dt_now.minute)) if agenda is not None else None
+    shift = shifts[idx] if idx is not None and idx < len(shifts) else None
     m["active_shift"] = shift
 
     # Campos legados: usa turno ativo (ou primeiro)
@@ -2166,6 +2465,10 @@ def _cfgv2_apply_to_memory(m: dict, cfg_v2: dict):
         m["meta_por_hora"] = []
         return
 
+    turno = agenda.turnos[idx]
+    if turno is None:
+        raise ValueError(f"Horario invalido: {shift.get('start')}-{shift.get('end')}")
+
     active_meta = int(shift.get("meta_pcs", 0) or 0)
     m["meta_turno_ativo"] = active_meta
     # Legado: meta_turno representa a meta do DIA (soma dos turnos) para o card e para producao_diaria
@@ -2173,78 +2476,14 @@ def _cfgv2_apply_to_memory(m: dict, cfg_v2: dict):
     m["turno_inicio"] = shift.get("start")
     m["turno_fim"] = shift.get("end")
 
-    # Horas (slots 1h) e meta_por_hora com pausa heuristica (>=30min de sobreposicao zera slot)
-    start_min = _cfgv2_hhmm_to_min(shift.get("start"))
-    end_min = _cfgv2_hhmm_to_min(shift.get("end"))
-    dur = _cfgv2_shift_duration(start_min, end_min)
+    # Horas (slots 1h) e meta_por_hora (pausa >= 30min zera o slot): ja compilados na agenda
+    m["horas_turno"] = list(turno["horas_turno"])
+    m["meta_por_hora"] = list(turno["meta_por_hora"])
 
-    break_intervals = []
-    for br in (shift.get("breaks") or []):
-        try:
-            b0 = _cfgv2_hhmm_to_min(br.get("start"))
-            b1 = _cfgv2_hhmm_to_min(br.get("end"))
-            rel0, rel1 = _cfgv2_break_rel(start_min, b0, b1)
-            break_intervals.append((rel0, rel1))
-        except Exception:
-            continue
+    _cfgv2_apply_runtime(m)
 
-    horas_turno = []
-    slot_is_break = []
-    t = 0
-    while t < dur:
-        t2 = min(dur, t + 60)
-        abs0 = (start_min + t) % (24 * 60)
-        abs1 = (start_min + t2) % (24 * 60)
-        h0 = f"{abs0//60:02d}:{abs0%60:02d}"
-        h1 = f"{abs1//60:02d}:{abs1%60:02d}"
-        horas_turno.append(f"{h0} - {h1}")
-
-        overlap = 0
-        for b0, b1 in break_intervals:
-            lo = max(t, b0)
-            hi = min(t2, b1)
-            if hi > lo:
-                overlap = max(overlap, hi - lo)
-        slot_is_break.append(True if overlap >= 30 else False)
-
-        t = t2
-
-    prod_slots = [i for i, isb in enumerate(slot_is_break) if not isb]
-    metas = [0 for _ in horas_turno]
-
-    meta_turno = int(m.get("meta_turno_ativo", m.get("meta_turno", 0)) or 0)
-    if meta_turno > 0 and prod_slots:
-        ramp = int(m.get("rampa_percentual", 0) or 0)
-        if ramp < 0:
-            ramp = 0
-        if ramp > 100:
-            ramp = 100
-
-        qtd_prod = len(prod_slots)
-        meta_base = meta_turno / qtd_prod
-        meta_primeira = round(meta_base * (ramp / 100))
-        if meta_primeira < 0:
-            meta_primeira = 0
-        if meta_primeira > meta_turno:
-            meta_primeira = meta_turno
-
-        restante = meta_turno - meta_primeira
-        horas_restantes = qtd_prod - 1
-
-        metas[prod_slots[0]] = meta_primeira
-        if horas_restantes > 0:
-            base = restante // horas_restantes
-            sobra = restante % horas_restantes
-            for i in range(horas_restantes):
-                metas[prod_slots[i + 1]] = int(base + (1 if i < sobra else 0))
-
-    for i, isb in enumerate(slot_is_break):
-        if isb:
-            metas[i] = 0
-
-    m["horas_turno"] = horas_turno
-    m["meta_por_hora"] = metas
 
+def _cfgv2_apply_runtime(m: dict):
     # runtime
     m["baseline_hora"] = int(m.get("esp_absoluto", 0) or 0)
     try:
@@ -2295,6 +2534,8 @@ def configurar_maquina():
     except Exception:
         pass
 
+    _maquina_alterada(machine_id)
+
     return jsonify(
         {
             "status": "configurado",
@@ -2341,6 +2582,9 @@ def _sum_prev_hours_produzido(conn, machine_id: str, cliente_id: str, dia_ref: s
         return total
     except Exception:
         return 0
+_PRODUCAO_DIARIA_COLS: dict | None = None
+
+
 def _sync_producao_diaria_absoluta(machine_id: str, cliente_id: str | None, dia_ref: str, produzido_abs: int, meta: int | None = None) -> None:
     """
     Garante que producao_diaria reflita o valor absoluto (producao_turno) e nao um acumulado incremental.
@@ -2373,15 +2617,22 @@ def _sync_producao_diaria_absoluta(machine_id: str, cliente_id: str | None, dia_
     except Exception:
         percentual = 0
 
+    global _PRODUCAO_DIARIA_COLS
+
     conn = get_db()
     try:
-        cols = []
-        try:
-            cols = conn.execute("PRAGMA table_info(producao_diaria)").fetchall()
-        except Exception:
+        # Colunas de producao_diaria: com o schema migrado nao mudam em runtime (1 PRAGMA por processo)
+        colnames = _PRODUCAO_DIARIA_COLS if schema_ready() else None
+        if colnames is None:
             cols = []
+            try:
+                cols = conn.execute("PRAGMA table_info(producao_diaria)").fetchall()
+            except Exception:
+                cols = []
 
-        colnames = {str(c[1]).lower(): True for c in (cols or [])}
+            colnames = {str(c[1]).lower(): True for c in (cols or [])}
+            if schema_ready() and colnames:
+                _PRODUCAO_DIARIA_COLS = colnames
         has_cliente_id = ("cliente_id" in colnames)
 
         set_parts = ["produzido = ?", "percentual = ?"]
@@ -2400,13 +2651,24 @@ def _sync_producao_diaria_absoluta(machine_id: str, cliente_id: str | None, dia_
         set_sql = ", ".join(set_parts)
 
         mids = [mid_raw] + ([f"{cid}::{mid_raw}"] if cid else [])
+        # machine_pk cobre as 2 variantes (puro e escopado) da maquina: 1 UPDATE indexado
+        pk = machine_pk(cid, mid_raw, conn=conn) if "machine_pk" in colnames else None
 
         # Atualiza primeiro (se existir)
         updated_any = False
-        for mid in mids:
+        if pk is not None:
             try:
-                if has_cliente_id and cid is not None:
-                    cur = conn.execute(
+                cur = conn.execute(
+                    f"UPDATE producao_diaria SET {set_sql} WHERE machine_pk = ? AND data = ?",
+                    tuple(params_base + [pk, dia_ref]),
+                )
+                updated_any = bool(cur and getattr(cur, "rowcount", 0) > 0)
+            except Exception:
+                pass
+        for mid in (mids if pk is None else []):
+            try:
+                if has_cliente_id and cid is not None:
+                    cur = conn.execute(
                         f"UPDATE producao_diaria SET {set_sql} WHERE data = ? AND machine_id = ? AND cliente_id = ?",
                         tuple(params_base + [dia_ref, mid, cid]),
                     )
@@ -2423,7 +2685,12 @@ def _sync_producao_diaria_absoluta(machine_id: str, cliente_id: str | None, dia_
         # Se nao existia, insere uma linha minima
         if not updated_any:
             try:
-                if has_cliente_id and cid is not None:
+                if pk is not None:
+                    conn.execute(
+                        "INSERT INTO producao_diaria (machine_id, cliente_id, data, produzido, meta, percentual, machine_pk) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (mids[0], cid, dia_ref, produzido_abs, meta_int, percentual, pk),
+                    )
+                elif has_cliente_id and cid is not None:
                     conn.execute(
                         "INSERT INTO producao_diaria (machine_id, cliente_id, data, produzido, meta, percentual) VALUES (?, ?, ?, ?, ?, ?)",
                         (mids[0], cid, dia_ref, produzido_abs, meta_int, percentual),
@@ -2545,9 +2812,239 @@ def _reset_hour_card_on_hour_change(
 def update_machine():
     data = request.get_json() or {}
 
+    # Retry do ESP (seq/ts_ms ja aplicado): responde antes de abrir a transacao
+    chave = leitura_chave(get_seq_from_payload(data), _get_ts_ms_from_payload(data))
+    origem = _update_origem_idempotencia(data) if chave is not None else None
+    if leitura_duplicada(origem, chave):
+        return jsonify(_update_resposta_duplicada(data, chave))
+
+    # 1 pacote = 1 conexao / 1 transacao / 1 commit (todos os get_db() do pipeline compartilham)
+    with unit_of_work(central=_update_escreve_central(data)):
+        resp = _update_machine_payload(data)
+
+    if not isinstance(resp, tuple):
+        marcar_leitura_processada(origem, chave)
+    return resp
+
+
+def _update_origem_idempotencia(data: dict) -> str | None:
+    """
+    Origem da janela de dedupe: cliente + device (MAC), ou cliente + machine_id quando o ESP
+    nao manda MAC. None sem AUTH. AUTH vem do cache de api_key (sem banco no caminho quente).
+    """
+    if not isinstance(data, dict):
+        return None
+    cliente = _get_cliente_from_api_key()
+    if not cliente:
+        return None
+    device_id = norm_device_id(data.get("mac") or data.get("device_id") or "")
+    alvo = device_id or _norm_machine_id(data.get("machine_id", "maquina01"))
+    return f"{cliente['id']}::{alvo}"
+
+
+def _update_escreve_central(data: dict) -> bool:
+    """
+    Shard: o pacote pode gravar em devices (banco central) dentro da unidade de trabalho?
+    So com device fora do registro ou sem ser do cliente (insert / takeover / sem dono).
+    Caminho normal (device conhecido do proprio cliente) fica so no lock do shard.
+    """
+    if not em_shard() or not isinstance(data, dict):
+        return False
+    cliente = _get_cliente_from_api_key()
+    device_id = norm_device_id(data.get("mac") or data.get("device_id") or "")
+    if not cliente or not device_id:
+        return False
+    entry = device_registry_get(device_id)
+    return entry is None or entry.get("cliente_id") != cliente["id"]
+
+
+def _update_resposta_duplicada(data: dict, chave: tuple) -> dict:
+    seq, ts_ms_esp = chave
+    return {
+        "message": "OK",
+        "duplicate": True,
+        "machine_id": _norm_machine_id(data.get("machine_id", "maquina01")),
+        "seq": seq,
+        "ts_ms": ts_ms_esp,
+    }
+
+
+@machine_bp.route("/machine/update/batch", methods=["POST"])
+def update_machine_batch():
+    """
+    Reenvio de leituras bufferizadas pelo ESP (queda de Wi-Fi).
+
+    Payload:
+      {
+        "mac": "...", "machine_id": "...",
+        "readings": [ {"ts_ms": ..., "producao_turno": ..., "status": "AUTO", "run": 1}, ... ]   # em ordem
+      }
+
+    - 1 AUTH + 1 upsert do device para o lote inteiro
+    - cada leitura passa pelo mesmo pipeline do /machine/update (delta, timeline, horaria, NP),
+      com o relogio do pipeline no horario da leitura
+    - producao_evento / machine_state_event gravados com executemany
+    - leituras sem ts_ms valido sao ignoradas
+    - leituras com (seq, ts_ms) ja aplicados (janela de dedupe do device) tambem
+    - leituras com ts_ms <= ultima ja vista (pacote ao vivo chegou antes do buffer) nao mexem no
+      estado ao vivo, mas gravam o producao_evento delas (_registrar_eventos_atrasados) e voltam
+      contadas em readings_atrasadas
+    """
+    data = request.get_json() or {}
+    readings = data.get("readings")
+    if not isinstance(readings, list) or not readings:
+        return jsonify({"error": "readings obrigatorio (lista nao vazia)"}), 400
+
+    try:
+        max_lote = int(os.getenv("INDFLOW_BATCH_MAX_READINGS", "2000") or 2000)
+    except Exception:
+        max_lote = 2000
+    if len(readings) > max_lote:
+        return jsonify({"error": "lote muito grande", "max_readings": max_lote}), 413
+
+    origem_lote = _update_origem_idempotencia(data)
+    chaves_aplicadas = []
+
+    with unit_of_work(central=_update_escreve_central(data)):
+        ctx, erro = _update_resolver_origem(data)
+        if erro is not None:
+            return erro
+
+        # machine_data da maquina: o agendador do status deriva/publica o mesmo dict em outra thread
+        with lock_maquina(ctx["machine_id"]):
+            m = get_machine(ctx["machine_id"])
+
+            aplicadas = 0
+            ignoradas = 0
+            atrasadas = []
+            last_resp = None
+            with _eventos_em_lote() as lote:
+                for r in readings:
+                    if not isinstance(r, dict):
+                        ignoradas += 1
+                        continue
+
+                    ts_in = _get_ts_ms_from_payload(r)
+                    if ts_in is None:
+                        ignoradas += 1
+                        continue
+
+                    seq_in = get_seq_from_payload(r)
+                    chave = leitura_chave(seq_in, int(ts_in))
+                    if leitura_duplicada(origem_lote, chave):
+                        ignoradas += 1
+                        continue
+
+                    try:
+                        last_seen = int(m.get("_last_esp_ts_ms_seen") or 0)
+                    except Exception:
+                        last_seen = 0
+                    if last_seen and int(ts_in) <= last_seen:
+                        try:
+                            abs_in = int(r.get("producao_turno", 0) or 0)
+                        except Exception:
+                            abs_in = 0
+                        atrasadas.append((int(ts_in), abs_in, seq_in if seq_in is not None else 0))
+                        chaves_aplicadas.append(chave)
+                        continue
+
+                    now_ms = int(datetime.now(TZ_BAHIA).timestamp() * 1000)
+                    agora_leitura = datetime.fromtimestamp(min(int(ts_in), now_ms) / 1000, TZ_BAHIA)
+
+                    with relogio_replay(agora_leitura):
+                        last_resp = _update_aplicar_leitura(ctx, r, incluir_cmd=False)
+                    aplicadas += 1
+                    chaves_aplicadas.append(chave)
+
+                gravados = _flush_eventos_lote(lote)
+
+            gravados["producao_evento_atrasado"] = _registrar_eventos_atrasados(ctx, atrasadas) if atrasadas else 0
+
+            # snapshot do /machine/status com o estado final do lote (relogio real, fora do lote de eventos)
+            try:
+                bump_version(ctx["machine_id"])
+                _status_publicar(m, ctx["machine_id"])
+            except Exception:
+                pass
+
+        resp = dict(last_resp or {})
+        resp.update({
+            "message": "OK",
+            "machine_id": ctx["machine_id"],
+            "cliente_id": ctx["cliente_id"],
+            "device_id": ctx["device_id"] or None,
+            "linked_machine": ctx["linked_machine"] or None,
+            "readings_total": len(readings),
+            "readings_aplicadas": aplicadas,
+            "readings_ignoradas": ignoradas,
+            "readings_atrasadas": len(atrasadas),
+            "eventos_gravados": gravados,
+        })
+        _update_anexar_cmd_pendente(resp, ctx["cliente_id"], ctx["machine_id"])
+
+    # so depois do commit: leitura rejeitada por rollback pode ser reenviada
+    for chave in chaves_aplicadas:
+        marcar_leitura_processada(origem_lote, chave)
+    return jsonify(resp)
+
+
+def _registrar_eventos_atrasados(ctx: dict, leituras: list) -> int:
+    """
+    Leituras (ts_ms, producao_turno, seq) do buffer mais antigas que o ultimo pacote ao vivo.
+    O pacote ao vivo que chegou antes ja contou a producao delas num evento so (o que "cobre" o
+    intervalo). Cada leitura atrasada grava a sua parte (delta ate ela) e o evento que cobre perde o
+    mesmo delta: total igual, so a distribuicao por hora fica certa.
+    Idempotente (INSERT OR IGNORE na chave device_id, ts_ms, seq). Evento que cobre ainda no journal
+    (nao gravado) => leitura fica so contada. Retorna quantos eventos foram gravados.
+    """
+    cliente_id = ctx["cliente_id"]
+    machine_id = ctx["machine_id"]
+    pk = machine_pk(cliente_id, machine_id)
+    if pk is None:
+        return 0
+
+    created_at = now_bahia().strftime("%Y-%m-%d %H:%M:%S")
+    gravados = 0
+    conn = get_db()
+    try:
+        for ts_ms, esp_abs, seq in sorted(leituras):
+            cobre = conn.execute(
+                "SELECT id, esp_absoluto, delta FROM producao_evento WHERE machine_pk = ? AND ts_ms > ? "
+                "ORDER BY ts_ms ASC LIMIT 1",
+                (pk, ts_ms),
+            ).fetchone()
+            if cobre is None:
+                continue
+            cobre_id, cobre_abs, cobre_delta = int(cobre[0]), int(cobre[1]), int(cobre[2])
+            delta = esp_abs - (cobre_abs - cobre_delta)
+            if delta <= 0 or delta > cobre_delta:
+                continue
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO producao_evento (cliente_id, machine_id, ts_ms, esp_absoluto, delta, created_at, device_id, seq, machine_pk) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (cliente_id, machine_id, ts_ms, esp_abs, delta, created_at, ctx["device_id"] or None, seq, pk),
+            )
+            if cur.rowcount != 1:
+                continue
+            if delta == cobre_delta:
+                conn.execute("DELETE FROM producao_evento WHERE id = ?", (cobre_id,))
+            else:
+                conn.execute("UPDATE producao_evento SET delta = delta - ? WHERE id = ?", (delta, cobre_id))
+            gravados += 1
+        conn.commit()
+    finally:
+        conn.close()
+    return gravados
+
+
+def _update_resolver_origem(data: dict):
+    """
+    AUTH (X-API-Key) + upsert do device + maquina vinculada.
+    Retorna (ctx, None) ou (None, resposta_de_erro).
+    """
     cliente = _get_cliente_from_api_key()
     if not cliente:
-        return jsonify({"error": "unauthorized"}), 401
+        return None, (jsonify({"error": "unauthorized"}), 401)
 
     cliente_id = cliente["id"]
     allow_takeover = False
@@ -2561,12 +3058,9 @@ def update_machine():
 
         ok_owner = _upsert_device_for_cliente(device_id=device_id, cliente_id=cliente_id, now_str=now_str, allow_takeover=allow_takeover)
         if not ok_owner:
-            return jsonify({"error": "device pertence a outro cliente", "hint": "se for DEV, libere takeover setando INDFLOW_ALLOW_DEVICE_TAKEOVER=1"}), 403
+            return None, (jsonify({"error": "device pertence a outro cliente", "hint": "se for DEV, libere takeover setando INDFLOW_ALLOW_DEVICE_TAKEOVER=1"}), 403)
 
-        try:
-            touch_device_seen(device_id)
-        except Exception:
-            pass
+        # last_seen ja marcado (coalescido) pelo _upsert_device_for_cliente
 
     linked_machine = _get_linked_machine_for_cliente(device_id, cliente_id) if device_id else None
     if linked_machine:
@@ -2574,6 +3068,45 @@ def update_machine():
     else:
         machine_id = _norm_machine_id(data.get("machine_id", "maquina01"))
 
+    ctx = {
+        "cliente_id": cliente_id,
+        "device_id": device_id,
+        "linked_machine": linked_machine,
+        "machine_id": machine_id,
+        "allow_takeover": allow_takeover,
+    }
+    return ctx, None
+
+
+def _update_machine_payload(data: dict):
+    ctx, erro = _update_resolver_origem(data)
+    if erro is not None:
+        return erro
+    # machine_data da maquina: o agendador do status deriva/publica o mesmo dict em outra thread
+    with lock_maquina(ctx["machine_id"]):
+        resp = _update_aplicar_leitura(ctx, data)
+
+        # snapshot do /machine/status sai do ingest (mesma transacao)
+        try:
+            bump_version(ctx["machine_id"])
+            _status_publicar(get_machine(ctx["machine_id"]), ctx["machine_id"])
+        except Exception:
+            pass
+
+    return jsonify(resp)
+
+
+def _update_aplicar_leitura(ctx: dict, data: dict, incluir_cmd: bool = True) -> dict:
+    """
+    Aplica UMA leitura do ESP (delta, stop, timeline, baseline, horaria, NP, bobinas) na maquina do contexto.
+    Usado pelo /machine/update (1 leitura) e pelo /machine/update/batch (N leituras em ordem).
+    """
+    cliente_id = ctx["cliente_id"]
+    device_id = ctx["device_id"]
+    linked_machine = ctx["linked_machine"]
+    machine_id = ctx["machine_id"]
+    allow_takeover = ctx["allow_takeover"]
+
     m = get_machine(machine_id)
 
     m["cliente_id"] = cliente_id
@@ -2617,6 +3150,12 @@ def update_machine():
     try:
         ts_ms_in = _get_ts_ms_from_payload(data)
 
+        # chave do UNIQUE (device_id, ts_ms, seq): sem seq mas com ts_ms do ESP => seq 0;
+        # ts_ms do servidor (fallback) nao identifica retry => sem dedupe no banco
+        seq_evt = get_seq_from_payload(data)
+        if seq_evt is None and ts_ms_in is not None:
+            seq_evt = 0
+
         agora_lc = now_bahia()
         now_ms_lc = int(agora_lc.timestamp() * 1000)
 
@@ -2647,6 +3186,8 @@ def update_machine():
                     esp_absoluto=int(esp_now),
                     delta=int(delta_evt),
                     created_at=created_at_evt,
+                    device_id=device_id or None,
+                    seq=seq_evt,
                 )
         except Exception:
             pass
@@ -2667,15 +3208,9 @@ def update_machine():
         now_ms = int(agora.timestamp() * 1000)
 
         if new_status == "AUTO":
-            _clear_stopped_since(machine_id, updated_at)
-            m["stopped_since_ms"] = None
+            _stop_clock_limpar(m, machine_id)
         else:
-            existing = _get_stopped_since_ms(machine_id)
-            if existing is None:
-                _set_stopped_since_ms(machine_id, now_ms, updated_at)
-                m["stopped_since_ms"] = now_ms
-            else:
-                m["stopped_since_ms"] = existing
+            _stop_clock_iniciar(m, machine_id, now_ms, updated_at)
     except Exception:
         pass
 
@@ -2900,18 +3435,26 @@ def update_machine():
         "ts_ms": (m.get("_last_esp_ts_ms_seen") or None),
     }
 
+    if incluir_cmd:
+        _update_anexar_cmd_pendente(resp, cliente_id, machine_id)
+
+    return resp
+
+
+def _update_anexar_cmd_pendente(resp: dict, cliente_id: str, machine_id: str) -> None:
     # Se houver reset pendente, envia comando ao ESP (vai repetir ate receber ACK)
     try:
         conn_cmd = get_db()
-        pending_cmd_id = _get_pending_reset_cmd(conn_cmd, cliente_id, machine_id)
+        try:
+            pending_cmd_id = _get_pending_reset_cmd(conn_cmd, cliente_id, machine_id)
+        finally:
+            conn_cmd.close()
         if pending_cmd_id:
             resp["cmd"] = "reset_counter"
             resp["cmd_id"] = pending_cmd_id
     except Exception:
         pass
 
-    return jsonify(resp)
-
 def _admin_zerar_producao_db_day_hour(machine_id: str, dia_ref: str, cliente_id: str | None) -> None:
     mid_raw = _norm_machine_id(_unscope_machine_id(machine_id))
     cid = (cliente_id or "").strip() or None
@@ -2995,6 +3538,7 @@ def admin_reset_hour():
 
         m["_ph_loaded"] = False
 
+        _maquina_alterada(machine_id)
         return jsonify({"ok": True, "machine_id": machine_id, "scope": "hour", "hora_idx": idx, "baseline_hora": int(m.get("baseline_hora", 0) or 0), "note": "Hora resetada. Produção da hora volta a contar a partir de agora."})
 
     try:
@@ -3063,6 +3607,7 @@ def admin_reset_hour():
     except Exception:
         pass
 
+    _maquina_alterada(machine_id)
     return jsonify({"ok": True, "machine_id": machine_id, "scope": "day+hour", "hora_idx": idx, "cliente_id": cid or None, "note": "Reset completo executado. Dia e hora zerados a partir de agora."})
 
 # =====================================================
@@ -3302,6 +3847,8 @@ def _admin_reset_producao_por_data(machine_id: str, dia_ref: str, cliente_id: st
     except Exception:
         pass
     conn.commit()
+    invalidar_refugo_cache()
+    invalidar_np_cache()
     return result
 
 
@@ -3334,6 +3881,7 @@ def admin_reset_date():
     cid = _get_cliente_id_for_request()  # FIX: reset-date usa helper existente; evita NameError
 
     out = _admin_reset_producao_por_data(machine_id=machine_id, dia_ref=dia_ref, cliente_id=cid)
+    _maquina_alterada(_norm_machine_id(machine_id))
     return jsonify(out)
 
 
@@ -3409,6 +3957,7 @@ def reset_manual():
                     pass
 
                 conn.commit()
+                invalidar_refugo_cache(mid_raw)
             finally:
                 conn.close()
         except Exception:
@@ -3416,6 +3965,7 @@ def reset_manual():
     except Exception:
         pass
 
+    _maquina_alterada(machine_id)
     return jsonify({"status": "resetado", "machine_id": machine_id})
 
 
@@ -3484,6 +4034,8 @@ def admin_baseline_manual():
         except Exception:
             pass
 
+    _maquina_alterada(_norm_machine_id(machine_id))
+
     return jsonify({
         "ok": True,
         "machine_id": machine_id,
@@ -3524,31 +4076,448 @@ def salvar_refugo():
     if not ok:
         return jsonify({"ok": False, "error": "Falha ao salvar no banco"}), 500
 
+    _maquina_alterada(machine_id)
     return jsonify({"ok": True, "machine_id": machine_id, "dia_ref": dia_ref, "hora_dia": hora_dia, "refugo": refugo})
 
+# ============================================================
+# /machine/status: snapshot em memoria (GET sem escrita)
+# ============================================================
+# Quem recalcula/escreve:
+#   - /machine/update (e /batch): _status_derivar + publicar, na mesma transacao do pacote
+#   - agendador (machine_status_view): _status_manutencao + _status_derivar a cada poucos segundos,
+#     cobrindo o que muda so com o tempo (virada de hora/dia, parada por falta de contagem, NP)
 @machine_bp.route("/machine/status", methods=["GET"])
 def machine_status():
+    """
+    Payload publico (machine_status_view.STATUS_SCHEMA_VERSION), JSON serializado 1x por versao.
+    ?fields=a,b,c devolve so esses campos. ETag = versao da maquina (+ projecao).
+    machine_id fora do cadastro (machines / devices / machine_config): 404, sem esperar nem agendar snapshot.
+    """
     machine_id = _norm_machine_id(request.args.get("machine_id", "maquina01"))
-    m = get_machine(machine_id)
+    campos = machine_status_view.normalizar_campos(request.args.get("fields"))
+
+    if not _maquina_conhecida(machine_id):
+        return jsonify({"error": "maquina nao encontrada", "machine_id": machine_id}), 404
+
+    def etag_de(versao: int) -> str:
+        etag = etag_for_version(machine_id, versao)
+        if campos:
+            etag += "-" + hashlib.sha1(",".join(campos).encode()).hexdigest()[:8]
+        return etag
+
+    # If-None-Match igual => 304 sem serializar nada
+    atual = machine_status_view.obter_snapshot_versionado(machine_id)
+    if atual is not None:
+        etag = etag_de(atual[1])
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            return resp
+    else:
+        machine_status_view.aguardar_snapshot(machine_id)
+
+    pronto = machine_status_view.obter_json(machine_id, campos)
+    if pronto is None:
+        # agendador ainda nao publicou: devolve o estado carregado (somente leitura, sem ETag)
+        body = machine_status_view.serializar(machine_status_view.payload_publico(get_machine(machine_id)), campos)
+        return _status_json_response(body)
+
+    body, versao = pronto
+    resp = _status_json_response(body)
+    resp.set_etag(etag_de(versao))
+    return resp
 
-    # Recarrega config persistida (pos-deploy)
-    _cfgv2_load_apply(m, machine_id)
 
-    cid_req = None
+def _maquina_conhecida(machine_id: str) -> bool:
+    """
+    Maquina ja vista pelo backend: em memoria / com snapshot, no cadastro machines (migracao 10),
+    vinculada a um device ou com machine_config. So leitura: id arbitrario nao cria estado nem entra no agendador.
+    """
+    if not machine_id:
+        return False
+    if machine_id in machine_data or machine_status_view.obter_snapshot(machine_id) is not None:
+        return True
+
+    cli, code = chave_maquina(None, machine_id)
+    conn = get_db_leitura()
     try:
-        cid_req = _get_cliente_id_for_request()
+        if cli:
+            row = conn.execute("SELECT 1 FROM machines WHERE cliente_id = ? AND code = ? LIMIT 1", (cli, code)).fetchone()
+        else:
+            row = conn.execute("SELECT 1 FROM machines WHERE code = ? LIMIT 1", (code,)).fetchone()
+        if row is None:
+            row = conn.execute("SELECT 1 FROM devices WHERE machine_id = ? LIMIT 1", (machine_id,)).fetchone()
+        if row is None:
+            # configurada pela tela, ainda sem nenhum pacote
+            row = conn.execute("SELECT 1 FROM machine_config WHERE machine_id = ? LIMIT 1", (machine_id,)).fetchone()
+        return row is not None
     except Exception:
-        cid_req = None
+        return False
+    finally:
+        conn.close()
 
-    if cid_req:
-        m["cliente_id"] = cid_req
 
-        if not m.get("_pd_backfill_done"):
-            try:
-                _backfill_producao_diaria_cliente_id_all(machine_id, cid_req)
-                m["_pd_backfill_done"] = True
-            except Exception:
-                pass
+def _status_json_response(body: bytes) -> Response:
+    resp = Response(body, mimetype="application/json")
+    resp.headers["X-Status-Schema"] = str(machine_status_view.STATUS_SCHEMA_VERSION)
+    return resp
+
+
+_STATUS_BULK_MAX = 200
+
+
+def _listar_maquinas_cliente(cliente_id: str) -> list:
+    """Maquinas do cliente: devices vinculados + machine_config + maquinas em memoria (1 SELECT)."""
+    cid = (cliente_id or "").strip()
+    ids = set()
+    if not cid:
+        return []
+
+    conn = get_db_leitura()
+    try:
+        rows = conn.execute(
+            """
+            SELECT machine_id FROM devices WHERE cliente_id=? AND machine_id IS NOT NULL AND machine_id <> ''
+            UNION
+            SELECT machine_id FROM machine_config WHERE cliente_id=?
+            """,
+            (cid, cid),
+        ).fetchall()
+        for r in rows:
+            mid = _norm_machine_id(_unscope_machine_id(r[0] or ""))
+            if mid:
+                ids.add(mid)
+    except Exception:
+        pass
+    finally:
+        conn.close()
+
+    for mid in machine_status_view.snapshot_ids():
+        snap = machine_status_view.obter_snapshot(mid) or {}
+        if (snap.get("cliente_id") or "").strip() == cid:
+            ids.add(mid)
+
+    return sorted(ids)
+
+
+@machine_bp.route("/machine/status/bulk", methods=["GET"])
+def machine_status_bulk():
+    """
+    Status de varias maquinas em 1 resposta (telas de visao geral / TVs):
+      - ?ids=a,b,c  -> essas maquinas (so as do cliente do request; as outras ficam de fora)
+      - sem ids     -> todas as maquinas do cliente do request (X-API-Key ou sessao)
+    Le os snapshots; maquinas frias sao recalculadas juntas pelo agendador (lookups em lote).
+    """
+    cliente_id = _get_cliente_id_for_request()
+    if not cliente_id:
+        return jsonify({"ok": False, "error": "cliente nao autenticado"}), 401
+
+    do_cliente = _listar_maquinas_cliente(cliente_id)
+    raw_ids = (request.args.get("ids") or "").strip()
+    if raw_ids:
+        permitidas = set(do_cliente)
+        ids = []
+        for part in raw_ids.split(","):
+            mid = _norm_machine_id(part)
+            if mid and mid in permitidas and mid not in ids:
+                ids.append(mid)
+    else:
+        ids = do_cliente
+
+    if len(ids) > _STATUS_BULK_MAX:
+        return jsonify({"ok": False, "error": f"maximo de {_STATUS_BULK_MAX} maquinas por chamada"}), 400
+
+    campos = machine_status_view.normalizar_campos(request.args.get("fields"))
+
+    frias = [mid for mid in ids if machine_status_view.obter_snapshot(mid) is None]
+    if frias:
+        machine_status_view.aguardar_snapshots(frias)
+
+    # monta a resposta com o JSON ja serializado de cada snapshot (cache por versao)
+    partes = []
+    for mid in ids:
+        pronto = machine_status_view.obter_json(mid, campos)
+        if pronto is not None:
+            body = pronto[0]
+        else:
+            body = machine_status_view.serializar(machine_status_view.payload_publico(get_machine(mid)), campos)
+        partes.append(json.dumps(mid).encode("utf-8") + b":" + body)
+
+    body = (
+        b'{"ok":true,"ids":' + json.dumps(ids).encode("utf-8")
+        + b',"machines":{' + b",".join(partes) + b"}}"
+    )
+    return _status_json_response(body)
+
+
+# ============================================================
+# /machine/overview: resumo do cliente para as TVs do chao de fabrica
+# ============================================================
+# Conta maquinas por estado, soma producao x meta do dia e lista as paradas ha mais tempo.
+# Fonte: snapshots em memoria + 1 SELECT agregado (maquinas cadastradas e producao_diaria do dia
+# para quem ainda nao tem snapshot). Resultado em cache por cliente por INDFLOW_OVERVIEW_TTL_SEC.
+_OVERVIEW_CACHE: dict = {}
+_OVERVIEW_CACHE_LOCK = threading.Lock()
+_OVERVIEW_TOP_MAX = 50
+
+
+def _overview_env_float(name: str, default: float) -> float:
+    try:
+        v = float((os.getenv(name) or "").strip() or default)
+        return v if v >= 0 else default
+    except Exception:
+        return default
+
+
+def _overview_base_cliente(cliente_id: str, dia_ref: str) -> dict:
+    """
+    1 SELECT: maquinas do cliente (devices + machine_config + producao_diaria do dia) com
+    produzido/meta do dia. {machine_id: (produzido | None, meta | None)}.
+    """
+    out = {}
+    conn = get_db_leitura()
+    try:
+        rows = conn.execute(
+            """
+            SELECT machine_id, MAX(produzido), MAX(meta) FROM (
+                SELECT machine_id, NULL AS produzido, NULL AS meta FROM devices
+                 WHERE cliente_id=? AND machine_id IS NOT NULL AND machine_id <> ''
+                UNION ALL
+                SELECT machine_id, NULL, NULL FROM machine_config WHERE cliente_id=?
+                UNION ALL
+                SELECT machine_id, produzido, meta FROM producao_diaria WHERE cliente_id=? AND data=?
+            ) GROUP BY machine_id
+            """,
+            (cliente_id, cliente_id, cliente_id, dia_ref),
+        ).fetchall()
+    except Exception:
+        rows = []
+    finally:
+        conn.close()
+
+    for raw_mid, produzido, meta in rows:
+        mid = _norm_machine_id(_unscope_machine_id(raw_mid or ""))
+        if not mid:
+            continue
+        p0, m0 = out.get(mid, (None, None))
+        if produzido is not None:
+            p0 = max(_safe_int(p0, 0), _safe_int(produzido, 0))
+        if meta is not None:
+            m0 = max(_safe_int(m0, 0), _safe_int(meta, 0))
+        out[mid] = (p0, m0)
+    return out
+
+
+def _overview_estado(snap: dict | None, ultimo_contato_ms, agora_ms: int, offline_ms: int) -> str:
+    if not snap:
+        return "OFFLINE"
+    try:
+        if ultimo_contato_ms is None or (agora_ms - int(ultimo_contato_ms)) > offline_ms:
+            return "OFFLINE"
+    except Exception:
+        return "OFFLINE"
+    st = _infer_state_for_timeline(snap, int(now_bahia().hour))
+    if st == "NP":
+        return "NP"
+    if st == "RUN":
+        return "PRODUZINDO"
+    return "PARADA"
+
+
+def _overview_calcular(cliente_id: str, top_n: int) -> dict:
+    agora = now_bahia()
+    agora_ms = int(agora.timestamp() * 1000)
+    dia_ref = dia_operacional_ref_str(agora)
+    offline_ms = int(_overview_env_float("INDFLOW_OVERVIEW_OFFLINE_SEC", 120.0) * 1000)
+
+    base = _overview_base_cliente(cliente_id, dia_ref)
+    for mid in machine_status_view.snapshot_ids():
+        snap = machine_status_view.obter_snapshot(mid) or {}
+        if (snap.get("cliente_id") or "").strip() == cliente_id:
+            base.setdefault(mid, (None, None))
+
+    contagem = {"PRODUZINDO": 0, "PARADA": 0, "NP": 0, "OFFLINE": 0}
+    produzido_total = 0
+    meta_total = 0
+    paradas = []
+
+    for mid in sorted(base.keys()):
+        snap = machine_status_view.obter_snapshot(mid)
+        m_mem = machine_data.get(mid) or {}
+        estado = _overview_estado(snap, m_mem.get("_last_esp_ts_ms_seen"), agora_ms, offline_ms)
+        contagem[estado] += 1
+
+        # producao do dia: snapshot (ao vivo) quando existir; senao a linha de producao_diaria
+        prod_db, meta_db = base[mid]
+        if snap:
+            produzido_total += _safe_int(snap.get("producao_turno"), 0)
+            meta_total += _safe_int(snap.get("meta_turno"), 0)
+        else:
+            produzido_total += _safe_int(prod_db, 0)
+            meta_total += _safe_int(meta_db, 0)
+
+        if estado == "PARADA" and snap.get("parado_min") is not None:
+            paradas.append({
+                "machine_id": mid,
+                "nome": snap.get("nome") or mid.upper(),
+                "parado_min": _safe_int(snap.get("parado_min"), 0),
+            })
+
+    paradas.sort(key=lambda p: (-p["parado_min"], p["machine_id"]))
+
+    return {
+        "ok": True,
+        "cliente_id": cliente_id,
+        "dia_ref": dia_ref,
+        "total": len(base),
+        "por_estado": contagem,
+        "producao": {
+            "produzido": int(produzido_total),
+            "meta": int(meta_total),
+            "percentual": (round((produzido_total / meta_total) * 100) if meta_total > 0 else 0),
+        },
+        "top_paradas": paradas[:top_n],
+        "gerado_em_ms": agora_ms,
+    }
+
+
+@machine_bp.route("/machine/overview", methods=["GET"])
+def machine_overview():
+    """
+    Resumo do cliente logado (X-API-Key ou sessao) para TVs:
+      por_estado {PRODUZINDO, PARADA, NP, OFFLINE}, producao {produzido, meta, percentual} do dia
+      e top_paradas (maior parado_min primeiro; ?top=N, default 5).
+    OFFLINE: sem snapshot ou sem leitura do ESP ha mais de INDFLOW_OVERVIEW_OFFLINE_SEC (default 120).
+    """
+    cliente_id = _get_cliente_id_for_request()
+    if not cliente_id:
+        return jsonify({"ok": False, "error": "cliente nao autenticado"}), 401
+
+    top_n = max(0, min(_OVERVIEW_TOP_MAX, _safe_int(request.args.get("top"), 5)))
+
+    ttl = _overview_env_float("INDFLOW_OVERVIEW_TTL_SEC", 3.0)
+    agora = time.monotonic()
+    chave = (cliente_id, top_n)
+    with _OVERVIEW_CACHE_LOCK:
+        hit = _OVERVIEW_CACHE.get(chave)
+    if hit is not None and hit[0] > agora:
+        return jsonify(hit[1])
+
+    out = _overview_calcular(cliente_id, top_n)
+    if ttl > 0:
+        with _OVERVIEW_CACHE_LOCK:
+            if len(_OVERVIEW_CACHE) >= 500:
+                _OVERVIEW_CACHE.clear()
+            _OVERVIEW_CACHE[chave] = (agora + ttl, out)
+    return jsonify(out)
+
+
+# ============================================================
+# /machine/stream: SSE com deltas do status (substitui o polling das telas)
+# ============================================================
+# Cada conexao ocupa 1 thread do waitress enquanto estiver aberta: o numero de assinantes e limitado
+# (INDFLOW_STREAM_MAX_SUBS, deixar abaixo do --threads do Procfile) e a conexao e reciclada a cada
+# INDFLOW_STREAM_MAX_SEC (o EventSource reconecta sozinho e recebe o estado inteiro).
+def _stream_env_float(name: str, default: float) -> float:
+    try:
+        v = float((os.getenv(name) or "").strip() or default)
+        return v if v > 0 else default
+    except Exception:
+        return default
+
+
+_STREAM_HEARTBEAT_SEC = _stream_env_float("INDFLOW_STREAM_HEARTBEAT_SEC", 15.0)
+_STREAM_MAX_SEC = _stream_env_float("INDFLOW_STREAM_MAX_SEC", 300.0)
+
+
+def _sse(evento: str, dados) -> str:
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False, separators=(',', ':'), default=str)}\n\n"
+
+
+@machine_bp.route("/machine/stream", methods=["GET"])
+def machine_stream():
+    """
+    Eventos:
+      - status    {machine_id: campos}  estado inicial (compacto) das maquinas assinadas
+      - delta     {machine_id, dados}   so os campos que mudaram (ingest / agendador)
+      - heartbeat {ts_ms, parado_min}   a cada INDFLOW_STREAM_HEARTBEAT_SEC sem delta
+      - evicted   {}                    consumidor lento despejado (reconectar)
+    Filtro: ?ids=a,b,c (so as do cliente do request) ou, sem ids, todas as maquinas do cliente.
+    """
+    cliente_id = _get_cliente_id_for_request()
+    if not cliente_id:
+        return jsonify({"ok": False, "error": "cliente nao autenticado"}), 401
+
+    raw_ids = (request.args.get("ids") or "").strip()
+    ids = None
+    if raw_ids:
+        permitidas = set(_listar_maquinas_cliente(cliente_id))
+        ids = []
+        for part in raw_ids.split(","):
+            mid = _norm_machine_id(part)
+            if mid and mid in permitidas and mid not in ids:
+                ids.append(mid)
+        if len(ids) > _STATUS_BULK_MAX:
+            return jsonify({"ok": False, "error": f"maximo de {_STATUS_BULK_MAX} maquinas por chamada"}), 400
+
+    ass = machine_status_view.assinar(ids, cliente_id)
+    if ass is None:
+        resp = jsonify({"ok": False, "error": "limite de conexoes de stream atingido"})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = "30"
+        return resp
+
+    # maquinas frias: o agendador publica e o delta chega pelo stream
+    for mid in ids or []:
+        if machine_status_view.obter_snapshot(mid) is None:
+            machine_status_view.solicitar_refresh(mid)
+
+    def gerar():
+        try:
+            yield "retry: 3000\n\n"
+            yield _sse("status", machine_status_view.estado_assinado(ass))
+
+            limite = time.monotonic() + _STREAM_MAX_SEC
+            while ass["ativo"] and time.monotonic() < limite:
+                try:
+                    evento = ass["fila"].get(timeout=_STREAM_HEARTBEAT_SEC)
+                except queue.Empty:
+                    estado = machine_status_view.estado_assinado(ass)
+                    yield _sse("heartbeat", {
+                        "ts_ms": int(time.time() * 1000),
+                        "parado_min": {mid: c.get("parado_min") for mid, c in estado.items() if c.get("parado_min") is not None},
+                    })
+                    continue
+                yield _sse("delta", evento)
+
+            if not ass["ativo"]:
+                yield _sse("evicted", {})
+        finally:
+            machine_status_view.cancelar_assinatura(ass)
+
+    return Response(
+        gerar(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _status_manutencao(m: dict, machine_id: str, cfgs: dict | None = None) -> None:
+    """
+    Parte do antigo /machine/status que depende do relogio (o ingest ja faz a mesma coisa por pacote):
+    virada do dia operacional, baseline, producao da hora e producao_diaria absoluta.
+    """
+    # Recarrega config persistida (pos-deploy)
+    _cfgv2_load_apply(m, machine_id, cfgs)
+
+    cid_m = (m.get("cliente_id") or "").strip() or None
+
+    if cid_m and not m.get("_pd_backfill_done"):
+        try:
+            _backfill_producao_diaria_cliente_id_all(machine_id, cid_m)
+            m["_pd_backfill_done"] = True
+        except Exception:
+            pass
 
     dia_ref_before = str(m.get("ultimo_dia") or "").strip()
     try:
@@ -3557,17 +4526,17 @@ def machine_status():
         pass
     dia_ref_after = str(m.get("ultimo_dia") or "").strip()
 
-    if cid_req and dia_ref_before and dia_ref_after and dia_ref_before != dia_ref_after:
+    if cid_m and dia_ref_before and dia_ref_after and dia_ref_before != dia_ref_after:
         try:
             raw_mid = _norm_machine_id(machine_id)
-            scoped_mid = f"{cid_req}::{raw_mid}"
+            scoped_mid = f"{cid_m}::{raw_mid}"
             conn = get_db()
             try:
                 conn.execute(
                     "UPDATE producao_diaria SET cliente_id=? "
                     "WHERE (cliente_id IS NULL OR cliente_id='') "
                     "AND data=? AND (machine_id=? OR machine_id=?)",
-                    (cid_req, dia_ref_before, raw_mid, scoped_mid),
+                    (cid_m, dia_ref_before, raw_mid, scoped_mid),
                 )
                 conn.commit()
             finally:
@@ -3601,19 +4570,35 @@ def machine_status():
             meta_abs = int(m.get("meta_turno", 0) or 0)
         except Exception:
             meta_abs = 0
-        _sync_producao_diaria_absoluta(machine_id=str(machine_id), cliente_id=(m.get("cliente_id") or cid_req), dia_ref=str(dia_ref_pd), produzido_abs=int(prod_abs), meta=int(meta_abs))
+        _sync_producao_diaria_absoluta(machine_id=str(machine_id), cliente_id=cid_m, dia_ref=str(dia_ref_pd), produzido_abs=int(prod_abs), meta=int(meta_abs))
     except Exception:
         pass
 
+
+def _status_derivar(m: dict, machine_id: str, lote: dict | None = None) -> None:
+    """
+    Campos de exibicao do status (refugo/NP por hora, producao_exibicao_24, status_ui, parado_min,
+    producao_hora_liquida) + transicao da timeline pelo estado inferido.
+    lote: lookups compartilhados de _status_lote_carregar (refugo/NP de varias maquinas de uma vez).
+    """
     calcular_tempo_medio(m)
     aplicar_derivados_ml(m)
 
-    dia_ref = dia_operacional_ref_str(now_bahia())
-    m["refugo_por_hora"] = load_refugo_24(machine_id, dia_ref)
+    agora_tick = now_bahia()
+    dia_ref = dia_operacional_ref_str(agora_tick)
+    m["_status_tick"] = [dia_ref, int(agora_tick.hour), int(agora_tick.minute)]
+    if lote is not None and lote.get("dia_ref") == dia_ref and machine_id in lote["refugo"]:
+        m["refugo_por_hora"] = list(lote["refugo"][machine_id])
+    else:
+        m["refugo_por_hora"] = load_refugo_24(machine_id, dia_ref)
 
     try:
-        cid = _resolve_cliente_id_for_status(m)
-        m["np_por_hora_24"] = _load_np_por_hora_24_scoped(machine_id, dia_ref, cid)
+        cid = (m.get("cliente_id") or "").strip() or None
+        np_mid = _machine_id_scoped(cid, machine_id)
+        if lote is not None and lote.get("dia_ref") == dia_ref and np_mid in lote["np"]:
+            m["np_por_hora_24"] = list(lote["np"][np_mid])
+        else:
+            m["np_por_hora_24"] = _load_np_por_hora_24_scoped(machine_id, dia_ref, cid)
     except Exception:
         m["np_por_hora_24"] = [0] * 24
 
@@ -3680,19 +4665,18 @@ def machine_status():
             m["status_ui"] = "PRODUZINDO"
             m["parado_min"] = None
             try:
-                _clear_stopped_since_ms(machine_id)
+                _stop_clock_limpar(m, machine_id)
             except Exception:
                 pass
         else:
             m["status_ui"] = "PARADA"
-            ss = _get_stopped_since_ms(machine_id)
+            ss = m.get("stopped_since_ms")
             if ss is None:
                 try:
                     updated_at = agora.strftime("%Y-%m-%d %H:%M:%S")
                     # quando parar, ancora no ultimo timestamp conhecido (se tiver)
                     anchor_ms = int(m.get("_last_count_ts_ms", now_ms) or now_ms)
-                    _set_stopped_since_ms(machine_id, anchor_ms, updated_at)
-                    ss = anchor_ms
+                    ss = _stop_clock_iniciar(m, machine_id, anchor_ms, updated_at)
                 except Exception:
                     ss = None
 
@@ -3730,7 +4714,7 @@ def machine_status():
             _record_machine_state_transition(raw_mid, eff_mid, cid_evt, "NP", agora_evt, data_ref_evt, hora_evt)
         except Exception:
             pass
-        return jsonify(m)
+        return
 
     try:
         hora_atual = int(now_bahia().hour)
@@ -3758,7 +4742,125 @@ def machine_status():
         _record_machine_state_transition(raw_mid, eff_mid, cid_evt, st_evt, agora_evt, data_ref_evt, hora_evt)
     except Exception:
         pass
-    return jsonify(m)
+
+
+def _maquina_alterada(machine_id: str) -> None:
+    """Config/refugo/reset mudaram a maquina fora do ingest: nova versao (ETag) + recalculo do snapshot."""
+    bump_version(machine_id)
+    machine_status_view.solicitar_refresh(machine_id)
+
+
+def _status_publicar(m: dict, machine_id: str, lote: dict | None = None) -> None:
+    _status_derivar(m, machine_id, lote)
+    machine_status_view.publicar_snapshot(machine_id, m)
+
+
+def _status_lote_carregar(machine_ids: list) -> dict:
+    """
+    Lookups compartilhados para recalcular varias maquinas: 1 SELECT de config, 1 de refugo e
+    1 de NP para o conjunto inteiro (em vez de 3 por maquina).
+    """
+    dia_ref = dia_operacional_ref_str(now_bahia())
+    np_ids = []
+    for mid in machine_ids:
+        try:
+            cid = (get_machine(mid).get("cliente_id") or "").strip() or None
+        except Exception:
+            cid = None
+        np_ids.append(_machine_id_scoped(cid, mid))
+
+    lote = {"dia_ref": dia_ref, "cfgs": None, "refugo": {}, "np": {}}
+    try:
+        lote["cfgs"] = _cfgv2_registro_many(machine_ids)
+    except Exception:
+        lote["cfgs"] = None
+    lote["refugo"] = load_refugo_24_many(machine_ids, dia_ref)
+    try:
+        conn = get_db()
+        try:
+            lote["np"] = load_np_por_hora_24_many(conn, np_ids, dia_ref)
+        finally:
+            conn.close()
+    except Exception:
+        lote["np"] = {}
+    return lote
+
+
+def _status_tick_necessario(m: dict, agora) -> str:
+    """
+    Tick periodico: o que o relogio mudou desde a ultima derivacao (ingest ou agendador).
+      "completo" -> virou o minuto/hora/dia (parado_min, meta da hora, reset diario)
+      "derivar"  -> mesmo minuto, mas a maquina passou do limite sem contagem (PRODUZINDO -> PARADA)
+      ""         -> nada mudou: o snapshot publicado continua valido
+    """
+    tick = m.get("_status_tick") or []
+    atual = [dia_operacional_ref_str(agora), int(agora.hour), int(agora.minute)]
+    if list(tick) != atual:
+        return "completo"
+
+    if m.get("status_ui") == "PRODUZINDO":
+        try:
+            thr = int(m.get("no_count_stop_sec", 0) or 0)
+            last_ts = int(m.get("_last_count_ts_ms") or 0)
+        except Exception:
+            return ""
+        now_ms = int(agora.timestamp() * 1000)
+        if thr >= 5 and last_ts and (now_ms - last_ts) >= thr * 1000:
+            return "derivar"
+    return ""
+
+
+def _status_refresh_agendado(machine_ids: list, completo: bool = True) -> None:
+    """
+    Ciclo do agendador: lookups do lote inteiro de uma vez; 1 transacao por maquina.
+    completo=False (tick periodico): so recalcula as maquinas em que o relogio mudou algo.
+    """
+    if not completo:
+        agora = now_bahia()
+        acoes = {}
+        for machine_id in machine_ids:
+            try:
+                acao = _status_tick_necessario(get_machine(machine_id), agora)
+            except Exception:
+                acao = "completo"
+            if acao:
+                acoes[machine_id] = acao
+        machine_ids = [mid for mid in machine_ids if mid in acoes]
+    else:
+        acoes = {mid: "completo" for mid in machine_ids}
+
+    if not machine_ids:
+        return
+
+    for cliente_id, ids in _status_por_cliente(machine_ids):
+        with usar_cliente(cliente_id):
+            lote = _status_lote_carregar(ids) if len(ids) > 1 else None
+            for machine_id in ids:
+                try:
+                    with unit_of_work(), lock_maquina(machine_id):
+                        m = get_machine(machine_id)
+                        if acoes[machine_id] == "completo":
+                            _status_manutencao(m, machine_id, lote["cfgs"] if lote else None)
+                        _status_publicar(m, machine_id, lote)
+                except Exception:
+                    log.exception("status-refresh: falha ao recalcular %s", machine_id)
+
+
+def _status_por_cliente(machine_ids: list) -> list:
+    """[(cliente_id, ids)]: com shard por cliente cada grupo roda no banco do seu cliente."""
+    if not shard_ativo():
+        return [(None, list(machine_ids))]
+    grupos = {}
+    for machine_id in machine_ids:
+        try:
+            cid = (get_machine(machine_id).get("cliente_id") or "").strip() or None
+        except Exception:
+            cid = None
+        grupos.setdefault(cid, []).append(machine_id)
+    return list(grupos.items())
+
+
+machine_status_view.registrar_refresh(_status_refresh_agendado)
 
 
 @machine_bp.route("/maquina/<machine_id>/historico", methods=["GET"])
@@ -1,6 +1,6 @@
 # Caminho: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\machine_service.py
-# Último recode: 2026-01-22 08:05 (America/Bahia)
-# Motivo: NP - usar SELECT direto no DB para db_total_hora antes do catch-up (nao confiar em m["np_por_hora_24"]), evitando delta_to_persist=0 por valor fantasma e destravando a hora 07-08.
+# Último recode: 2026-10-17 21:30 (America/Bahia)
+# Motivo: is_fora_do_turno consulta a agenda compilada do turno (machine_agenda) em vez de strptime a cada leitura.
 
 from __future__ import annotations
 
@@ -9,6 +9,7 @@ from zoneinfo import ZoneInfo
 from typing import Optional, List
 
 from modules.db_indflow import get_db
+from modules.machine_agenda import agenda_turno_unico
 
 # Repo NP (persistência)
 try:
@@ -287,23 +288,6 @@ def buscar_historico(machine_id=None, inicio=None, fim=None):
 # ============================================================
 # NÃO PROGRAMADO (HORA EXTRA) — ORQUESTRAÇÃO
 # ============================================================
-def _parse_turno_range(agora: datetime, inicio_str: str, fim_str: str):
-    ini = datetime.strptime(inicio_str, "%H:%M").time()
-    fim = datetime.strptime(fim_str, "%H:%M").time()
-
-    inicio_dt = agora.replace(hour=ini.hour, minute=ini.minute, second=0, microsecond=0)
-    fim_dt = agora.replace(hour=fim.hour, minute=fim.minute, second=0, microsecond=0)
-
-    if fim_dt <= inicio_dt:
-        fim_dt += timedelta(days=1)
-
-    if agora < inicio_dt and fim_dt.date() != inicio_dt.date():
-        inicio_dt -= timedelta(days=1)
-        fim_dt -= timedelta(days=1)
-
-    return inicio_dt, fim_dt
-
-
 def is_fora_do_turno(m: dict, agora: Optional[datetime] = None) -> bool:
     a = agora or now_bahia()
 
@@ -316,16 +300,10 @@ def is_fora_do_turno(m: dict, agora: Optional[datetime] = None) -> bool:
                 except Exception:
                     pass
 
-    inicio = (m.get("turno_inicio") or "").strip()
-    fim = (m.get("turno_fim") or "").strip()
-    if not inicio or not fim:
-        return True
-
-    try:
-        inicio_dt, fim_dt = _parse_turno_range(a, inicio, fim)
-        return not (inicio_dt <= a < fim_dt)
-    except Exception:
+    agenda = agenda_turno_unico((m.get("turno_inicio") or "").strip(), (m.get("turno_fim") or "").strip())
+    if agenda is None:
         return True
+    return agenda.turno_em(int(a.hour) * 60 + int(a.minute)) is None
 
 
 def _machine_id_scoped(cliente_id: Optional[str], machine_id: str) -> str:
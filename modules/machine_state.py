@@ -1,14 +1,26 @@
 # modules/machine_state.py
+# LAST_RECODE: 2026-10-18 01:55 America/Bahia
+# MOTIVO: lock_maquina(machine_id): ingest e agendador do status seguram o lock da maquina ao mudar e ao
+#         derivar/publicar machine_data[mid] (deepcopy sem 'dictionary changed size').
 from datetime import datetime
 import json
+import threading
+import time
 
-from modules.db_indflow import get_db
+from modules import event_journal
+from modules.db_indflow import get_db, get_db_path_atual, schema_ready
 from modules.machine_calc import now_bahia, dia_operacional_ref_str
 
 machine_data = {}
 
+_MACHINE_CONFIG_TABLE_OK = False
+
 
 def _ensure_machine_config_table():
+    # schema criado pelas migracoes do init_db (schema_version); fora dele, DDL so 1x por processo
+    global _MACHINE_CONFIG_TABLE_OK
+    if _MACHINE_CONFIG_TABLE_OK or schema_ready():
+        return
     conn = get_db()
     cur = conn.cursor()
     cur.execute("""
@@ -48,6 +60,7 @@ def _ensure_machine_config_table():
         pass
 
     conn.close()
+    _MACHINE_CONFIG_TABLE_OK = True
 
 
 def _load_machine_config(machine_id: str):
@@ -179,6 +192,88 @@ def _load_baseline_diario_state(machine_id: str):
         return None
 
 
+# ============================================================
+# RELOGIO DE PARADA (machine_stop)
+# ============================================================
+# machine_id -> stopped_since_ms, carregado de uma vez no startup (prime_stop_clocks).
+# get_machine consome daqui ao criar a maquina; sem prime, le a linha da maquina 1x.
+_STOP_CLOCK_BOOT = {}
+_STOP_CLOCK_PRIMED = False
+
+
+def prime_stop_clocks() -> int:
+    """Carrega todas as linhas de machine_stop (1 consulta). Retorna quantas maquinas estao paradas."""
+    global _STOP_CLOCK_PRIMED
+    carregado = {}
+    conn = get_db()
+    try:
+        for r in conn.execute("SELECT machine_id, stopped_since_ms FROM machine_stop").fetchall():
+            try:
+                v = int(r[1])
+            except Exception:
+                continue
+            if r[0] and v > 0:
+                carregado[str(r[0])] = v
+    except Exception:
+        # tabela ainda nao existe (banco novo)
+        pass
+    finally:
+        conn.close()
+
+    _STOP_CLOCK_BOOT.clear()
+    _STOP_CLOCK_BOOT.update(carregado)
+    _STOP_CLOCK_PRIMED = True
+    return len(carregado)
+
+
+def _load_stopped_since_ms(machine_id: str) -> int | None:
+    if _STOP_CLOCK_PRIMED:
+        return _STOP_CLOCK_BOOT.pop(machine_id, None)
+
+    conn = get_db()
+    try:
+        row = conn.execute(
+            "SELECT stopped_since_ms FROM machine_stop WHERE machine_id = ? LIMIT 1",
+            (machine_id,),
+        ).fetchone()
+        if not row:
+            return None
+        v = int(row[0])
+        return v if v > 0 else None
+    except Exception:
+        return None
+    finally:
+        conn.close()
+
+
+def reset_stop_clocks(machine_id: str | None = None) -> None:
+    """Admin apagou machine_stop: zera o relogio em memoria (uma maquina ou todas)."""
+    if machine_id is None:
+        _STOP_CLOCK_BOOT.clear()
+    else:
+        _STOP_CLOCK_BOOT.pop(machine_id, None)
+    for mid, m in list(machine_data.items()):
+        if machine_id is None or mid == machine_id:
+            m["stopped_since_ms"] = None
+
+
+# Lock por maquina: machine_data[mid] e mutado pelo ingest e derivado/publicado pelo agendador
+# do status em outra thread. Quem muda o dict e quem deriva + publica (deepcopy) seguram o lock.
+# Ordem: sempre DENTRO da unit_of_work (escritor do banco -> lock da maquina).
+_MAQUINA_LOCKS: dict = {}
+_MAQUINA_LOCKS_LOCK = threading.Lock()
+
+
+def lock_maquina(machine_id: str) -> threading.RLock:
+    """RLock da maquina (mesma normalizacao do get_machine)."""
+    machine_id = (machine_id or "").strip().lower() or "maquina01"
+    with _MAQUINA_LOCKS_LOCK:
+        lock = _MAQUINA_LOCKS.get(machine_id)
+        if lock is None:
+            lock = _MAQUINA_LOCKS[machine_id] = threading.RLock()
+    return lock
+
+
 def get_machine(machine_id: str):
     # ✅ normaliza sempre
     machine_id = (machine_id or "").strip().lower()
@@ -243,6 +338,9 @@ def get_machine(machine_id: str):
             "_bd_esp_last": bd_esp_last,
 
             "_primeiro_update_pendente": primeiro_update_pendente,
+
+            # relogio de parada: fonte em memoria; machine_stop so e gravado na transicao
+            "stopped_since_ms": _load_stopped_since_ms(machine_id),
         }
 
         # Carrega config persistida (se existir) e aplica no estado
@@ -261,3 +359,135 @@ def get_machine(machine_id: str):
             machine_data[machine_id]["conv_m_por_pcs"] = cfg.get("conv_m_por_pcs", 1.0) or 1.0
 
     return machine_data[machine_id]
+
+
+# ============================================================
+# ULTIMO ESTADO POR MAQUINA (machine_state_event)
+# ============================================================
+# chave: (effective_machine_id, cliente_id) -> {"state": "RUN"|"STOP"|..., "ts_ms": int}
+# Fonte unica do "ultimo estado gravado ou pendente": quem grava machine_state_event
+# (request, lote ou journal) chama set_last_state antes de enfileirar.
+# Shard por cliente: cada banco e primado na 1a consulta da thread que aponta para ele.
+machine_last_state = {}
+_LAST_STATE_LOCK = threading.Lock()
+_LAST_STATE_PRIMED: set = set()  # bancos (get_db_path_atual) ja carregados
+
+
+def prime_last_states(effective_machine_id: str | None = None) -> int:
+    """
+    Carrega o ultimo estado das maquinas com 1 consulta (GROUP BY) do banco atual da thread,
+    mais as transicoes ainda na fila do journal (event_journal.ultimos_pendentes).
+    No SQLite, a coluna "state" junto de MAX(ts_ms) vem da mesma linha do maximo.
+    effective_machine_id informado: recarrega so essa maquina.
+    Retorna quantas chaves foram carregadas.
+    """
+    banco = get_db_path_atual()
+    carregado = {}
+    conn = get_db()
+    try:
+        if effective_machine_id is None:
+            rows = conn.execute(
+                "SELECT effective_machine_id, cliente_id, state, MAX(ts_ms) "
+                "FROM machine_state_event GROUP BY effective_machine_id, cliente_id"
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT effective_machine_id, cliente_id, state, MAX(ts_ms) "
+                "FROM machine_state_event WHERE effective_machine_id=? GROUP BY cliente_id",
+                (effective_machine_id,),
+            ).fetchall()
+        for r in rows:
+            if not r[0]:
+                continue
+            carregado[(r[0], r[1])] = {"state": str(r[2] or "").upper(), "ts_ms": int(r[3] or 0)}
+    except Exception:
+        # tabela ainda nao existe (banco novo): indice comeca vazio
+        pass
+    finally:
+        conn.close()
+
+    # transicao ja commitada mas ainda na fila do journal vale mais que o banco
+    for k, v in event_journal.ultimos_pendentes("machine_state_event").items():
+        if effective_machine_id is not None and k[0] != effective_machine_id:
+            continue
+        atual = carregado.get(k)
+        if atual is None or atual["ts_ms"] <= int(v.get("ts_ms") or 0):
+            carregado[k] = {"state": str(v.get("state") or "").upper(), "ts_ms": int(v.get("ts_ms") or 0)}
+
+    with _LAST_STATE_LOCK:
+        # nao sobrescreve o que ja foi gravado depois do SELECT
+        for k, v in carregado.items():
+            atual = machine_last_state.get(k)
+            if atual is None or int(atual.get("ts_ms") or 0) <= v["ts_ms"]:
+                machine_last_state[k] = v
+        if effective_machine_id is None:
+            _LAST_STATE_PRIMED.add(banco)
+    return len(carregado)
+
+
+def get_last_state(effective_machine_id: str, cliente_id: str | None = None) -> str:
+    """Ultimo estado conhecido da maquina ("" se nunca houve evento)."""
+    if get_db_path_atual() not in _LAST_STATE_PRIMED:
+        prime_last_states()
+    with _LAST_STATE_LOCK:
+        v = machine_last_state.get((effective_machine_id, cliente_id))
+    return str((v or {}).get("state") or "")
+
+
+def set_last_state(effective_machine_id: str, cliente_id: str | None, state: str, ts_ms: int) -> None:
+    """Write-through: chamado por quem grava/enfileira uma transicao em machine_state_event."""
+    with _LAST_STATE_LOCK:
+        machine_last_state[(effective_machine_id, cliente_id)] = {
+            "state": str(state or "").upper(),
+            "ts_ms": int(ts_ms or 0),
+        }
+
+
+def forget_last_states(effective_machine_id: str | None = None) -> None:
+    """
+    Invalida o indice (purge/backfill fora do fluxo normal):
+      - effective_machine_id informado: descarta essa maquina e relê do banco
+      - sem argumento: limpa tudo; o proximo get_last_state recarrega
+    """
+    with _LAST_STATE_LOCK:
+        if effective_machine_id is None:
+            machine_last_state.clear()
+            _LAST_STATE_PRIMED.clear()
+            return
+        for k in list(machine_last_state.keys()):
+            if k[0] == effective_machine_id:
+                machine_last_state.pop(k, None)
+    prime_last_states(effective_machine_id)
+
+
+# ============================================================
+# VERSAO POR MAQUINA (ETag)
+# ============================================================
+# Contador em memoria, so cresce. O epoch do processo entra no ETag para um restart nunca
+# repetir um ETag antigo com conteudo diferente.
+VERSAO_EPOCH = format(int(time.time() * 1000), "x")
+
+_VERSOES: dict = {}
+_VERSOES_LOCK = threading.Lock()
+
+
+def bump_version(machine_id: str) -> int:
+    with _VERSOES_LOCK:
+        v = _VERSOES.get(machine_id, 0) + 1
+        _VERSOES[machine_id] = v
+        return v
+
+
+def bump_all_versions() -> None:
+    with _VERSOES_LOCK:
+        for mid in list(_VERSOES.keys()):
+            _VERSOES[mid] += 1
+
+
+def get_version(machine_id: str) -> int:
+    with _VERSOES_LOCK:
+        return _VERSOES.get(machine_id, 0)
+
+
+def etag_for_version(machine_id: str, versao: int) -> str:
+    return f"{VERSAO_EPOCH}-{machine_id}-{int(versao)}"
@@ -0,0 +1,350 @@
+# PATH: modules/machine_status_view.py
+# LAST_RECODE: 2026-10-18 01:30 America/Bahia
+# MOTIVO: Snapshot em memoria do /machine/status. O GET so le o snapshot; quem escreve e o ingest
+#         (/machine/update) e um agendador de fundo (virada de hora/dia, parada por falta de contagem).
+#
+# Regras:
+# - publicar_snapshot(mid, m): copia o estado da maquina (o GET nunca ve um dict sendo alterado).
+# - Agendador: a cada INDFLOW_STATUS_REFRESH_SEC (default 5) roda o refresh registrado para
+#   toda maquina com snapshot; solicitar_refresh(mid) acorda o agendador na hora.
+# - Maquina sem snapshot (pos-deploy, antes do 1o pacote): o GET pede refresh e espera
+#   ate INDFLOW_STATUS_COLD_WAIT_MS (default 1500) pelo primeiro snapshot.
+# - O refresh registrado recebe a LISTA de maquinas do ciclo (lookups compartilhados no lote) e se o
+#   recalculo e completo (pedido explicito) ou so o tick do relogio (ciclo periodico).
+# - Stream (SSE /machine/stream): cada publicacao que muda algum campo de CAMPOS_STREAM gera um
+#   delta para os assinantes da maquina. Fila por assinante limitada (INDFLOW_STREAM_QUEUE, default 64):
+#   encheu => assinante lento e despejado. No maximo INDFLOW_STREAM_MAX_SUBS (default 32) assinantes.
+#   Assinante com cliente so recebe maquinas desse cliente (mesmo assinando por ids).
+# - Schema publico (STATUS_SCHEMA_VERSION): o snapshot guarda so os campos publicos (sem chaves "_*"
+#   de debug/controle e sem config_v2); o JSON serializado fica em cache ate a versao mudar.
+# - INDFLOW_STATUS_REFRESH_SEC=0 desliga o ciclo periodico (pedidos explicitos continuam).
+
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from modules.db_indflow import liberar_conexao_thread
+from modules.machine_state import bump_version, get_version
+
+log = logging.getLogger("indflow")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        v = float((os.getenv(name) or "").strip() or default)
+        return v if v >= 0 else default
+    except Exception:
+        return default
+
+
+_REFRESH_SEC = _env_float("INDFLOW_STATUS_REFRESH_SEC", 5.0)
+_COLD_WAIT_MS = _env_float("INDFLOW_STATUS_COLD_WAIT_MS", 1500.0)
+_STREAM_MAX_SUBS = int(_env_float("INDFLOW_STREAM_MAX_SUBS", 32))
+_STREAM_QUEUE = max(1, int(_env_float("INDFLOW_STREAM_QUEUE", 64)))
+
+# Schema publico do /machine/status. Mudou o formato (remocao/renomeacao de campo) => incrementar.
+STATUS_SCHEMA_VERSION = 1
+
+# Campos internos fora do payload publico (alem de toda chave iniciada por "_")
+_CAMPOS_INTERNOS = frozenset({"config_v2"})
+
+# Projecoes (?fields=) distintas guardadas por snapshot
+_MAX_PROJECOES = 8
+
+# Campos que as telas usam (cards/TV): e o que vai no stream (estado inicial + deltas)
+CAMPOS_STREAM = (
+    "nome", "status", "status_ui", "run", "parado_min",
+    "meta_turno", "producao_turno", "percentual_turno",
+    "meta_hora_pcs", "producao_hora", "producao_hora_liquida", "percentual_hora",
+    "meta_turno_ml", "producao_turno_ml", "meta_hora_ml", "producao_hora_ml",
+    "tempo_medio_min_por_peca", "unidade_1", "unidade_2",
+)
+
+# machine_id -> {"dados": dict (publico), "compacto": dict, "versao": int, "publicado_em": float,
+#                "json": {campos | None: bytes}}
+_SNAPSHOTS: dict = {}
+_LOCK = threading.Lock()
+_PUBLICADO = threading.Condition(_LOCK)
+
+_PENDENTES: set = set()
+_ACORDAR = threading.Event()
+_AGENDADOR: threading.Thread | None = None
+
+# fn(machine_ids: list, completo: bool) -> None: recalcula as maquinas e chama publicar_snapshot;
+# completo=False e o tick periodico (so recalcula o que o relogio mudou)
+_REFRESH_FN = None
+
+
+def registrar_refresh(fn) -> None:
+    global _REFRESH_FN
+    _REFRESH_FN = fn
+
+
+# ============================================================
+# SNAPSHOT
+# ============================================================
+def payload_publico(m: dict) -> dict:
+    """Campos publicos do estado da maquina (schema STATUS_SCHEMA_VERSION)."""
+    out = {k: v for k, v in m.items() if not k.startswith("_") and k not in _CAMPOS_INTERNOS}
+    out["schema_version"] = STATUS_SCHEMA_VERSION
+    return out
+
+
+def compactar(dados: dict) -> dict:
+    return {k: dados.get(k) for k in CAMPOS_STREAM}
+
+
+def publicar_snapshot(machine_id: str, m: dict) -> None:
+    dados = copy.deepcopy(payload_publico(m))
+    compacto = compactar(dados)
+    with _PUBLICADO:
+        anterior = _SNAPSHOTS.get(machine_id)
+        # ingest/config/refugo/reset ja incrementam a versao; o agendador (virada de hora, parado_min)
+        # so incrementa aqui quando o conteudo publico mudou. Republicacao identica mantem o ETag do cliente.
+        versao = get_version(machine_id)
+        if anterior is None or (anterior["versao"] == versao and anterior["dados"] != dados):
+            versao = bump_version(machine_id)
+        _SNAPSHOTS[machine_id] = {
+            "dados": dados,
+            "compacto": compacto,
+            "versao": versao,
+            "publicado_em": time.time(),
+            "json": {},
+        }
+        _PUBLICADO.notify_all()
+
+    prev = anterior["compacto"] if anterior else {}
+    delta = {k: v for k, v in compacto.items() if k not in prev or prev[k] != v}
+    if delta:
+        _difundir(machine_id, dados.get("cliente_id"), delta)
+    _ensure_agendador()
+
+
+def obter_snapshot(machine_id: str) -> dict | None:
+    """Snapshot atual (nao copiar/alterar: e substituido inteiro a cada publicacao)."""
+    with _LOCK:
+        s = _SNAPSHOTS.get(machine_id)
+    return s["dados"] if s else None
+
+
+def obter_snapshot_versionado(machine_id: str) -> tuple | None:
+    """(snapshot, versao) ou None: o GET responde 304 comparando so a versao, sem serializar."""
+    with _LOCK:
+        s = _SNAPSHOTS.get(machine_id)
+    return (s["dados"], s["versao"]) if s else None
+
+
+def normalizar_campos(raw: str | None) -> tuple | None:
+    """?fields=a,b,c -> tupla ordenada (chave do cache de projecao) ou None (payload inteiro)."""
+    campos = sorted({c.strip() for c in (raw or "").split(",") if c.strip()})
+    return tuple(campos) or None
+
+
+def serializar(dados: dict, campos: tuple | None = None) -> bytes:
+    if campos is not None:
+        dados = {k: dados[k] for k in campos if k in dados}
+    return json.dumps(dados, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def obter_json(machine_id: str, campos: tuple | None = None) -> tuple | None:
+    """
+    (json_bytes, versao) do snapshot, serializado 1x por versao/projecao; None se nao houver snapshot.
+    O cache vive dentro da entrada do snapshot: publicar uma versao nova descarta tudo.
+    """
+    with _LOCK:
+        s = _SNAPSHOTS.get(machine_id)
+    if s is None:
+        return None
+    cache = s["json"]
+    body = cache.get(campos)
+    if body is None:
+        body = serializar(s["dados"], campos)
+        if campos is None or len(cache) < _MAX_PROJECOES:
+            cache[campos] = body
+    return body, s["versao"]
+
+
+def aguardar_snapshot(machine_id: str, timeout_ms: float | None = None) -> dict | None:
+    """Maquina fria: pede refresh ao agendador e espera o primeiro snapshot."""
+    solicitar_refresh(machine_id)
+    limite = time.monotonic() + (float(_COLD_WAIT_MS if timeout_ms is None else timeout_ms) / 1000.0)
+    with _PUBLICADO:
+        while machine_id not in _SNAPSHOTS:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return None
+            _PUBLICADO.wait(restante)
+        return _SNAPSHOTS[machine_id]["dados"]
+
+
+def aguardar_snapshots(machine_ids: list, timeout_ms: float | None = None) -> dict:
+    """
+    Versao em lote (status bulk): pede 1 refresh para todas as frias e espera todas juntas.
+    Retorna {machine_id: snapshot} so das que foram publicadas dentro do prazo.
+    """
+    with _LOCK:
+        frias = [mid for mid in machine_ids if mid not in _SNAPSHOTS]
+        _PENDENTES.update(frias)
+    if frias:
+        _ensure_agendador()
+        _ACORDAR.set()
+
+    limite = time.monotonic() + (float(_COLD_WAIT_MS if timeout_ms is None else timeout_ms) / 1000.0)
+    with _PUBLICADO:
+        while any(mid not in _SNAPSHOTS for mid in frias):
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            _PUBLICADO.wait(restante)
+        return {mid: _SNAPSHOTS[mid]["dados"] for mid in machine_ids if mid in _SNAPSHOTS}
+
+
+def esquecer_snapshot(machine_id: str | None = None) -> None:
+    with _LOCK:
+        if machine_id is None:
+            _SNAPSHOTS.clear()
+        else:
+            _SNAPSHOTS.pop(machine_id, None)
+
+
+def snapshot_ids() -> list:
+    with _LOCK:
+        return list(_SNAPSHOTS.keys())
+
+
+# ============================================================
+# STREAM (assinantes do SSE)
+# ============================================================
+# assinante: {"fila": Queue, "ids": set | None, "cliente_id": str | None, "ativo": bool}
+_ASSINANTES: list = []
+_STREAM_STATS = {"despejados": 0, "recusados": 0}
+
+
+def assinar(ids: list | None = None, cliente_id: str | None = None) -> dict | None:
+    """
+    Registra um assinante para as maquinas `ids` (ou todas do `cliente_id`).
+    Com os dois, so as `ids` que forem do `cliente_id`; ids=[] nao assina nenhuma.
+    Retorna None se o limite de assinantes foi atingido.
+    """
+    ass = {
+        "fila": queue.Queue(maxsize=_STREAM_QUEUE),
+        "ids": set(ids) if ids is not None else None,
+        "cliente_id": (cliente_id or "").strip() or None,
+        "ativo": True,
+    }
+    with _LOCK:
+        if len(_ASSINANTES) >= _STREAM_MAX_SUBS:
+            _STREAM_STATS["recusados"] += 1
+            return None
+        _ASSINANTES.append(ass)
+    return ass
+
+
+def cancelar_assinatura(ass: dict) -> None:
+    with _LOCK:
+        ass["ativo"] = False
+        try:
+            _ASSINANTES.remove(ass)
+        except ValueError:
+            pass
+
+
+def _assinante_quer(ass: dict, machine_id: str, cliente_id) -> bool:
+    if ass["ids"] is not None and machine_id not in ass["ids"]:
+        return False
+    if ass["cliente_id"]:
+        return (cliente_id or "").strip() == ass["cliente_id"]
+    return ass["ids"] is not None
+
+
+def estado_assinado(ass: dict) -> dict:
+    """Estado compacto atual das maquinas do assinante (evento inicial do stream)."""
+    with _LOCK:
+        out = {}
+        for mid, snap in _SNAPSHOTS.items():
+            if _assinante_quer(ass, mid, snap["dados"].get("cliente_id")):
+                out[mid] = dict(snap["compacto"])
+        return out
+
+
+def _difundir(machine_id: str, cliente_id, delta: dict) -> None:
+    evento = {"machine_id": machine_id, "dados": delta}
+    with _LOCK:
+        alvos = [a for a in _ASSINANTES if _assinante_quer(a, machine_id, cliente_id)]
+    for ass in alvos:
+        try:
+            ass["fila"].put_nowait(evento)
+        except queue.Full:
+            # consumidor lento: despeja (o cliente reconecta e recebe o estado inteiro de novo)
+            cancelar_assinatura(ass)
+            with _LOCK:
+                _STREAM_STATS["despejados"] += 1
+
+
+def stream_stats() -> dict:
+    with _LOCK:
+        out = dict(_STREAM_STATS)
+        out["assinantes"] = len(_ASSINANTES)
+    out["max_assinantes"] = _STREAM_MAX_SUBS
+    out["fila_max"] = _STREAM_QUEUE
+    return out
+
+
+# ============================================================
+# AGENDADOR
+# ============================================================
+def solicitar_refresh(machine_id: str) -> None:
+    """Config/refugo/reset mudaram a maquina fora do ingest: recalcula no agendador (assincrono)."""
+    if not machine_id:
+        return
+    with _LOCK:
+        _PENDENTES.add(machine_id)
+    _ensure_agendador()
+    _ACORDAR.set()
+
+
+def _ensure_agendador() -> None:
+    global _AGENDADOR
+    if _AGENDADOR is not None and _AGENDADOR.is_alive():
+        return
+    with _LOCK:
+        if _AGENDADOR is not None and _AGENDADOR.is_alive():
+            return
+        _AGENDADOR = threading.Thread(target=_agendador_loop, name="indflow-status-refresh", daemon=True)
+        _AGENDADOR.start()
+
+
+def _agendador_loop() -> None:
+    proximo_ciclo = time.monotonic() + _REFRESH_SEC
+    while True:
+        espera = (proximo_ciclo - time.monotonic()) if _REFRESH_SEC > 0 else None
+        if espera is None or espera > 0:
+            _ACORDAR.wait(espera)
+        _ACORDAR.clear()
+
+        with _LOCK:
+            pedidos = set(_PENDENTES)
+            _PENDENTES.clear()
+            periodicos = set()
+            if _REFRESH_SEC > 0 and time.monotonic() >= proximo_ciclo:
+                periodicos = set(_SNAPSHOTS.keys()) - pedidos
+                proximo_ciclo = time.monotonic() + _REFRESH_SEC
+
+        fn = _REFRESH_FN
+        if fn is None:
+            continue
+        # pedidos explicitos (config/refugo/reset/maquina fria) recalculam tudo; o ciclo periodico
+        # e so o "tick" do relogio: a funcao decide por maquina se algo mudou com o tempo
+        for ids, completo in ((pedidos, True), (periodicos, False)):
+            if not ids:
+                continue
+            try:
+                fn(sorted(ids), completo)
+            except Exception:
+                log.exception("status-refresh: falha no ciclo (%d maquinas)", len(ids))
+        # fim de ciclo = fim de request: handle esquecido / transacao aberta nao passa ao proximo
+        liberar_conexao_thread()
@@ -1,17 +1,15 @@
-import sqlite3
 from datetime import date
-from pathlib import Path
 
-# ============================================
-# CONFIG
-# ============================================
-DB_PATH = Path("indflow.db")
+from modules.db_indflow import get_db
 
 # ============================================
 # CONEXÃO
 # ============================================
 def get_conn():
-    return sqlite3.connect(DB_PATH)
+    # mesmo banco/conexao do app (db_indflow); antes abria "indflow.db" relativo ao CWD
+    conn = get_db()
+    conn.row_factory = None
+    return conn
 
 # ============================================
 # INIT DB
@@ -23,10 +21,11 @@ def init_db():
     cur.execute("""
         CREATE TABLE IF NOT EXISTS producao_diaria (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            machine_id TEXT NOT NULL,
-            data TEXT NOT NULL,
-            produzido INTEGER NOT NULL,
-            meta INTEGER NOT NULL
+            machine_id TEXT,
+            data TEXT,
+            produzido INTEGER,
+            meta INTEGER,
+            percentual INTEGER
         )
     """)
 
@@ -82,7 +81,7 @@ def listar_historico(machine_id=None, limit=30):
             "data": r[1],
             "produzido": r[2],
             "meta": r[3],
-            "percentual": round((r[2] / r[3]) * 100) if r[3] > 0 else 0
+            "percentual": round(((r[2] or 0) / r[3]) * 100) if (r[3] or 0) > 0 else 0
         }
         for r in rows
     ]
@@ -1,11 +1,11 @@
 # PATH: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\producao\historico_routes.py
-# ULTIMO_RECODE: 2026-03-04 21:30:00
-# MOTIVO: Detalhe-dia: hours[].produzido deve vir de SUM(delta) em producao_evento por janela local (America/Bahia), evitando sobrescrita por machine_state.
+# ULTIMO_RECODE: 2026-10-17 23:45:00
+# MOTIVO: GET /api/producao/historico e /api/producao/detalhe-dia leem pela conexao somente-leitura
+#         (get_db_leitura); o backfill (POST) continua na conexao de escrita.
 
 
 from __future__ import annotations
 
-import os
 import json
 import sqlite3
 import traceback
@@ -15,16 +15,19 @@ from zoneinfo import ZoneInfo
 from flask import Blueprint, jsonify, render_template, request
 
 try:
-    from modules.db_indflow import init_db, get_db
+    from modules.db_indflow import init_db, get_db, get_db_leitura
 except Exception:
     init_db = None
     get_db = None
+    get_db_leitura = None
 
 try:
     from modules.machine_state import get_machine
 except Exception:
     get_machine = None
 
+from modules.machine_agenda import agenda_de
+
 TZ_BAHIA = ZoneInfo("America/Bahia")
 
 def _to_sql_dt(dt: datetime) -> str:
@@ -62,17 +65,17 @@ historico_bp = Blueprint(
     template_folder="templates",
 )
 
-def _sqlite_connect(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+def _get_conn():
+    # conexao da thread via db_indflow (mesmo caminho e PRAGMAs do resto do app)
+    return get_db()
 
-def _get_conn() -> sqlite3.Connection:
-    if callable(get_db):
-        return get_db()
 
-    db_path = os.environ.get("INDFLOW_DB_PATH") or os.environ.get("DB_PATH") or "/data/indflow.db"
-    return _sqlite_connect(db_path)
+def _get_conn_leitura():
+    # GET de relatorio: conexao somente-leitura (mode=ro + query_only); varredura longa
+    # de producao_evento/diaria nao segura lock junto do /machine/update
+    if callable(get_db_leitura):
+        return get_db_leitura()
+    return _get_conn()
 
 
 def _hhmmss_to_sec(s: str) -> int:
@@ -351,27 +354,20 @@ def _resolve_effective_machine_id(conn: sqlite3.Connection, machine_id: str, dat
         return mid
 
     col = _resolve_data_col(conn, "producao_diaria")
+    where_pk, params_pk = _sql_machine_pks(mid)
 
+    # so as variantes escopadas (a linha do mid legado e o fallback abaixo)
     sql = f"""
         SELECT machine_id
           FROM producao_diaria
-         WHERE {col} = ?
-           AND (
-                machine_id LIKE ?
-             OR machine_id LIKE ?
-           )
+         WHERE {where_pk} AND {col} = ?
+           AND instr(machine_id, '::') > 0
          ORDER BY produzido DESC
          LIMIT 1
     """
 
-    # Tenta casar pelos 2 formatos:
-    # 1) <cliente>::<maquina> -> termina com ::mid
-    # 2) <maquina>::<op/ctx>  -> comeca com mid::
-    like_suffix = f"%::{mid}"
-    like_prefix = f"{mid}::%"
-
     try:
-        row = _fetch_one(conn, sql, (data_ref, like_suffix, like_prefix))
+        row = _fetch_one(conn, sql, (*params_pk, data_ref))
         if row and row["machine_id"]:
             return str(row["machine_id"])
     except Exception:
@@ -379,6 +375,22 @@ def _resolve_effective_machine_id(conn: sqlite3.Connection, machine_id: str, dat
 
     return mid
 
+
+def _sql_machine_pks(mid: str) -> tuple[str, tuple]:
+    """
+    Filtro (SQL, params) pelas machine_pk de todas as variantes de um machine_id legado
+    (cadastro machines, migracao 10), no lugar de LIKE '%::mid' / LIKE 'mid::%':
+      1) <cliente>::<maquina> e <maquina> -> code = mid (qualquer cliente)
+      2) <maquina>::<op/ctx>              -> faixa de code [mid::, mid:;)  (';' vem depois de ':')
+    machines e pequena; producao_diaria e lida pelo indice (machine_pk, data).
+    """
+    m = (mid or "").strip().lower()
+    return (
+        "machine_pk IN (SELECT id FROM machines WHERE code = ? OR (code >= ? AND code < ?))",
+        (m, f"{m}::", f"{m}:;"),
+    )
+
+
 def _parse_date_any(s: str | None) -> date | None:
     if not s:
         return None
@@ -490,22 +502,6 @@ def _build_meta_24_from_machine_state(machine_state: dict | None) -> list[int] |
 
     return meta24
 
-def _parse_hhmm_to_min(hhmm: str) -> int | None:
-    s = (hhmm or '').strip()
-    if not s or ':' not in s:
-        return None
-    try:
-        hh = int(s.split(':')[0])
-        mm = int(s.split(':')[1])
-        if hh < 0 or hh > 23 or mm < 0 or mm > 59:
-            return None
-        return hh * 60 + mm
-    except Exception:
-        return None
-
-def _intervals_intersect(a_s: int, a_e: int, b_s: int, b_e: int) -> bool:
-    return (a_s < b_e) and (b_s < a_e)
-
 def _build_meta_24_from_config_v2(cfg: dict | None, data_ref: date) -> list[int] | None:
     """Monta meta[24] a partir do config_v2 (shifts + breaks).
 
@@ -515,6 +511,7 @@ def _build_meta_24_from_config_v2(cfg: dict | None, data_ref: date) -> list[int]
     - Para cada shift: horas dentro do shift e fora dos breaks recebem meta constante (meta_pcs / horas_planejadas)
     - Horas dentro de breaks recebem 0
     - Turnos que cruzam meia-noite sao suportados (ex.: 22:00-06:00)
+    O calculo fica pre-compilado na agenda da config (modules/machine_agenda): aqui e so consulta.
     """
     if not isinstance(cfg, dict):
         return None
@@ -526,99 +523,10 @@ def _build_meta_24_from_config_v2(cfg: dict | None, data_ref: date) -> list[int]
     if cv2 is None:
         return None
 
-    active_days = cv2.get('active_days')
-    if isinstance(active_days, list) and active_days:
-        try:
-            dow = int(data_ref.isoweekday())
-            if dow not in [int(x) for x in active_days if isinstance(x, (int, float, str)) and str(x).strip() != '']:
-                return [0] * 24
-        except Exception:
-            pass
-
-    shifts = cv2.get('shifts')
-    if not isinstance(shifts, list) or not shifts:
+    agenda = agenda_de(cv2)
+    if agenda is None:
         return None
-
-    meta24 = [0] * 24
-
-    for sh in shifts:
-        if not isinstance(sh, dict):
-            continue
-        s_min = _parse_hhmm_to_min(str(sh.get('start') or ''))
-        e_min = _parse_hhmm_to_min(str(sh.get('end') or ''))
-        if s_min is None or e_min is None:
-            continue
-        if e_min <= s_min:
-            e_min += 1440  # vira o dia
-
-        # breaks (mapear para o mesmo timeline do shift)
-        br_intervals: list[tuple[int, int]] = []
-        brs = sh.get('breaks')
-        if isinstance(brs, list):
-            for br in brs:
-                if not isinstance(br, dict):
-                    continue
-                bs = _parse_hhmm_to_min(str(br.get('start') or ''))
-                be = _parse_hhmm_to_min(str(br.get('end') or ''))
-                if bs is None or be is None:
-                    continue
-                if be <= bs:
-                    be += 1440
-                # se o break estiver antes do inicio e o shift virar, joga pro dia seguinte
-                if bs < s_min and e_min > 1440:
-                    bs += 1440
-                    be += 1440
-                br_intervals.append((bs, be))
-
-        meta_pcs = _safe_int(sh.get('meta_pcs'), 0)
-        planned_min = None
-        calc = sh.get('calc')
-        if isinstance(calc, dict):
-            planned_min = _safe_int(calc.get('planned_min'), 0)
-        if planned_min is None or planned_min <= 0:
-            # fallback: duracao - breaks
-            dur = e_min - s_min
-            br_total = 0
-            for bs, be in br_intervals:
-                br_total += max(0, be - bs)
-            planned_min = max(0, dur - br_total)
-
-        planned_hours = planned_min / 60.0 if planned_min else 0.0
-        if meta_pcs <= 0 or planned_hours <= 0:
-            meta_h = 0
-        else:
-            # manter o mesmo comportamento da tela 24h: meta constante arredondada
-            try:
-                meta_h = int(round(float(meta_pcs) / float(planned_hours)))
-            except Exception:
-                meta_h = int(round(meta_pcs / max(planned_hours, 1.0)))
-
-        # aplicar nas 24 horas do relogio (considerar timeline dia0 e dia1)
-        for hh in range(24):
-            h0_s = hh * 60
-            h0_e = (hh + 1) * 60
-            h1_s = h0_s + 1440
-            h1_e = h0_e + 1440
-
-            inside = _intervals_intersect(h0_s, h0_e, s_min, e_min) or _intervals_intersect(h1_s, h1_e, s_min, e_min)
-            if not inside:
-                continue
-
-            in_break = False
-            for bs, be in br_intervals:
-                if _intervals_intersect(h0_s, h0_e, bs, be) or _intervals_intersect(h1_s, h1_e, bs, be):
-                    in_break = True
-                    break
-
-            if in_break:
-                # se outro turno ja colocou meta positiva, nao derruba; mas break do turno atual zera a hora dele
-                # como os turnos nao deveriam se sobrepor, podemos zerar direto
-                meta24[hh] = 0
-            else:
-                if meta_h > meta24[hh]:
-                    meta24[hh] = meta_h
-
-    return meta24
+    return agenda.meta_24(int(data_ref.isoweekday()))
 
 
 def _merge_intervals(intervals: list[tuple[datetime, datetime]]) -> list[tuple[datetime, datetime]]:
@@ -1243,37 +1151,24 @@ def _diaria_do_dia(conn: sqlite3.Connection, machine_id: str, data_ref: str) ->
     if mid_raw:
         mids.add(str(mid_raw))
 
-    # Quando o request vem sem scope, considere tambem possiveis variacoes no banco.
-    like_scoped = None
-    like_legacy = None
+    # Quando o request vem sem scope, so valem as variacoes escopadas (<cliente>::<maquina>).
+    # Filtro feito aqui nos candidatos (antes era LIKE '%::mid' no SQL): a consulta fica so por
+    # igualdade e usa o indice (machine_id, data).
     if "::" not in mid_raw and mid_uns:
-        like_scoped = f"%::{mid_uns.lower()}"
-        like_legacy = f"%:{mid_uns.lower()}"
-
-    where = [f"{col} = ?"]
-    params = [data_ref]
+        sufixo = f"::{mid_uns.lower()}"
+        mids = {m for m in mids if m.lower().endswith(sufixo)}
 
+    rows = []
     if mids:
-        where.append("machine_id IN ({})".format(",".join(["?"] * len(mids))))
-        params.extend(list(mids))
-
-    if like_scoped:
-        where.append("machine_id LIKE ?")
-        params.append(like_scoped)
-    if like_legacy:
-        where.append("machine_id LIKE ?")
-        params.append(like_legacy)
-
-    sql = (
-        "SELECT machine_id, produzido, meta, percentual "
-        "FROM producao_diaria "
-        "WHERE " + " AND ".join(where)
-    )
-
-    try:
-        rows = conn.execute(sql, tuple(params)).fetchall()
-    except Exception:
-        rows = []
+        sql = (
+            "SELECT machine_id, produzido, meta, percentual "
+            "FROM producao_diaria "
+            "WHERE machine_id IN ({}) AND {} = ?".format(",".join(["?"] * len(mids)), col)
+        )
+        try:
+            rows = conn.execute(sql, (*mids, data_ref)).fetchall()
+        except Exception:
+            rows = []
 
     if not rows:
         return {"produzido": 0, "meta": None, "percentual": None, "_mid": eff_mid}
@@ -1422,7 +1317,7 @@ def api_producao_historico():
     hoje = datetime.now(TZ_BAHIA).date()
     inicio = hoje - timedelta(days=days - 1)
 
-    conn = _get_conn()
+    conn = _get_conn_leitura()
     try:
         dados = []
 
@@ -1475,7 +1370,7 @@ def api_producao_detalhe_dia():
             now_naive = now_dt.replace(tzinfo=None)
     except Exception:
         now_naive = None
-    conn = _get_conn()
+    conn = _get_conn_leitura()
     try:
         try:
             # Resolve machine_id efetivo (scoped) para evitar "horas zeradas" quando o dia foi gravado como <cliente>::<maquina>.
@@ -1899,22 +1794,17 @@ def api_producao_backfill_horaria():
                 col = _resolve_data_col(conn0, "producao_diaria")
                 mid_raw = (machine_id or "").strip()
                 mid_uns = mid_raw.split("::", 1)[1] if "::" in mid_raw else mid_raw
-                like_suffix = f"%::{mid_uns}"
-                like_prefix = f"{mid_uns}::%"
+                where_pk, params_pk = _sql_machine_pks(mid_uns)
 
                 row = _fetch_one(
                     conn0,
                     f"""
                     SELECT MIN({col}) as dmin
                       FROM producao_diaria
-                     WHERE COALESCE(produzido,0) > 0
-                       AND (
-                            machine_id = ?
-                         OR machine_id LIKE ?
-                         OR machine_id LIKE ?
-                       )
+                     WHERE {where_pk}
+                       AND COALESCE(produzido,0) > 0
                     """,
-                    (mid_raw, like_suffix, like_prefix),
+                    params_pk,
                 )
                 dmin = _parse_date_any(str(row["dmin"]) if row and row["dmin"] else None)
                 d_from = dmin or (hoje - timedelta(days=days - 1))
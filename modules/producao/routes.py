@@ -1,19 +1,20 @@
 # PATH: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\producao\routes.py
-# LAST_RECODE: 2026-03-06 21:20:00 (America/Bahia)
-# MOTIVO: Corrigir /op/salvar para preservar bobinas 1-based sem zerar dados ao salvar fechamento manual.
+# LAST_RECODE: 2026-10-18 00:15:00 (America/Bahia)
+# MOTIVO: init_op_db registrado no db_indflow para criar as tabelas de OP/bobinas em cada shard de cliente
+#         (INDFLOW_SHARD_MODE=cliente).
 from flask import Blueprint, render_template, redirect, request, jsonify
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 import sqlite3
 import os
 import json
-from pathlib import Path
 from threading import Lock
 
 # =====================================================
 # AUTH
 # =====================================================
 from modules.admin.routes import login_required
+from modules.db_indflow import get_db, registrar_schema_shard
 
 # =====================================================
 # DATA (SQLite) - historico diario existente
@@ -89,6 +90,8 @@ def _get_current_esp_snapshot(conn: sqlite3.Connection, machine_id: str):
     """
     try:
         cur = conn.cursor()
+        # machine_id e gravado minusculo (migracao 9): igualdade usa o indice (machine_id, dia)
+        mid = (machine_id or "").strip().lower()
 
         cand = []
 
@@ -98,11 +101,11 @@ def _get_current_esp_snapshot(conn: sqlite3.Connection, machine_id: str):
                 """
                 SELECT esp_last, updated_at
                 FROM baseline_diario
-                WHERE lower(machine_id)=lower(?)
+                WHERE machine_id = ?
                 ORDER BY dia_ref DESC, updated_at DESC, id DESC
                 LIMIT 1
                 """,
-                (machine_id,),
+                (mid,),
             ).fetchone()
             if row and row[0] is not None:
                 esp = int(row[0])
@@ -117,11 +120,11 @@ def _get_current_esp_snapshot(conn: sqlite3.Connection, machine_id: str):
                 """
                 SELECT esp_last, updated_at
                 FROM producao_horaria
-                WHERE lower(machine_id)=lower(?)
+                WHERE machine_id = ?
                 ORDER BY data_ref DESC, hora_idx DESC, updated_at DESC, id DESC
                 LIMIT 1
                 """,
-                (machine_id,),
+                (mid,),
             ).fetchone()
             if row and row[0] is not None:
                 esp = int(row[0])
@@ -269,7 +272,6 @@ def get_machine(machine_id: str):
 # =====================================================
 # OP (ORDEM DE PRODUCAO) - SQLITE + MEMORIA
 # =====================================================
-DB_PATH = Path(__import__("os").environ.get("INDFLOW_DB_PATH", "indflow.db"))
 # =====================================================
 # HISTORICO DIARIO - GARANTIR DIA ATUAL (OPCAO 3)
 #   Objetivo: o Historico deve sempre conter o dia corrente,
@@ -636,11 +638,9 @@ op_active = {}
 
 
 def _get_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
-    try:
-        conn.execute("PRAGMA busy_timeout=3000")
-    except Exception:
-        pass
+    # conexao da thread (db_indflow: WAL + busy_timeout); linhas como tupla, como o modulo sempre usou
+    conn = get_db()
+    conn.row_factory = None
     return conn
 
 
@@ -702,6 +702,9 @@ def init_op_db():
         except Exception:
             pass
 
+    # _fetch_ops_for_range: maquina + faixa de started_at
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_ordens_producao_mid_started ON ordens_producao(machine_id, started_at)")
+
     # -------------------------------------------------
     # TABELA: FECHAMENTO POR BOBINA (1 OP pode ter N bobinas)
     # -------------------------------------------------
@@ -837,6 +840,9 @@ except Exception:
     # Nao derrubar o app caso falhe criar tabela em runtime
     pass
 
+# shard por cliente: tabelas de OP/bobinas tambem em cada banco de cliente novo
+registrar_schema_shard(init_op_db)
+
 
 def _now_iso():
     tz = _get_tz()
@@ -1627,11 +1633,23 @@ def apply_bobina_swap_pending_on_update(machine_id: str, esp_abs: int, ts_iso: s
                 conn.close()
         except Exception:
             pass
+def _dia_seguinte_iso(dia: str) -> str:
+    """'YYYY-MM-DD' do dia seguinte (limite exclusivo de faixa em colunas ISO texto)."""
+    try:
+        return (datetime.strptime(str(dia)[:10], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    except Exception:
+        # fora do formato: '~' ordena depois de qualquer resto de timestamp ISO com o mesmo prefixo
+        return str(dia) + "~"
+
+
 def _fetch_ops_for_range(machine_id: str | None, day_min: str, day_max: str):
     """
     Busca OPs que cruzam o intervalo [day_min, day_max].
     start_day <= day_max AND (end_day >= day_min OR end_day IS NULL).
 
+    Em texto ISO, substr(x,1,10) <= D equivale a x < dia_seguinte(D) e substr(x,1,10) >= D a x >= D:
+    a comparacao direta na coluna usa o indice (machine_id, started_at).
+
     Retorna tambem:
       - bobinas: lista de comprimentos (metros) cadastrada na OP
       - bobinas_itens: lista por bobina com pcs_total/metro_consumido + campos de fechamento
@@ -1646,11 +1664,11 @@ def _fetch_ops_for_range(machine_id: str | None, day_min: str, day_max: str):
                    qtd_mat_bom, qtd_cost_elas, refugo, qtd_saco_caixa
             FROM ordens_producao
             WHERE machine_id = ?
-              AND substr(started_at, 1, 10) <= ?
-              AND (ended_at IS NULL OR substr(ended_at, 1, 10) >= ?)
+              AND started_at < ?
+              AND (ended_at IS NULL OR ended_at >= ?)
             ORDER BY started_at DESC
             """,
-            (machine_id, day_max, day_min),
+            (machine_id, _dia_seguinte_iso(day_max), str(day_min)[:10]),
         )
     else:
         cur.execute(
@@ -1658,11 +1676,11 @@ def _fetch_ops_for_range(machine_id: str | None, day_min: str, day_max: str):
             SELECT id, machine_id, os, lote, operador, bobina, gr_fio, observacoes, started_at, ended_at, status, op_metros, op_pcs, op_conv_m_por_pcs,
                    qtd_mat_bom, qtd_cost_elas, refugo, qtd_saco_caixa
             FROM ordens_producao
-            WHERE substr(started_at, 1, 10) <= ?
-              AND (ended_at IS NULL OR substr(ended_at, 1, 10) >= ?)
+            WHERE started_at < ?
+              AND (ended_at IS NULL OR ended_at >= ?)
             ORDER BY started_at DESC
             """,
-            (day_max, day_min),
+            (_dia_seguinte_iso(day_max), str(day_min)[:10]),
         )
 
     rows = cur.fetchall()
@@ -2091,8 +2109,7 @@ def api_detalhe_dia():
     # stop_sec da config (se existir), senao 120.
     stop_sec = 120
     try:
-        conn_cfg = sqlite3.connect(str(DB_PATH))
-        conn_cfg.row_factory = sqlite3.Row
+        conn_cfg = get_db()
         try:
             row = conn_cfg.execute(
                 "SELECT config_json FROM machine_config WHERE machine_id = ? ORDER BY id DESC LIMIT 1",
@@ -2118,8 +2135,7 @@ def api_detalhe_dia():
 
     # Backfill somente se ainda nao houver eventos para esse dia/maquina.
     try:
-        conn = sqlite3.connect(str(DB_PATH))
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
 
         # Tabela pode nao existir em DBs antigos (defensivo).
         conn.execute(
@@ -2146,17 +2162,20 @@ def api_detalhe_dia():
         existing_count = int(existing["c"] if existing and existing["c"] is not None else 0)
 
         if existing_count == 0:
-            # Puxa pulsos do dia (fonte persistida e estavel).
+            # Puxa pulsos do dia (fonte persistida e estavel). Mesmo dia UTC de date(ts_ms/1000,'unixepoch'),
+            # mas como faixa de ts_ms: usa o indice (machine_id, ts_ms).
+            ini_ms = int(datetime.combine(data_ref, datetime.min.time(), tzinfo=timezone.utc).timestamp() * 1000)
+            fim_ms = ini_ms + 86400000
             rows = conn.execute(
-                "SELECT ts_ms FROM producao_evento WHERE machine_id = ? AND date(ts_ms/1000,'unixepoch') = ? ORDER BY ts_ms ASC",
-                (eff_mid, data_ref_str),
+                "SELECT ts_ms FROM producao_evento WHERE machine_id = ? AND ts_ms >= ? AND ts_ms < ? ORDER BY ts_ms ASC",
+                (eff_mid, ini_ms, fim_ms),
             ).fetchall()
 
             # Se nao achar pelo eff_mid, tenta pelo machine_id original (caso tenha scope no evento).
             if (not rows) and (machine_id != eff_mid):
                 rows = conn.execute(
-                    "SELECT ts_ms FROM producao_evento WHERE machine_id = ? AND date(ts_ms/1000,'unixepoch') = ? ORDER BY ts_ms ASC",
-                    (machine_id, data_ref_str),
+                    "SELECT ts_ms FROM producao_evento WHERE machine_id = ? AND ts_ms >= ? AND ts_ms < ? ORDER BY ts_ms ASC",
+                    (machine_id, ini_ms, fim_ms),
                 ).fetchall()
 
             ts_list = [int(r["ts_ms"]) for r in rows if r and r["ts_ms"] is not None]
@@ -2222,6 +2241,13 @@ def api_detalhe_dia():
                             last_state = "STOP"
 
                 conn.commit()
+
+                # backfill gravou fora do fluxo do ESP: indice de ultimo estado relê essa maquina
+                try:
+                    from modules.machine_state import forget_last_states
+                    forget_last_states(eff_mid)
+                except Exception:
+                    pass
     except Exception:
         try:
             conn.rollback()
@@ -1,6 +1,6 @@
 # modules/repos/baseline_repo.py
 
-from modules.db_indflow import get_db
+from modules.db_indflow import get_db, schema_ready
 from modules.machine_calc import now_bahia, dia_operacional_ref_str
 
 
@@ -42,6 +42,9 @@ def _has_column(conn, table: str, col: str) -> bool:
 # ============================================================
 
 def ensure_baseline_diario_table():
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn = get_db()
     cur = conn.cursor()
 
@@ -109,6 +112,7 @@ def persistir_baseline_diario(machine_id: str, esp_abs: int):
     agora = now_bahia()
     dia_ref = dia_operacional_ref_str(agora)
 
+    conn = None
     try:
         conn = get_db()
         ensure_baseline_diario_table()
@@ -152,9 +156,11 @@ def persistir_baseline_diario(machine_id: str, esp_abs: int):
             ))
 
         conn.commit()
-        conn.close()
     except Exception:
         pass
+    finally:
+        if conn is not None:
+            conn.close()
 
 
 def carregar_baseline_diario(m: dict, machine_id: str):
@@ -192,6 +198,7 @@ def carregar_baseline_diario(m: dict, machine_id: str):
     ):
         return
 
+    conn = None
     try:
         conn = get_db()
         ensure_baseline_diario_table()
@@ -263,7 +270,6 @@ def carregar_baseline_diario(m: dict, machine_id: str):
             ))
 
         conn.commit()
-        conn.close()
 
         # aplica no estado em memória
         m["baseline_diario"] = int(baseline)
@@ -275,3 +281,6 @@ def carregar_baseline_diario(m: dict, machine_id: str):
         # fallback seguro
         if "baseline_diario" not in m:
             m["baseline_diario"] = esp_abs
+    finally:
+        if conn is not None:
+            conn.close()
@@ -1,10 +1,10 @@
 # Caminho: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\repos\machine_config_repo.py
-# Último recode: 2026-01-20 19:20 (America/Bahia)
-# Motivo: Persistir configuração por máquina do "Alerta de Parada por Inatividade" (alerta_sem_contagem_seg) no machine_config.
+# Último recode: 2026-10-18 01:30 (America/Bahia)
+# Motivo: upsert_machine_config fecha o handle do get_db() em finally (mesmo com excecao engolida).
 
 import json
 from datetime import datetime
-from modules.db_indflow import get_db
+from modules.db_indflow import get_db, schema_ready
 
 
 def _ensure_column(conn, table: str, col: str, ddl: str) -> None:
@@ -25,6 +25,9 @@ def _ensure_column(conn, table: str, col: str, ddl: str) -> None:
 
 
 def ensure_machine_config_table():
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn = get_db()
     cur = conn.cursor()
     cur.execute("""
@@ -78,6 +81,7 @@ def upsert_machine_config(machine_id: str, m: dict):
     if not machine_id:
         return False
 
+    conn = None
     try:
         ensure_machine_config_table()
 
@@ -150,7 +154,9 @@ def upsert_machine_config(machine_id: str, m: dict):
             datetime.now().isoformat()
         ))
         conn.commit()
-        conn.close()
         return True
     except Exception:
         return False
+    finally:
+        if conn is not None:
+            conn.close()
@@ -1,9 +1,11 @@
 # Caminho: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\repos\nao_programado_horaria_repo.py
-# Último recode: 2026-01-22 07:40 (America/Bahia)
-# Motivo: Corrigir NP horaria que nao atualiza apesar de upsert/load "OK": detectar schema antigo e migrar tabela nao_programado_horaria automaticamente, evitando falha silenciosa e garantindo coluna produzido/hora_dia.
+# Último recode: 2026-10-18 01:25 (America/Bahia)
+# Motivo: Cache NP 24h: geracao de escrita; load concorrente com upsert_delta nao grava no cache o array
+#         lido antes da escrita (chave sem entrada e descartada de novo no commit).
 
 from __future__ import annotations
 
+import threading
 from typing import List, Optional, Tuple
 
 
@@ -14,13 +16,111 @@ from typing import List, Optional, Tuple
 # ============================================================
 try:
     # modules/repos -> modules
-    from ..db_indflow import get_db  # type: ignore
+    from ..db_indflow import get_db, schema_ready, on_commit, on_rollback  # type: ignore
 except Exception:
     try:
-        from modules.db_indflow import get_db  # type: ignore
+        from modules.db_indflow import get_db, schema_ready, on_commit, on_rollback  # type: ignore
     except Exception:
         get_db = None  # type: ignore
 
+        def schema_ready() -> bool:  # type: ignore
+            return False
+
+        def on_commit(fn) -> None:  # type: ignore
+            fn()
+
+        def on_rollback(fn) -> None:  # type: ignore
+            return None
+
+
+# ============================================================
+# Cache (machine_id, data_ref) -> array 24
+# ============================================================
+# machine_id e a chave exata da tabela (raw ou "cliente::maquina"). Guarda o dia operacional mais
+# recente; dias anteriores sao podados quando o dia vira.
+# _CACHE_GERACAO sobe a cada escrita/invalidacao: load que leu o banco antes dela nao preenche o cache.
+_CACHE: dict = {}
+_CACHE_LOCK = threading.Lock()
+_CACHE_MAX = 4096
+_CACHE_DIA_MAX = ""
+_CACHE_GERACAO = 0
+
+
+def _cache_geracao() -> int:
+    with _CACHE_LOCK:
+        return _CACHE_GERACAO
+
+
+def _cache_get(chave) -> Optional[List[int]]:
+    with _CACHE_LOCK:
+        arr = _CACHE.get(chave)
+    return list(arr) if arr is not None else None
+
+
+def _cache_put(chave, arr: List[int], geracao: Optional[int] = None) -> None:
+    """geracao (loads): so grava se nenhuma escrita/invalidacao aconteceu desde a leitura do banco."""
+    global _CACHE_DIA_MAX
+    dia = chave[1]
+    with _CACHE_LOCK:
+        if geracao is not None and geracao != _CACHE_GERACAO:
+            return
+        if dia > _CACHE_DIA_MAX:
+            _CACHE_DIA_MAX = dia
+            for k in [k for k in _CACHE if k[1] < dia]:
+                _CACHE.pop(k, None)
+        if len(_CACHE) >= _CACHE_MAX:
+            _CACHE.clear()
+        _CACHE[chave] = list(arr)
+
+
+def _cache_ajustar(machine_id: str, data_ref: str, hora_dia: int, valor: int, somar: bool) -> None:
+    """
+    Aplica a escrita no array em cache (se carregado) e agenda a invalidacao em caso de rollback.
+    Sem entrada: descarta a chave de novo no commit (load concorrente pode ter lido o banco antes).
+    """
+    global _CACHE_GERACAO
+    chave = (machine_id, data_ref)
+    with _CACHE_LOCK:
+        _CACHE_GERACAO += 1
+        arr = _CACHE.get(chave)
+        if arr is not None:
+            arr[hora_dia] = (arr[hora_dia] + valor) if somar else valor
+    if arr is None:
+        on_commit(lambda: _cache_descartar(chave))
+    on_rollback(lambda: invalidar_np_cache(machine_id, data_ref))
+
+
+def _cache_descartar(chave) -> None:
+    global _CACHE_GERACAO
+    with _CACHE_LOCK:
+        _CACHE_GERACAO += 1
+        _CACHE.pop(chave, None)
+
+
+def invalidar_np_cache(machine_id: Optional[str] = None, data_ref: Optional[str] = None) -> None:
+    """
+    Sem argumentos limpa tudo. machine_id raw tambem limpa as chaves "cliente::maquina" da maquina.
+    """
+    global _CACHE_GERACAO
+    with _CACHE_LOCK:
+        _CACHE_GERACAO += 1
+        if not machine_id:
+            _CACHE.clear()
+            return
+        mid = (machine_id or "").strip()
+        for k in list(_CACHE.keys()):
+            if (k[0] == mid or k[0].endswith("::" + mid)) and (not data_ref or k[1] == data_ref):
+                _CACHE.pop(k, None)
+
+
+def upsert_absoluto_cache(machine_id: str, data_ref: str, hora_dia: int, produzido: int) -> None:
+    """Para quem grava o total absoluto da hora fora deste repo (machine_calc_nao_programado)."""
+    mid = (machine_id or "").strip()
+    dr = (data_ref or "").strip()
+    hd = _safe_int(hora_dia, -1)
+    if mid and dr and 0 <= hd <= 23:
+        _cache_ajustar(mid, dr, hd, _safe_int(produzido, 0), somar=False)
+
 
 # ============================================================
 # Schema
@@ -202,6 +302,9 @@ def ensure_table(conn) -> None:
     Garante que a tabela nao_programado_horaria existe.
     Tambem valida/migra schema antigo para evitar falha silenciosa no upsert.
     """
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn.execute(DDL_NAO_PROGRAMADO_HORARIA)
     conn.commit()
 
@@ -253,6 +356,7 @@ def upsert_delta(
             (mid, dr, hd, d, updated_at),
         )
         conn.commit()
+        _cache_ajustar(mid, dr, hd, d, somar=True)
         return
     except Exception:
         pass
@@ -288,8 +392,10 @@ def upsert_delta(
                 (mid, dr, hd, d, updated_at),
             )
         conn.commit()
+        _cache_ajustar(mid, dr, hd, d, somar=True)
     except Exception:
         # Não levanta erro para não quebrar o update da máquina
+        invalidar_np_cache(mid, dr)
         return
 
 
@@ -304,6 +410,11 @@ def load_np_por_hora_24(conn, machine_id: str, data_ref: str) -> List[int]:
     if not mid or not dr:
         return arr
 
+    hit = _cache_get((mid, dr))
+    if hit is not None:
+        return hit
+    geracao = _cache_geracao()
+
     ensure_table(conn)
 
     try:
@@ -322,9 +433,60 @@ def load_np_por_hora_24(conn, machine_id: str, data_ref: str) -> List[int]:
     except Exception:
         return arr
 
+    _cache_put((mid, dr), arr, geracao)
     return arr
 
 
+def load_np_por_hora_24_many(conn, machine_ids, data_ref: str) -> dict:
+    """
+    Versao em lote do load_np_por_hora_24 (status bulk / agendador): 1 SELECT para todos os ids.
+    Retorna {machine_id (como veio): array 24}.
+    """
+    dr = (data_ref or "").strip()
+    alvos = {}
+    for machine_id in machine_ids or []:
+        mid = (machine_id or "").strip()
+        if mid:
+            alvos.setdefault(mid, []).append(machine_id)
+
+    out = {machine_id: [0] * 24 for machine_id in (machine_ids or [])}
+    if not alvos or not dr:
+        return out
+    geracao = _cache_geracao()
+
+    for mid in list(alvos.keys()):
+        hit = _cache_get((mid, dr))
+        if hit is not None:
+            for machine_id in alvos.pop(mid):
+                out[machine_id] = list(hit)
+    if not alvos:
+        return out
+
+    ensure_table(conn)
+
+    try:
+        mids = list(alvos.keys())
+        cur = conn.execute(
+            f"""
+            SELECT machine_id, hora_dia, produzido
+            FROM nao_programado_horaria
+            WHERE data_ref = ? AND machine_id IN ({",".join("?" * len(mids))})
+            """,
+            [dr] + mids,
+        )
+        for mid, hora, produzido in cur.fetchall():
+            h = _safe_int(hora, -1)
+            if 0 <= h <= 23:
+                for machine_id in alvos.get(mid, []):
+                    out[machine_id][h] = _safe_int(produzido, 0)
+    except Exception:
+        return out
+
+    for mid, ids in alvos.items():
+        _cache_put((mid, dr), out[ids[0]], geracao)
+    return out
+
+
 # ============================================================
 # Conveniência: abre conexão via get_db (se existir)
 # ============================================================
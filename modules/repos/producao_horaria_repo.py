@@ -1,12 +1,12 @@
 # PATH: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\repos\producao_horaria_repo.py
-# LAST_RECODE: 2026-02-25 15:58 America/Bahia
-# MOTIVO: Fixar cliente_id consistente em producao_horaria: ignorar cliente_id do machine_id scoped, resolver por tabelas de config/vinculo e, se preciso, pelo cliente_id mais recente em producao_horaria. Evita mistura de dois clientes no historico.
+# LAST_RECODE: 2026-10-18 01:30 America/Bahia
+# MOTIVO: upsert_hora fecha o handle do get_db() em finally (mesmo com excecao engolida).
 
 # modules/repos/producao_horaria_repo.py
 # LAST_RECODE: 2026-02-25 14:35 America/Bahia
 # MOTIVO: Corrigir divergencia de cliente_id na persistencia de producao_horaria: ignorar cid de machine_id scoped e resolver cliente_id consistente por consulta ao DB antes do upsert/leitura.
 
-from modules.db_indflow import get_db
+from modules.db_indflow import get_db, schema_ready
 from modules.machine_calc import now_bahia
 
 
@@ -183,6 +183,9 @@ def _has_column(conn, table: str, col: str) -> bool:
 # ============================================================
 
 def ensure_producao_horaria_table():
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn = get_db()
     cur = conn.cursor()
 
@@ -247,6 +250,7 @@ def upsert_hora(
     meta: int,
     percentual: int
 ):
+    conn = None
     try:
         ensure_producao_horaria_table()
 
@@ -313,10 +317,12 @@ def upsert_hora(
             ))
 
         conn.commit()
-        conn.close()
         return True
     except Exception:
         return False
+    finally:
+        if conn is not None:
+            conn.close()
 
 
 def get_baseline_for_hora(machine_id: str, data_ref: str, hora_idx: int):
@@ -1,6 +1,11 @@
 # modules/repos/refugo_repo.py
+# LAST_RECODE: 2026-10-18 01:30 America/Bahia
+# MOTIVO: Cache do refugo 24h: geracao de escrita; leitura do banco concorrente com um upsert nao
+#         grava no cache o array lido antes da escrita. upsert_refugo fecha o handle em finally.
 
-from modules.db_indflow import get_db
+import threading
+
+from modules.db_indflow import get_db, schema_ready, on_commit, on_rollback
 
 
 # ============================================================
@@ -57,11 +62,92 @@ def _dedupe_keep_latest(conn, table: str):
         pass
 
 
+# ============================================================
+# CACHE (cliente_id|None, machine_id, dia_ref) -> lista 24
+# ============================================================
+# So muda via upsert_refugo (e resets, que chamam invalidar_refugo_cache). Guarda o dia
+# operacional mais recente; dias anteriores sao podados quando o dia vira.
+# _CACHE_GERACAO sobe a cada escrita/invalidacao: load que leu o banco antes dela nao preenche o
+# cache (o upsert concorrente nao achou entrada para ajustar e o array lido ja esta velho).
+
+_CACHE: dict = {}
+_CACHE_LOCK = threading.Lock()
+_CACHE_MAX = 4096
+_CACHE_DIA_MAX = ""
+_CACHE_GERACAO = 0
+
+
+def _cache_geracao() -> int:
+    with _CACHE_LOCK:
+        return _CACHE_GERACAO
+
+
+def _cache_get(chave):
+    with _CACHE_LOCK:
+        arr = _CACHE.get(chave)
+    return list(arr) if arr is not None else None
+
+
+def _cache_put(chave, arr, geracao: int | None = None) -> None:
+    """geracao (loads): so grava se nenhuma escrita/invalidacao aconteceu desde a leitura do banco."""
+    global _CACHE_DIA_MAX
+    dia = chave[2]
+    with _CACHE_LOCK:
+        if geracao is not None and geracao != _CACHE_GERACAO:
+            return
+        if dia > _CACHE_DIA_MAX:
+            _CACHE_DIA_MAX = dia
+            for k in [k for k in _CACHE if k[2] < dia]:
+                _CACHE.pop(k, None)
+        if len(_CACHE) >= _CACHE_MAX:
+            _CACHE.clear()
+        _CACHE[chave] = list(arr)
+
+
+def _cache_ajustar(chave, hora_dia: int, valor: int) -> None:
+    """
+    Escrita: atualiza o slot se o dia ja estiver carregado. Sem entrada, descarta a chave de novo no
+    commit (load concorrente pode ter lido o banco antes da escrita ser visivel).
+    """
+    global _CACHE_GERACAO
+    with _CACHE_LOCK:
+        _CACHE_GERACAO += 1
+        arr = _CACHE.get(chave)
+        if arr is not None and 0 <= hora_dia < 24:
+            arr[hora_dia] = valor
+    if arr is None:
+        on_commit(lambda: _cache_descartar(chave))
+
+
+def _cache_descartar(chave) -> None:
+    global _CACHE_GERACAO
+    with _CACHE_LOCK:
+        _CACHE_GERACAO += 1
+        _CACHE.pop(chave, None)
+
+
+def invalidar_refugo_cache(machine_id: str | None = None, dia_ref: str | None = None) -> None:
+    """Sem argumentos limpa tudo; com machine_id (raw ou cliente::maquina) limpa so essa maquina."""
+    global _CACHE_GERACAO
+    with _CACHE_LOCK:
+        _CACHE_GERACAO += 1
+        if not machine_id:
+            _CACHE.clear()
+            return
+        cid, mid = _split_scoped_machine_id(machine_id)
+        for k in list(_CACHE.keys()):
+            if k[1] == mid and (cid is None or k[0] == cid) and (not dia_ref or k[2] == dia_ref):
+                _CACHE.pop(k, None)
+
+
 # ============================================================
 # TABELA / ÍNDICES
 # ============================================================
 
 def ensure_refugo_table():
+    # schema criado pelas migracoes do init_db (schema_version)
+    if schema_ready():
+        return
     conn = get_db()
     cur = conn.cursor()
 
@@ -133,6 +219,12 @@ def load_refugo_24(machine_id: str, dia_ref: str):
     if not mid:
         return out
 
+    chave = (cid, mid, dia_ref)
+    hit = _cache_get(chave)
+    if hit is not None:
+        return hit
+    geracao = _cache_geracao()
+
     try:
         ensure_refugo_table()
 
@@ -163,6 +255,88 @@ def load_refugo_24(machine_id: str, dia_ref: str):
                     out[h] = max(0, v)
             except Exception:
                 continue
+        _cache_put(chave, out, geracao)
+    except Exception:
+        pass
+
+    return out
+
+
+def load_refugo_24_many(machine_ids, dia_ref: str) -> dict:
+    """
+    Versao em lote do load_refugo_24 (status bulk / agendador): 1 SELECT para os ids legados
+    e 1 para os "cliente::maquina". Retorna {machine_id (como veio): lista 24}.
+    """
+    out = {}
+    legado = {}
+    scoped = {}
+    geracao = _cache_geracao()
+    for machine_id in machine_ids or []:
+        out[machine_id] = [0] * 24
+        cid, mid = _split_scoped_machine_id(machine_id)
+        if not mid:
+            continue
+        hit = _cache_get((cid, mid, dia_ref))
+        if hit is not None:
+            out[machine_id] = hit
+            continue
+        if cid:
+            scoped.setdefault((cid, mid), []).append(machine_id)
+        else:
+            legado.setdefault(mid, []).append(machine_id)
+
+    if not legado and not scoped:
+        return out
+
+    try:
+        ensure_refugo_table()
+
+        conn = get_db()
+        try:
+            rows = []
+            if legado:
+                mids = list(legado.keys())
+                marks = ",".join("?" * len(mids))
+                rows += [
+                    (None, r[0], r[1], r[2])
+                    for r in conn.execute(f"""
+                        SELECT machine_id, hora_dia, refugo
+                        FROM refugo_horaria
+                        WHERE cliente_id IS NULL AND dia_ref=? AND machine_id IN ({marks})
+                    """, [dia_ref] + mids).fetchall()
+                ]
+            if scoped:
+                mids = sorted({mid for _cid, mid in scoped.keys()})
+                cids = sorted({cid for cid, _mid in scoped.keys()})
+                rows += [
+                    tuple(r)
+                    for r in conn.execute(f"""
+                        SELECT cliente_id, machine_id, hora_dia, refugo
+                        FROM refugo_horaria
+                        WHERE dia_ref=?
+                          AND cliente_id IN ({",".join("?" * len(cids))})
+                          AND machine_id IN ({",".join("?" * len(mids))})
+                    """, [dia_ref] + cids + mids).fetchall()
+                ]
+        finally:
+            conn.close()
+
+        for cid, mid, hora, refugo in rows:
+            try:
+                h = int(hora)
+                v = max(0, int(refugo))
+            except Exception:
+                continue
+            if not (0 <= h < 24):
+                continue
+            alvos = scoped.get((cid, mid), []) if cid else legado.get(mid, [])
+            for machine_id in alvos:
+                out[machine_id][h] = v
+
+        for (cid, mid), alvos in scoped.items():
+            _cache_put((cid, mid, dia_ref), out[alvos[0]], geracao)
+        for mid, alvos in legado.items():
+            _cache_put((None, mid, dia_ref), out[alvos[0]], geracao)
     except Exception:
         pass
 
@@ -179,6 +353,7 @@ def upsert_refugo(machine_id: str, dia_ref: str, hora_dia: int, refugo: int, upd
     if not mid:
         return False
 
+    conn = None
     try:
         ensure_refugo_table()
 
@@ -215,7 +390,14 @@ def upsert_refugo(machine_id: str, dia_ref: str, hora_dia: int, refugo: int, upd
                 """, (mid, dia_ref, int(hora_dia), int(refugo), updated_at_iso))
 
         conn.commit()
-        conn.close()
+
+        # cache: atualiza o slot se o dia ja estiver carregado; rollback da unidade de trabalho desfaz
+        _cache_ajustar((cid, mid, dia_ref), int(hora_dia), max(0, int(refugo)))
+        on_rollback(lambda: invalidar_refugo_cache(machine_id, dia_ref))
         return True
     except Exception:
+        invalidar_refugo_cache(machine_id, dia_ref)
         return False
+    finally:
+        if conn is not None:
+            conn.close()
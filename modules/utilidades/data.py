@@ -1,9 +1,11 @@
 # Caminho: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\utilidades\data.py
-# Último recode: 2026-01-18 17:05 (America/Bahia)
-# Motivo: Adicionar sistema pré-configurado gen_01 (ENERGY) no store utilidades_systems para habilitar detalhe /utilidades/system/gen_01 sem 404.
+# Último recode: 2026-10-17 18:40 (America/Bahia)
+# Motivo: Versão monotônica por sistema (ETag do /utilidades/system/status), incrementada a cada /system/update.
 
 from __future__ import annotations
 
+import threading
+import time
 from dataclasses import dataclass
 from datetime import datetime
 from typing import Any, Dict, List, Optional
@@ -105,3 +107,24 @@ def get_or_create_system(system_type: str, system_id: str) -> Dict[str, Any]:
         utilidades_systems[sid]["system_type"] = stype
 
     return utilidades_systems[sid]
+
+
+# ============================================================
+# VERSÃO POR SISTEMA (ETag do /utilidades/system/status)
+# ============================================================
+VERSAO_EPOCH = format(int(time.time() * 1000), "x")
+
+utilidades_versions: Dict[str, int] = {}
+_VERSIONS_LOCK = threading.Lock()
+
+
+def bump_system_version(system_id: str) -> int:
+    with _VERSIONS_LOCK:
+        v = utilidades_versions.get(system_id, 0) + 1
+        utilidades_versions[system_id] = v
+        return v
+
+
+def get_system_version(system_id: str) -> int:
+    with _VERSIONS_LOCK:
+        return utilidades_versions.get(system_id, 0)
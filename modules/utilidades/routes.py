@@ -1,8 +1,10 @@
 # Caminho: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\modules\utilidades\routes.py
-# Último recode: 2026-01-17 09:05 (America/Bahia)
-# Motivo: Adicionar rota de detalhe do sistema (card pai) em /utilidades/system/<system_id>, mantendo todo o resto intacto.
+# Último recode: 2026-10-17 18:40 (America/Bahia)
+# Motivo: ETag/304 no /utilidades/system/status (versão do sistema + status/parado_min calculados no GET).
 
-from flask import Blueprint, render_template, request, jsonify
+import hashlib
+
+from flask import Blueprint, Response, render_template, request, jsonify
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
@@ -11,6 +13,9 @@ from .data import (
     utilidades_systems,      # novo (sistemas)
     get_or_create_system,
     now_bahia_iso,
+    VERSAO_EPOCH,
+    bump_system_version,
+    get_system_version,
 )
 
 from modules.admin.routes import login_required
@@ -306,6 +311,8 @@ def system_update():
     # controla tempo parado (agora delega para services.py via wrapper)
     _update_stopped_clock(system, status)
 
+    bump_system_version(system_id)
+
     return jsonify({
         "ok": True,
         "system_id": system_id,
@@ -347,15 +354,31 @@ def system_status():
             "last_seen": s.get("last_seen"),
         }
 
+    def etag_de(s: dict) -> str:
+        # status/parado_min mudam só com o tempo (offline, minutos parados): entram no ETag junto da versão
+        sid = s.get("system_id") or ""
+        return f"{sid}:{get_system_version(sid)}:{s.get('status')}:{s.get('parado_min')}"
+
+    def responder(out, etag: str):
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        else:
+            resp = jsonify(out)
+        resp.set_etag(etag)
+        return resp
+
     if system_id:
         s = utilidades_systems.get(system_id)
         if not s:
             return jsonify({"error": "system_id não encontrado"}), 404
-        return jsonify(build_out(s))
+        out = build_out(s)
+        return responder(out, f"{VERSAO_EPOCH}-{etag_de(s)}")
 
     # lista todos
     out = [build_out(s) for s in utilidades_systems.values()]
-    return jsonify(out)
+    chave = "|".join(etag_de(s) for s in utilidades_systems.values())
+    etag = f"{VERSAO_EPOCH}-{hashlib.sha1(chave.encode()).hexdigest()[:16]}"
+    return responder(out, etag)
 
 
 # ============================================================
@@ -1,10 +1,10 @@
 # PATH: indflow/server.py
-# LAST_RECODE: 2026-02-19 20:20 America/Bahia
-# MOTIVO: Corrigir NameError ProxyFix no Railway (import ausente) mantendo ajuste de cookies/HTTPS.
+# LAST_RECODE: 2026-10-18 02:05 America/Bahia
+# MOTIVO: Shard por cliente: /admin/db-check e /admin/purge-production aceitam cliente_id (usar_cliente);
+#         sem ele, central + todos os shards (antes so o central, vazio com o modo ligado).
 
 import os
 import logging
-import sqlite3
 from flask import Flask, render_template, request, jsonify
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -27,7 +27,21 @@ from modules.clientes.routes import clientes_bp
 # ============================================================
 # NOVOS MÓDULOS (extraídos do server)
 # ============================================================
-from modules.db_indflow import init_db
+from modules.db_indflow import (
+    init_db,
+    get_db,
+    get_db_leitura,
+    get_db_path as db_get_path,
+    get_db_path_atual,
+    liberar_conexao_thread,
+    shard_ativo,
+    usar_cliente,
+    clientes_com_shard,
+)
+from modules.machine_state import prime_last_states, prime_stop_clocks, reset_stop_clocks, bump_all_versions
+from modules.repos.refugo_repo import invalidar_refugo_cache
+from modules.repos.nao_programado_horaria_repo import invalidar_np_cache
+from modules import machine_status_view
 from modules.machine_routes import machine_bp
 
 # ============================================================
@@ -108,6 +122,18 @@ except Exception:
     log.exception("startup: init_db() failed")
     raise
 
+try:
+    n = prime_last_states()
+    log.info("startup: ultimo estado carregado para %s maquina(s)", n)
+except Exception:
+    log.exception("startup: prime_last_states() failed")
+
+try:
+    n = prime_stop_clocks()
+    log.info("startup: relogio de parada carregado para %s maquina(s)", n)
+except Exception:
+    log.exception("startup: prime_stop_clocks() failed")
+
 # ============================================================
 # LOG REQUESTS (mínimo)
 # ============================================================
@@ -122,6 +148,15 @@ def _log_request(response):
         pass
     return response
 
+
+@app.teardown_request
+def _liberar_conexao(_exc=None):
+    # Transacao esquecida aberta nao vaza para o proximo request da mesma thread.
+    try:
+        liberar_conexao_thread()
+    except Exception:
+        pass
+
 # ============================================================
 # ADMIN: DB CHECK (TEMPORÁRIO)
 # ============================================================
@@ -146,8 +181,8 @@ def _admin_token_ok() -> bool:
 
 
 def get_db_path() -> str:
-    # Banco usado pelo app no Railway (volume /data).
-    return os.getenv("INDFLOW_DB_PATH", "/data/indflow.db")
+    # Mesmo caminho que o app usa (db_indflow: INDFLOW_DB_PATH, volume /data no Railway, ou local).
+    return db_get_path()
 
 def _check_admin_auth():
     """
@@ -183,14 +218,33 @@ def admin_db_check():
     if not _admin_token_ok():
         return jsonify({"ok": False, "error": "unauthorized"}), 401
 
-    db_path = os.getenv("INDFLOW_DB_PATH", "/data/indflow.db")
     machine_id = (request.args.get("machine_id") or "maquina02").strip()
     days_limit = int((request.args.get("days") or "10").strip() or "10")
     if days_limit < 1:
         days_limit = 1
     if days_limit > 31:
         days_limit = 31
+    cliente_id = (request.args.get("cliente_id") or "").strip() or None
+
+    # Shard por cliente: os dados operacionais ficam no banco de cada cliente, nao no central.
+    # ?cliente_id= olha so o shard dele; sem ele, o central (legado) + 1 bloco por shard.
+    if cliente_id or not shard_ativo():
+        with usar_cliente(cliente_id):
+            out = _db_check_banco(machine_id, days_limit)
+        out["cliente_id"] = cliente_id
+        return jsonify(out)
+
+    out = _db_check_banco(machine_id, days_limit)
+    out["shards"] = {}
+    for cid in clientes_com_shard():
+        with usar_cliente(cid):
+            out["shards"][cid] = _db_check_banco(machine_id, days_limit)
+    return jsonify(out)
+
 
+def _db_check_banco(machine_id: str, days_limit: int) -> dict:
+    """Diagnostico do banco atual da thread (central ou shard do cliente)."""
+    db_path = get_db_path_atual()
     out = {
         "ok": True,
         "db_path": db_path,
@@ -203,7 +257,8 @@ def admin_db_check():
     }
 
     try:
-        conn = sqlite3.connect(db_path)
+        conn = get_db_leitura()  # diagnostico so le: conexao somente-leitura
+        conn.row_factory = None  # linhas viram listas no JSON
         cur = conn.cursor()
 
         tables = [r[0] for r in cur.execute(
@@ -416,7 +471,7 @@ def admin_db_check():
         out["ok"] = False
         out["error"] = str(e)
 
-    return jsonify(out)
+    return out
 
 # ============================================================
 # ROTAS PRINCIPAIS
@@ -434,6 +489,8 @@ def admin_purge_production():
 
     Body (JSON) opcional:
       { "machine_id": "maquina02" }  # se informado, tenta apagar apenas dessa maquina quando a tabela tiver a coluna machine_id
+      { "cliente_id": "..." }        # shard por cliente: apaga so no banco desse cliente
+    Shard por cliente sem cliente_id: apaga no central (legado) e em todos os shards.
     """
     auth = _check_admin_auth()
     if auth is not None:
@@ -441,10 +498,50 @@ def admin_purge_production():
 
     payload = request.get_json(silent=True) or {}
     machine_id = (payload.get("machine_id") or "").strip() or None
+    cliente_id = (payload.get("cliente_id") or "").strip() or None
+
+    with usar_cliente(cliente_id):
+        db_path = get_db_path_atual()
+        deleted, errors = _purge_banco(machine_id)
+    shards = {}
+    if shard_ativo() and not cliente_id:
+        for cid in clientes_com_shard():
+            with usar_cliente(cid):
+                d, e = _purge_banco(machine_id)
+            shards[cid] = {"deleted": d, "errors": e}
+            errors = errors + [dict(x, cliente_id=cid) for x in e]
+
+    # machine_stop foi apagada: relogio de parada em memoria acompanha
+    reset_stop_clocks(machine_id)
+    invalidar_refugo_cache()
+    invalidar_np_cache()
+    bump_all_versions()
+    for mid in machine_status_view.snapshot_ids():
+        machine_status_view.solicitar_refresh(mid)
+
+    note = "Purge executado. Dados operacionais apagados."
+    if machine_id:
+        note += f" machine_id={machine_id}"
+    if cliente_id:
+        note += f" cliente_id={cliente_id}"
 
-    db_path = get_db_path()
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    out = {
+        "ok": len(errors) == 0,
+        "db_path": db_path,
+        "machine_id": machine_id,
+        "cliente_id": cliente_id,
+        "deleted": deleted,
+        "errors": errors,
+        "note": note,
+    }
+    if shards:
+        out["shards"] = shards
+    return jsonify(out)
+
+
+def _purge_banco(machine_id: str | None) -> tuple:
+    """Purge no banco atual da thread (central ou shard do cliente). Retorna (deleted, errors)."""
+    conn = get_db()
     cur = conn.cursor()
 
     tables = [
@@ -489,19 +586,7 @@ def admin_purge_production():
 
     conn.commit()
     conn.close()
-
-    note = "Purge executado. Dados operacionais apagados."
-    if machine_id:
-        note += f" machine_id={machine_id}"
-
-    return jsonify({
-        "ok": len(errors) == 0,
-        "db_path": db_path,
-        "machine_id": machine_id,
-        "deleted": deleted,
-        "errors": errors,
-        "note": note,
-    })
+    return deleted, errors
 
 @app.route("/")
 def index():
@@ -335,6 +335,9 @@ function renderMachines(){
   grid.innerHTML = pageItems.map(cardHTML).join("");
 
   renderPager();
+
+  // troca de página: preenche os cards com o último estado recebido do stream
+  pageItems.forEach(aplicarCache);
 }
 
 function formatTempoMedio(v) {
@@ -344,84 +347,90 @@ function formatTempoMedio(v) {
   return fixed.replace(".", ",");
 }
 
-function updateMachine(machineId){
+function updateMachine(machineId, data){
   const sid = safeSid(machineId);
 
-  fetch(`/machine/status?machine_id=${machineId}`)
-    .then(r => r.json())
-    .then(data => {
-      const statusBadge = document.getElementById(`status-badge-${sid}`);
-      if(!statusBadge) return;
-
-      statusBadge.textContent = data.status;
-      statusBadge.className =
-        "machine-status " + (data.status === "AUTO" ? "status-auto" : "status-manual");
-
-      // Unidades vindas da configuração
-      const u1 = normUnidade(data.unidade_1) || "pcs";   // obrigatória (fallback pcs)
-      const u2 = normUnidade(data.unidade_2);           // opcional
-
-      const u1Label = labelUnidade(u1);
-      const u2Label = u2 ? labelUnidade(u2) : null;
-
-      // Percentuais
-      setText(`percent-turno-${sid}`, (data.percentual_turno ?? 0) + "%");
-      setText(`percent-hora-${sid}`,  (data.percentual_hora ?? 0) + "%");
-
-      // TURNO: unidade 1 (em cima)
-      const vTurnoU1 = pickValuesByUnit(u1, data, "turno");
-      setText(`lbl-meta-turno-u1-${sid}`, `Meta (${u1Label})`);
-      setText(`lbl-prod-turno-u1-${sid}`, `Produzido (${u1Label})`);
-      setText(`meta-turno-u1-${sid}`, fmt(vTurnoU1.meta));
-      setText(`prod-turno-u1-${sid}`, fmt(vTurnoU1.prod));
-
-      // TURNO: unidade 2 (embaixo / opcional)
-      const showU2 = !!u2Label;
-      setVisible(`row-meta-turno-u2-${sid}`, showU2);
-      setVisible(`row-prod-turno-u2-${sid}`, showU2);
-      if(showU2){
-        const vTurnoU2 = pickValuesByUnit(u2, data, "turno");
-        setText(`lbl-meta-turno-u2-${sid}`, `Meta (${u2Label})`);
-        setText(`lbl-prod-turno-u2-${sid}`, `Produzido (${u2Label})`);
-        setText(`meta-turno-u2-${sid}`, fmt(vTurnoU2.meta));
-        setText(`prod-turno-u2-${sid}`, fmt(vTurnoU2.prod));
-      }
-
-      // HORA: unidade 1 (em cima)
-      const vHoraU1 = pickValuesByUnit(u1, data, "hora");
-      setText(`lbl-meta-hora-u1-${sid}`, `Meta (${u1Label})`);
-      setText(`lbl-prod-hora-u1-${sid}`, `Produzido (${u1Label})`);
-      setText(`meta-hora-u1-${sid}`, fmt(vHoraU1.meta));
-      setText(`prod-hora-u1-${sid}`, fmt(vHoraU1.prod));
-
-      // HORA: unidade 2 (embaixo / opcional)
-      setVisible(`row-meta-hora-u2-${sid}`, showU2);
-      setVisible(`row-prod-hora-u2-${sid}`, showU2);
-      if(showU2){
-        const vHoraU2 = pickValuesByUnit(u2, data, "hora");
-        setText(`lbl-meta-hora-u2-${sid}`, `Meta (${u2Label})`);
-        setText(`lbl-prod-hora-u2-${sid}`, `Produzido (${u2Label})`);
-        setText(`meta-hora-u2-${sid}`, fmt(vHoraU2.meta));
-        setText(`prod-hora-u2-${sid}`, fmt(vHoraU2.prod));
-      }
-
-      // Ritmo médio
-      const elRitmo = document.getElementById(`ritmo-medio-${sid}`);
-      const tempoMedioTxt = formatTempoMedio(data.tempo_medio_min_por_peca);
-      if(elRitmo){
-        elRitmo.textContent =
-          tempoMedioTxt !== "—"
-            ? `Ritmo médio: ${tempoMedioTxt} min/peça`
-            : "Ritmo médio: —";
-      }
-    })
-    .catch(() => {});
+  const statusBadge = document.getElementById(`status-badge-${sid}`);
+  if(!statusBadge) return;
+
+  statusBadge.textContent = data.status;
+  statusBadge.className =
+    "machine-status " + (data.status === "AUTO" ? "status-auto" : "status-manual");
+
+  // Unidades vindas da configuração
+  const u1 = normUnidade(data.unidade_1) || "pcs";   // obrigatória (fallback pcs)
+  const u2 = normUnidade(data.unidade_2);           // opcional
+
+  const u1Label = labelUnidade(u1);
+  const u2Label = u2 ? labelUnidade(u2) : null;
+
+  // Percentuais
+  setText(`percent-turno-${sid}`, (data.percentual_turno ?? 0) + "%");
+  setText(`percent-hora-${sid}`,  (data.percentual_hora ?? 0) + "%");
+
+  // TURNO: unidade 1 (em cima)
+  const vTurnoU1 = pickValuesByUnit(u1, data, "turno");
+  setText(`lbl-meta-turno-u1-${sid}`, `Meta (${u1Label})`);
+  setText(`lbl-prod-turno-u1-${sid}`, `Produzido (${u1Label})`);
+  setText(`meta-turno-u1-${sid}`, fmt(vTurnoU1.meta));
+  setText(`prod-turno-u1-${sid}`, fmt(vTurnoU1.prod));
+
+  // TURNO: unidade 2 (embaixo / opcional)
+  const showU2 = !!u2Label;
+  setVisible(`row-meta-turno-u2-${sid}`, showU2);
+  setVisible(`row-prod-turno-u2-${sid}`, showU2);
+  if(showU2){
+    const vTurnoU2 = pickValuesByUnit(u2, data, "turno");
+    setText(`lbl-meta-turno-u2-${sid}`, `Meta (${u2Label})`);
+    setText(`lbl-prod-turno-u2-${sid}`, `Produzido (${u2Label})`);
+    setText(`meta-turno-u2-${sid}`, fmt(vTurnoU2.meta));
+    setText(`prod-turno-u2-${sid}`, fmt(vTurnoU2.prod));
+  }
+
+  // HORA: unidade 1 (em cima)
+  const vHoraU1 = pickValuesByUnit(u1, data, "hora");
+  setText(`lbl-meta-hora-u1-${sid}`, `Meta (${u1Label})`);
+  setText(`lbl-prod-hora-u1-${sid}`, `Produzido (${u1Label})`);
+  setText(`meta-hora-u1-${sid}`, fmt(vHoraU1.meta));
+  setText(`prod-hora-u1-${sid}`, fmt(vHoraU1.prod));
+
+  // HORA: unidade 2 (embaixo / opcional)
+  setVisible(`row-meta-hora-u2-${sid}`, showU2);
+  setVisible(`row-prod-hora-u2-${sid}`, showU2);
+  if(showU2){
+    const vHoraU2 = pickValuesByUnit(u2, data, "hora");
+    setText(`lbl-meta-hora-u2-${sid}`, `Meta (${u2Label})`);
+    setText(`lbl-prod-hora-u2-${sid}`, `Produzido (${u2Label})`);
+    setText(`meta-hora-u2-${sid}`, fmt(vHoraU2.meta));
+    setText(`prod-hora-u2-${sid}`, fmt(vHoraU2.prod));
+  }
+
+  // Ritmo médio
+  const elRitmo = document.getElementById(`ritmo-medio-${sid}`);
+  const tempoMedioTxt = formatTempoMedio(data.tempo_medio_min_por_peca);
+  if(elRitmo){
+    elRitmo.textContent =
+      tempoMedioTxt !== "—"
+        ? `Ritmo médio: ${tempoMedioTxt} min/peça`
+        : "Ritmo médio: —";
+  }
 }
 
 /* ALTERADO: agora atualiza só os 6 visíveis (página atual) */
 function updateAll(){
   const pageItems = getMachinesPage();
-  pageItems.forEach(updateMachine);
+  if(!pageItems.length) return;
+
+  // 1 chamada para a página inteira (em vez de 1 fetch por máquina)
+  fetch(`/machine/status/bulk?ids=${encodeURIComponent(pageItems.join(","))}`)
+    .then(r => r.json())
+    .then(resp => {
+      const porId = (resp && resp.machines) || {};
+      pageItems.forEach((machineId) => {
+        if(porId[machineId]) updateMachine(machineId, porId[machineId]);
+      });
+    })
+    .catch(() => {});
 }
 
 /* MODAL */
@@ -464,7 +473,79 @@ document.getElementById("btnSave").addEventListener("click", () => {
   window.location.href = `/producao/config/${id}`;
 });
 
+/* ===========================
+   STREAM (SSE /machine/stream)
+   =========================== */
+
+// Cache do último estado de cada máquina (estado inicial + deltas do servidor)
+const statusCache = {};
+let statusStream = null;
+let statusStreamIds = "";
+let pollingTimer = null;
+
+function aplicarCache(machineId){
+  const data = statusCache[machineId];
+  if(data) updateMachine(machineId, data);
+}
+
+function mesclarStatus(machineId, dados){
+  statusCache[machineId] = Object.assign(statusCache[machineId] || {}, dados || {});
+  if(getMachinesPage().includes(machineId)) aplicarCache(machineId);
+}
+
+function iniciarPolling(){
+  // Fallback: navegador sem EventSource ou servidor sem vaga para o stream
+  if(pollingTimer) return;
+  updateAll();
+  pollingTimer = setInterval(updateAll, 1000);
+}
+
+function iniciarStream(){
+  const ids = getMachines().join(",");
+  if(statusStream && ids === statusStreamIds) return;
+  if(statusStream) statusStream.close();
+
+  if(!window.EventSource || !ids){
+    iniciarPolling();
+    return;
+  }
+
+  statusStreamIds = ids;
+  statusStream = new EventSource(`/machine/stream?ids=${encodeURIComponent(ids)}`);
+
+  statusStream.addEventListener("status", (ev) => {
+    const porId = JSON.parse(ev.data || "{}");
+    Object.keys(porId).forEach((machineId) => mesclarStatus(machineId, porId[machineId]));
+  });
+
+  statusStream.addEventListener("delta", (ev) => {
+    const d = JSON.parse(ev.data || "{}");
+    if(d.machine_id) mesclarStatus(d.machine_id, d.dados);
+  });
+
+  statusStream.addEventListener("heartbeat", (ev) => {
+    const hb = JSON.parse(ev.data || "{}");
+    const mins = hb.parado_min || {};
+    Object.keys(mins).forEach((machineId) => mesclarStatus(machineId, { parado_min: mins[machineId] }));
+  });
+
+  statusStream.addEventListener("evicted", () => {
+    // o servidor descartou a conexão (cliente lento): reconecta e recebe o estado inteiro
+    statusStream.close();
+    statusStream = null;
+    setTimeout(iniciarStream, 1000);
+  });
+
+  statusStream.onerror = () => {
+    // EventSource reconecta sozinho; CLOSED = servidor recusou (ex.: 503 por limite de conexões)
+    if(statusStream && statusStream.readyState === EventSource.CLOSED){
+      statusStream = null;
+      iniciarPolling();
+    }
+  };
+}
+
 /* INIT */
 renderMachines();
 updateAll();
-setInterval(updateAll, 1000);
+iniciarStream();
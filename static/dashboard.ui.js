@@ -1,7 +1,7 @@
 /*
 Caminho: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\static\dashboard.ui.js
-Último recode: 2026-02-24 22:00 (America/Bahia)
-Motivo: Adicionar indicador de internet (WiFi) no canto inferior esquerdo do card, baseado em last_seen (45s) com estados ONLINE/OFFLINE/SEM DADOS, sem alterar backend.
+Último recode: 2026-10-17 18:00 (America/Bahia)
+Motivo: Remover o setInterval de refreshStatuses: o status ao vivo vem do stream SSE (dashboard.update.js); refreshStatuses só redesenha do cache ao trocar de página.
 */
 
 // static/dashboard.ui.js
@@ -168,16 +168,26 @@ function applyStatusToCard(machineId, data){
 
 /* Poll simples só do status (não mexe em percentuais) */
 function refreshStatuses(){
+  // Com o stream (dashboard.update.js) ativo, só redesenha a partir do cache
+  if(typeof reaplicarStatus === "function" && statusStream){
+    reaplicarStatus();
+    return;
+  }
   try{
     const pageItems = getMachinesPage(); // só as máquinas visíveis (pager)
-    pageItems.forEach((machineId) => {
-      fetch(`/machine/status?machine_id=${machineId}`)
-        .then(r => r.json())
-        .then(data => applyStatusToCard(machineId, data))
-        .catch(() => {
-          // se falhar, não quebra a tela
+    if(!pageItems.length) return;
+    // 1 chamada para a página inteira (em vez de 1 fetch por máquina)
+    fetch(`/machine/status/bulk?ids=${encodeURIComponent(pageItems.join(","))}`)
+      .then(r => r.json())
+      .then(resp => {
+        const porId = (resp && resp.machines) || {};
+        pageItems.forEach((machineId) => {
+          if(porId[machineId]) applyStatusToCard(machineId, porId[machineId]);
         });
-    });
+      })
+      .catch(() => {
+        // se falhar, não quebra a tela
+      });
   }catch(e){
     // silencioso
   }
@@ -470,5 +480,4 @@ document.getElementById("btnSave").addEventListener("click", () => {
 /* INIT UI */
 renderMachines();
 
-// ✅ Poll leve só do status (não mexe nos números do card)
-setInterval(refreshStatuses, 2000);
+// Status ao vivo vem do stream SSE (dashboard.update.js); sem polling periódico aqui
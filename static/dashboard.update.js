@@ -1,7 +1,7 @@
 /*
 Caminho: C:\Users\vlula\OneDrive\Área de Trabalho\Projetos Backup\indflow\static\dashboard.update.js
-Último recode: 2026-01-16 21:40 (America/Bahia)
-Motivo: Padronizar status do card para PRODUZINDO/PARADA usando status_ui e exibir "XX min parados" via parado_min, evitando conflito com AUTO/MANUAL.
+Último recode: 2026-10-17 18:00 (America/Bahia)
+Motivo: Trocar o polling de 1 s pelo stream SSE (/machine/stream): estado inicial + deltas; polling via /machine/status/bulk só como fallback.
 */
 
 // static/dashboard.update.js
@@ -150,121 +150,205 @@ function indicadorPorRitmoDaHora(metaHora, produzidoHora){
    UPDATE
    =========================== */
 
-function updateMachine(machineId){
+function updateMachine(machineId, data){
   const sid = safeSid(machineId);
 
-  fetch(`/machine/status?machine_id=${machineId}`)
+  const statusBadge = document.getElementById(`status-badge-${sid}`);
+  if(!statusBadge) return;
+
+  // ✅ STATUS: PRODUZINDO / PARADA (padronizado)
+  const statusUI = resolveStatusUI(data);
+  const produzindo = (statusUI === "PRODUZINDO");
+
+  statusBadge.textContent = statusUI;
+  statusBadge.className =
+    "machine-status " + (produzindo ? "status-auto" : "status-manual");
+
+  // ✅ Linha "XX min parados" (se existir no card)
+  const stopEl = document.getElementById(`stopline-${sid}`);
+  if(stopEl){
+    const mins = resolveParadoMin(data);
+    if(!produzindo && mins !== null){
+      stopEl.textContent = `${mins} min parados`;
+      stopEl.style.display = "";
+    }else{
+      stopEl.textContent = "";
+      stopEl.style.display = "none";
+    }
+  }
+
+  const u1 = normUnidade(data.unidade_1) || "pcs";
+  const u2 = normUnidade(data.unidade_2);
+
+  const u1Label = labelUnidade(u1);
+  const u2Label = u2 ? labelUnidade(u2) : null;
+
+  /* ===== PERCENTUAIS COM SINAL (ANTES DO NÚMERO) ===== */
+
+  // Dia: mantém sinal baseado no percentual_turno (como está hoje)
+  const pTurno = Number(data.percentual_turno ?? 0);
+
+  // Hora: número continua sendo percentual_hora (exibe 78%),
+  // mas o sinal/cor é por ritmo dentro da hora (ex: 19:45 = 75%)
+  const pHora  = Number(data.percentual_hora ?? 0);
+
+  const elTurno = document.getElementById(`percent-turno-${sid}`);
+  const elHora  = document.getElementById(`percent-hora-${sid}`);
+
+  renderPercentWithIndicator(elTurno, pTurno);
+
+  const metaHora = Number(data.meta_hora_pcs ?? 0);
+  const prodHora = Number(data.producao_hora ?? 0);
+  const indHoraRitmo = indicadorPorRitmoDaHora(metaHora, prodHora);
+
+  renderPercentWithIndicator(elHora, pHora, indHoraRitmo);
+
+  /* ===== TURNO ===== */
+
+  const vTurnoU1 = pickValuesByUnit(u1, data, "turno");
+  setText(`lbl-meta-turno-u1-${sid}`, `Meta (${u1Label})`);
+  setText(`lbl-prod-turno-u1-${sid}`, `Produzido (${u1Label})`);
+  setText(`meta-turno-u1-${sid}`, vTurnoU1.meta);
+  setText(`prod-turno-u1-${sid}`, vTurnoU1.prod);
+
+  const showU2 = !!u2Label;
+  setVisible(`row-meta-turno-u2-${sid}`, showU2);
+  setVisible(`row-prod-turno-u2-${sid}`, showU2);
+
+  if(showU2){
+    const vTurnoU2 = pickValuesByUnit(u2, data, "turno");
+    setText(`lbl-meta-turno-u2-${sid}`, `Meta (${u2Label})`);
+    setText(`lbl-prod-turno-u2-${sid}`, `Produzido (${u2Label})`);
+    setText(`meta-turno-u2-${sid}`, vTurnoU2.meta);
+    setText(`prod-turno-u2-${sid}`, vTurnoU2.prod);
+  }
+
+  /* ===== HORA ===== */
+
+  const vHoraU1 = pickValuesByUnit(u1, data, "hora");
+  setText(`lbl-meta-hora-u1-${sid}`, `Meta (${u1Label})`);
+  setText(`lbl-prod-hora-u1-${sid}`, `Produzido (${u1Label})`);
+  setText(`meta-hora-u1-${sid}`, vHoraU1.meta);
+  setText(`prod-hora-u1-${sid}`, vHoraU1.prod);
+
+  setVisible(`row-meta-hora-u2-${sid}`, showU2);
+  setVisible(`row-prod-hora-u2-${sid}`, showU2);
+
+  if(showU2){
+    const vHoraU2 = pickValuesByUnit(u2, data, "hora");
+    setText(`lbl-meta-hora-u2-${sid}`, `Meta (${u2Label})`);
+    setText(`lbl-prod-hora-u2-${sid}`, `Produzido (${u2Label})`);
+    setText(`meta-hora-u2-${sid}`, vHoraU2.meta);
+    setText(`prod-hora-u2-${sid}`, vHoraU2.prod);
+  }
+
+  /* ===== RITMO ===== */
+
+  const elRitmo = document.getElementById(`ritmo-medio-${sid}`);
+  const tempoMedioTxt = formatTempoMedio(data.tempo_medio_min_por_peca);
+  if(elRitmo){
+    elRitmo.textContent =
+      tempoMedioTxt !== "—"
+        ? `Ritmo médio: ${tempoMedioTxt} min/peça`
+        : "Ritmo médio: —";
+  }
+}
+
+function updateAll(){
+  const pageItems = getMachinesPage();
+  if(!pageItems.length) return;
+
+  // 1 chamada para a página inteira (em vez de 1 fetch por máquina)
+  fetch(`/machine/status/bulk?ids=${encodeURIComponent(pageItems.join(","))}`)
     .then(r => r.json())
-    .then(data => {
-
-      const statusBadge = document.getElementById(`status-badge-${sid}`);
-      if(!statusBadge) return;
-
-      // ✅ STATUS: PRODUZINDO / PARADA (padronizado)
-      const statusUI = resolveStatusUI(data);
-      const produzindo = (statusUI === "PRODUZINDO");
-
-      statusBadge.textContent = statusUI;
-      statusBadge.className =
-        "machine-status " + (produzindo ? "status-auto" : "status-manual");
-
-      // ✅ Linha "XX min parados" (se existir no card)
-      const stopEl = document.getElementById(`stopline-${sid}`);
-      if(stopEl){
-        const mins = resolveParadoMin(data);
-        if(!produzindo && mins !== null){
-          stopEl.textContent = `${mins} min parados`;
-          stopEl.style.display = "";
-        }else{
-          stopEl.textContent = "";
-          stopEl.style.display = "none";
-        }
-      }
-
-      const u1 = normUnidade(data.unidade_1) || "pcs";
-      const u2 = normUnidade(data.unidade_2);
-
-      const u1Label = labelUnidade(u1);
-      const u2Label = u2 ? labelUnidade(u2) : null;
-
-      /* ===== PERCENTUAIS COM SINAL (ANTES DO NÚMERO) ===== */
-
-      // Dia: mantém sinal baseado no percentual_turno (como está hoje)
-      const pTurno = Number(data.percentual_turno ?? 0);
-
-      // Hora: número continua sendo percentual_hora (exibe 78%),
-      // mas o sinal/cor é por ritmo dentro da hora (ex: 19:45 = 75%)
-      const pHora  = Number(data.percentual_hora ?? 0);
-
-      const elTurno = document.getElementById(`percent-turno-${sid}`);
-      const elHora  = document.getElementById(`percent-hora-${sid}`);
-
-      renderPercentWithIndicator(elTurno, pTurno);
-
-      const metaHora = Number(data.meta_hora_pcs ?? 0);
-      const prodHora = Number(data.producao_hora ?? 0);
-      const indHoraRitmo = indicadorPorRitmoDaHora(metaHora, prodHora);
-
-      renderPercentWithIndicator(elHora, pHora, indHoraRitmo);
-
-      /* ===== TURNO ===== */
-
-      const vTurnoU1 = pickValuesByUnit(u1, data, "turno");
-      setText(`lbl-meta-turno-u1-${sid}`, `Meta (${u1Label})`);
-      setText(`lbl-prod-turno-u1-${sid}`, `Produzido (${u1Label})`);
-      setText(`meta-turno-u1-${sid}`, vTurnoU1.meta);
-      setText(`prod-turno-u1-${sid}`, vTurnoU1.prod);
-
-      const showU2 = !!u2Label;
-      setVisible(`row-meta-turno-u2-${sid}`, showU2);
-      setVisible(`row-prod-turno-u2-${sid}`, showU2);
-
-      if(showU2){
-        const vTurnoU2 = pickValuesByUnit(u2, data, "turno");
-        setText(`lbl-meta-turno-u2-${sid}`, `Meta (${u2Label})`);
-        setText(`lbl-prod-turno-u2-${sid}`, `Produzido (${u2Label})`);
-        setText(`meta-turno-u2-${sid}`, vTurnoU2.meta);
-        setText(`prod-turno-u2-${sid}`, vTurnoU2.prod);
-      }
-
-      /* ===== HORA ===== */
-
-      const vHoraU1 = pickValuesByUnit(u1, data, "hora");
-      setText(`lbl-meta-hora-u1-${sid}`, `Meta (${u1Label})`);
-      setText(`lbl-prod-hora-u1-${sid}`, `Produzido (${u1Label})`);
-      setText(`meta-hora-u1-${sid}`, vHoraU1.meta);
-      setText(`prod-hora-u1-${sid}`, vHoraU1.prod);
-
-      setVisible(`row-meta-hora-u2-${sid}`, showU2);
-      setVisible(`row-prod-hora-u2-${sid}`, showU2);
-
-      if(showU2){
-        const vHoraU2 = pickValuesByUnit(u2, data, "hora");
-        setText(`lbl-meta-hora-u2-${sid}`, `Meta (${u2Label})`);
-        setText(`lbl-prod-hora-u2-${sid}`, `Produzido (${u2Label})`);
-        setText(`meta-hora-u2-${sid}`, vHoraU2.meta);
-        setText(`prod-hora-u2-${sid}`, vHoraU2.prod);
-      }
-
-      /* ===== RITMO ===== */
-
-      const elRitmo = document.getElementById(`ritmo-medio-${sid}`);
-      const tempoMedioTxt = formatTempoMedio(data.tempo_medio_min_por_peca);
-      if(elRitmo){
-        elRitmo.textContent =
-          tempoMedioTxt !== "—"
-            ? `Ritmo médio: ${tempoMedioTxt} min/peça`
-            : "Ritmo médio: —";
-      }
+    .then(resp => {
+      const porId = (resp && resp.machines) || {};
+      pageItems.forEach((machineId) => {
+        if(porId[machineId]) updateMachine(machineId, porId[machineId]);
+      });
     })
     .catch(() => {});
 }
 
-function updateAll(){
-  const pageItems = getMachinesPage();
-  pageItems.forEach(updateMachine);
+/* ===========================
+   STREAM (SSE /machine/stream)
+   =========================== */
+
+// Cache do último estado de cada máquina (estado inicial + deltas do servidor)
+const statusCache = {};
+let statusStream = null;
+let statusStreamIds = "";
+let pollingTimer = null;
+
+function aplicarCache(machineId){
+  const data = statusCache[machineId];
+  if(!data) return;
+  updateMachine(machineId, data);
+  if(typeof applyStatusToCard === "function") applyStatusToCard(machineId, data);
+}
+
+// Chamado pelo dashboard.ui.js ao trocar de página: redesenha com o cache, sem ir ao servidor
+function reaplicarStatus(){
+  getMachinesPage().forEach(aplicarCache);
+}
+
+function mesclarStatus(machineId, dados){
+  statusCache[machineId] = Object.assign(statusCache[machineId] || {}, dados || {});
+  if(getMachinesPage().includes(machineId)) aplicarCache(machineId);
+}
+
+function iniciarPolling(){
+  // Fallback: navegador sem EventSource ou servidor sem vaga para o stream
+  if(pollingTimer) return;
+  updateAll();
+  pollingTimer = setInterval(updateAll, 1000);
+}
+
+function iniciarStream(){
+  const ids = getMachines().join(",");
+  if(statusStream && ids === statusStreamIds) return;
+  if(statusStream) statusStream.close();
+
+  if(!window.EventSource || !ids){
+    iniciarPolling();
+    return;
+  }
+
+  statusStreamIds = ids;
+  statusStream = new EventSource(`/machine/stream?ids=${encodeURIComponent(ids)}`);
+
+  statusStream.addEventListener("status", (ev) => {
+    const porId = JSON.parse(ev.data || "{}");
+    Object.keys(porId).forEach((machineId) => mesclarStatus(machineId, porId[machineId]));
+  });
+
+  statusStream.addEventListener("delta", (ev) => {
+    const d = JSON.parse(ev.data || "{}");
+    if(d.machine_id) mesclarStatus(d.machine_id, d.dados);
+  });
+
+  statusStream.addEventListener("heartbeat", (ev) => {
+    const hb = JSON.parse(ev.data || "{}");
+    const mins = hb.parado_min || {};
+    Object.keys(mins).forEach((machineId) => mesclarStatus(machineId, { parado_min: mins[machineId] }));
+  });
+
+  statusStream.addEventListener("evicted", () => {
+    // o servidor descartou a conexão (cliente lento): reconecta e recebe o estado inteiro
+    statusStream.close();
+    statusStream = null;
+    setTimeout(iniciarStream, 1000);
+  });
+
+  statusStream.onerror = () => {
+    // EventSource reconecta sozinho; CLOSED = servidor recusou (ex.: 503 por limite de conexões)
+    if(statusStream && statusStream.readyState === EventSource.CLOSED){
+      statusStream = null;
+      iniciarPolling();
+    }
+  };
 }
 
 /* INIT */
 updateAll();
-setInterval(updateAll, 1000);
+iniciarStream();